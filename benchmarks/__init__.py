@@ -0,0 +1 @@
+"""benchmarks of the fetch, parse, store and analysis hot paths"""
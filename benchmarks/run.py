@@ -0,0 +1,326 @@
+"""
+run the benchmark suite and persist its timings per commit
+
+usage:
+    python -m benchmarks.run                      # run everything
+    python -m benchmarks.run -k decode            # only matching benchmarks
+    python -m benchmarks.run -k import            # import time regressions
+    python -m benchmarks.run --compare abc1234    # diff against a saved run
+
+results are written to benchmarks/results/<commit>.json
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+import numpy as np
+
+from netmet.analysis import hop_statistics, traceroute_summary
+from netmet.anomaly import AnomalyDetector
+from netmet.archive import ProbeArchive
+from netmet.bulk import BulkImporter
+from netmet.client import AtlasClient
+from netmet.collector import ResultCollector, collect_ledger_to_store
+from netmet.ledger import Ledger
+from netmet.mock_server import MockAtlas, serve
+from netmet.registry import ProbeRegistry
+from netmet.scheduler import CampaignScheduler, build_definition, build_probes
+from netmet.store import TracerouteStore, flatten_traceroutes
+from netmet.stream import iter_json_array, iter_ndjson
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+BENCHMARKS = {}
+
+
+def benchmark(name: str, repeat: int = 5):
+    """register fn(setup_result) as a benchmark, setup runs outside the timing"""
+
+    def decorator(setup):
+        BENCHMARKS[name] = (setup, repeat)
+        return setup
+
+    return decorator
+
+
+def _fixture_traceroute() -> dict:
+    with (ROOT_DIR / "results" / "results_exo2_correction.json").open() as file:
+        return json.load(file)
+
+
+def _fixture_probes(nb_probes: int) -> list:
+    with (ROOT_DIR / "datasets" / "ua_vps_correction.json").open() as file:
+        probes = json.load(file)["results"]
+    return [
+        {**probes[i % len(probes)], "id": i, "asn_v4": random.randint(1, nb_probes // 10)}
+        for i in range(nb_probes)
+    ]
+
+
+def _traceroutes(nb_traceroutes: int) -> list:
+    template = _fixture_traceroute()
+    return [
+        {**template, "prb_id": i, "timestamp": template["timestamp"] + i}
+        for i in range(nb_traceroutes)
+    ]
+
+
+# probe list loading and indexing
+
+
+@benchmark("probes_load_index_10k")
+def _probes_load(tmp_dir: Path):
+    path = tmp_dir / "probes.json"
+    path.write_text(json.dumps(_fixture_probes(10000)))
+    return lambda: ProbeRegistry.from_file(path)
+
+
+@benchmark("probes_random_pick_100k")
+def _probes_pick(tmp_dir: Path):
+    registry = ProbeRegistry(_fixture_probes(10000))
+    return lambda: [registry.random(status="Connected") for _ in range(100000)]
+
+
+@benchmark("probe_archive_load_10k_30_snapshots")
+def _archive_load(tmp_dir: Path):
+    probes = _fixture_probes(10000)
+    archive = ProbeArchive(tmp_dir / "archive")
+    for day in range(30):
+        for probe in probes[day::7]:
+            probe["last_connected"] = day * 86400 + probe["id"]
+        archive.add(probes, timestamp=day * 86400)
+    return lambda: ProbeArchive(tmp_dir / "archive").at()
+
+
+# result decoding
+
+
+def _decode_benchmarks(nb_results: int) -> None:
+    traceroutes = _traceroutes(nb_results)
+    array = json.dumps(traceroutes).encode()
+    ndjson = b"".join(json.dumps(t).encode() + b"\n" for t in traceroutes)
+    chunks = lambda data: (data[i : i + 65536] for i in range(0, len(data), 65536))
+
+    @benchmark(f"decode_json_loads_{nb_results}")
+    def _loads(tmp_dir: Path):
+        return lambda: json.loads(array)
+
+    @benchmark(f"decode_stream_array_{nb_results}")
+    def _stream_array(tmp_dir: Path):
+        return lambda: sum(1 for _ in iter_json_array(chunks(array)))
+
+    @benchmark(f"decode_stream_ndjson_{nb_results}")
+    def _stream_ndjson(tmp_dir: Path):
+        return lambda: sum(1 for _ in iter_ndjson(chunks(ndjson)))
+
+
+for _nb_results in (1, 100, 10000):
+    _decode_benchmarks(_nb_results)
+
+
+# traceroute flattening and statistics
+
+
+@benchmark("flatten_10k_traceroutes")
+def _flatten(tmp_dir: Path):
+    traceroutes = _traceroutes(10000)
+    return lambda: flatten_traceroutes(traceroutes)
+
+
+@benchmark("hop_statistics_100k_traceroutes")
+def _hop_statistics(tmp_dir: Path):
+    base = flatten_traceroutes(_traceroutes(1000))
+    columns = {key: np.tile(values, 100) for key, values in base.items()}
+    columns["prb_id"] += np.repeat(np.arange(100, dtype=np.int32) * 1000, len(base["prb_id"]))
+    return lambda: (hop_statistics(columns), traceroute_summary(columns))
+
+
+@benchmark("bulk_import_20k_traceroutes_gz", repeat=3)
+def _bulk_import(tmp_dir: Path):
+    path = tmp_dir / "traceroutes.json.gz"
+    with gzip.open(path, "wt") as file:
+        for traceroute in _traceroutes(20000):
+            file.write(json.dumps(traceroute) + "\n")
+
+    def run():
+        store = TracerouteStore(Path(tempfile.mkdtemp(dir=tmp_dir)))
+        BulkImporter(store, workers=2).run([path])
+
+    return run
+
+
+@benchmark("anomaly_detect_100k_traceroutes")
+def _anomaly(tmp_dir: Path):
+    columns = flatten_traceroutes(_traceroutes(100000))
+    detector = AnomalyDetector()
+    return lambda: detector.process(columns)
+
+
+@benchmark("store_append_load_10k_traceroutes")
+def _store(tmp_dir: Path):
+    columns = flatten_traceroutes(_traceroutes(10000))
+
+    def run():
+        store = TracerouteStore(Path(tempfile.mkdtemp(dir=tmp_dir)))
+        for _ in range(10):
+            store.append_columns(columns)
+        store.load(["msm_id", "rtt"])
+
+    return run
+
+
+# ledger
+
+
+@benchmark("ledger_append_10k")
+def _ledger_append(tmp_dir: Path):
+    measurement = {
+        "measurement_id": [1],
+        "measurement_description": {
+            "definitions": [build_definition("1.1.1.1", 80, "ICMP")],
+            "probes": build_probes([1]),
+        },
+    }
+
+    def run():
+        ledger = Ledger(Path(tempfile.mkdtemp(dir=tmp_dir)) / "ledger.jsonl")
+        for i in range(10000):
+            ledger.append({**measurement, "measurement_id": [i]})
+
+    return run
+
+
+# import time of short-lived processes
+
+
+def _import_benchmark(module: str, forbidden: tuple = ()) -> None:
+    """time `python -c "import module"`, failing if it loads a forbidden module"""
+    code = (
+        f"import sys, {module}; "
+        f"sys.exit(','.join(m for m in {forbidden!r} if m in sys.modules) or None)"
+    )
+
+    @benchmark(f"import_{module.replace('.', '_')}", repeat=10)
+    def _import(tmp_dir: Path):
+        def run():
+            process = subprocess.run(
+                [sys.executable, "-c", code], cwd=ROOT_DIR, capture_output=True, text=True
+            )
+            if process.returncode:
+                raise RuntimeError(f"import {module}: {process.stderr.strip()}")
+
+        return run
+
+
+# the interpreter alone, as a baseline
+_import_benchmark("sys")
+# analysis workers and the exercise scripts must not load the HTTP stack
+for _module in ("netmet", "netmet.analysis", "netmet.topology", "main", "main_correction"):
+    _import_benchmark(_module, forbidden=("requests", "common.credentials"))
+_import_benchmark("netmet.cli", forbidden=("requests", "numpy"))
+
+
+# end to end against the mock server
+
+
+@benchmark("submit_collect_100_measurements_100_results", repeat=3)
+def _end_to_end(tmp_dir: Path):
+    def run():
+        atlas = MockAtlas(latency=0.005, results_per_measurement=100)
+        with serve(atlas) as base_url:
+            client = AtlasClient(api_key="benchmark", base_url=base_url)
+            run_dir = Path(tempfile.mkdtemp(dir=tmp_dir))
+            ledger_path = run_dir / "ledger.jsonl"
+
+            scheduler = CampaignScheduler(
+                {"username": "benchmark", "secret_key": "benchmark"},
+                client=client,
+                min_interval=0.0,
+            )
+            pairs = [(1, f"10.0.{i // 256}.{i % 256}") for i in range(100)]
+            for _ in scheduler.submit(pairs, 80, "ICMP", ledger_path):
+                pass
+
+            collector = ResultCollector(client=client, poll_interval=0.01)
+            asyncio.run(
+                collect_ledger_to_store(ledger_path, TracerouteStore(run_dir / "store"), collector)
+            )
+
+    return run
+
+
+def run_benchmarks(pattern: str = "") -> dict:
+    timings = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, (setup, repeat) in BENCHMARKS.items():
+            if pattern not in name:
+                continue
+
+            fn = setup(Path(tmp))
+
+            durations = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                fn()
+                durations.append(time.perf_counter() - start)
+
+            timings[name] = {"min": min(durations), "median": statistics.median(durations)}
+            print(f"{name:50s} min {min(durations) * 1000:10.2f} ms", flush=True)
+
+    return timings
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=ROOT_DIR,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(timings: dict, reference: dict) -> None:
+    for name, timing in timings.items():
+        if name in reference:
+            ratio = timing["min"] / reference[name]["min"]
+            print(f"{name:50s} x{ratio:6.2f} {'slower' if ratio > 1 else 'faster'}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="netmet benchmark suite")
+    parser.add_argument("-k", dest="pattern", default="", help="only run matching benchmarks")
+    parser.add_argument("--compare", help="commit of a saved run to compare against")
+    args = parser.parse_args()
+
+    timings = run_benchmarks(args.pattern)
+
+    RESULTS_DIR.mkdir(exist_ok=True)
+    commit = current_commit()
+    result_path = RESULTS_DIR / f"{commit}.json"
+    result_path.write_text(json.dumps({"commit": commit, "timings": timings}, indent=4))
+    print(f"results saved to {result_path}")
+
+    if args.compare:
+        reference = json.loads((RESULTS_DIR / f"{args.compare}.json").read_text())
+        compare(timings, reference["timings"])
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
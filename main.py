@@ -1,12 +1,9 @@
 """execute each exercise or correction for TP1"""
-import requests
-import random
 import sys
 
 from pathlib import Path
 
-from common.credentials import get_ripe_atlas_credentials
-from common.file_utils import dump_json, load_json, insert_json
+from common.file_utils import dump_json
 from common.default import (
     TP2_VPS_DATASET,
     TP2_TARGETS_DATASET,
@@ -14,32 +11,42 @@ from common.default import (
     TP2_TARGETS_DATASET_CORRECTION,
     TP2_RESULTS_PATH,
 )
-from common.ripe.utils import print_traceroute
 from common.logger_config import logger
 
+# netmet loads its submodules on first use: importing this script does not
+# pull in requests or the credentials until an exercise needs them
+import netmet
+
+
+# every crawl is also kept as a dated snapshot: the datasets above only hold
+# the latest probe lists, the archives their whole history
+VPS_ARCHIVE = TP2_VPS_DATASET_CORRECTION.parent / "archive" / "ua_vps"
+TARGETS_ARCHIVE = TP2_TARGETS_DATASET_CORRECTION.parent / "archive" / "ru_targets"
+
 
 def get_one_vp_one_target_random() -> tuple:
     """return one vp from set of vp and one target from set of target"""
 
-    # first we will load targets and vps from last exercise
+    # first we will load targets and vps from last exercise,
+    # only once per process: the registries are kept in memory
     try:
-        targets = load_json(TP2_TARGETS_DATASET)  # all UA connected servers
-        vps = load_json(TP2_VPS_DATASET)  # all RU connected servers
+        targets = netmet.get_registry(TP2_TARGETS_DATASET)  # all UA connected servers
+        vps = netmet.get_registry(TP2_VPS_DATASET)  # all RU connected servers
     except FileNotFoundError:
         logger.info("using vps and targets from the correction")
 
-        targets = load_json(TP2_TARGETS_DATASET_CORRECTION)  # all UA connected servers
-        vps = load_json(TP2_VPS_DATASET_CORRECTION)  # all RU connected servers
+        targets = netmet.get_registry(TP2_TARGETS_DATASET_CORRECTION)  # all UA connected servers
+        vps = netmet.get_registry(TP2_VPS_DATASET_CORRECTION)  # all RU connected servers
 
     # we get one random target and one random vp,
     # so we do not overload one specific pair with our measurements
-    target_index = random.randint(0, len(targets) - 1)
-    target = targets[target_index]
+    target = targets.random()
+    vp = vps.random()
 
-    vp_index = random.randint(0, len(vps) - 1)
-    vp = vps[vp_index]
-
-    logger.info(f"You got: vp = {vp} and target = {target}")
+    logger.info(
+        f"You got: vp = {vp['id']} ({vp['address_v4']}) "
+        f"and target = {target['id']} ({target['address_v4']})"
+    )
 
     return vp, target
 
@@ -61,15 +68,18 @@ def exo1_get_a_measurement(measurement_id: int, output_file_path: Path) -> dict:
     # TODO: make an http request to RIPE API (using requests package)  #
     # to get measurement with measurement id : 38333397                #
     ####################################################################
-    measurement_description: dict =  requests.get(f"{base_url}{measurement_id}/").json()
+    measurement_description: dict = netmet.get_cache().get_json(
+        f"{base_url}{measurement_id}/", ttl=netmet.measurement_ttl
+    )
 
     if not measurement_description:
         logger.error("Measurement description is empty")
         sys.exit(1)
 
-    logger.info("Measurement description")
+    # formatting every field of large payloads is costly: only in debug
+    logger.info(f"Measurement description: {', '.join(measurement_description)}")
     for key, val in measurement_description.items():
-        logger.info(f"{key} : {val}")
+        logger.debug(f"{key} : {val}")
 
     dump_json(measurement_description, output_file_path)
 
@@ -96,35 +106,41 @@ def exo2_get_a_measurement_result(measurement_id: int, output_file_path: Path) -
     # to get measurement results for measurement uuid 38333397         #
     ####################################################################
 
-    # 1. get measurement description
-    response = requests.get(f"{base_url}{measurement_id}/")
+    # 1. get measurement description (from the local cache if possible)
+    measurement_description = netmet.get_cache().get_json(
+        f"{base_url}{measurement_id}/", ttl=netmet.measurement_ttl
+    )
 
-    if not response:
+    if not measurement_description:
         logger.error("measurement description is empty")
         sys.exit(1)
 
     # 2. check measurement description to get measurement results url
-    measurement_description = response.json()
     result_url = measurement_description.get("result")
 
     if not result_url:
         logger.error("result url empty")
         sys.exit(1)
 
-    # 3. make the request to get measurement results
-    results_response = requests.get(result_url)
+    # 3. get measurement results (from the local cache once the measurement stopped)
+    # 4. just take the first result
+    results = next(
+        netmet.iter_results(
+            result_url,
+            limit=1,
+            cache=netmet.get_cache(),
+            ttl=netmet.measurement_ttl(measurement_description),
+        ),
+        None,
+    )
 
-    if not result_url:
+    if not results:
         logger.error("Measurement results empty")
         sys.exit(1)
 
-    # 4. just take the first result
-    results = results_response.json()[0]
-
-    logger.info("Results:")
+    logger.info(f"Results: {', '.join(results)}")
     for key, val in results.items():
-        logger.info(f"{key} : {val}")
-    logger.info("\n")
+        logger.debug(f"{key} : {val}")
 
     # 5. from measurement result, get:
     #   - the source address of the measurement
@@ -144,6 +160,8 @@ def exo2_get_a_measurement_result(measurement_id: int, output_file_path: Path) -
     # 7. print the traceroute
     logger.info("Traceroute results")
     if traceroute:
+        from common.ripe.utils import print_traceroute
+
         print_traceroute(traceroute)
 
         dump_json(results, output_file_path)
@@ -157,8 +175,6 @@ def exo3_get_all_vps() -> None:
     logger.info("#  EXO3                                       #")
     logger.info("###############################################")
 
-    base_url = "https://atlas.ripe.net/api/v2/probes/"
-
     # 1. Set parameters (Define your parameters here)
     params = {
         "country_code": "UA",  # Add other required parameters as needed
@@ -170,20 +186,15 @@ def exo3_get_all_vps() -> None:
         logger.error("You must set parameters")
         sys.exit(1)
     else:
-        # 2. Perform a request to get all RIPE Atlas servers in Ukraine
-        response = requests.get(base_url, params=params)
-
-        if not response:
-            logger.error("Failed to fetch connected servers from Ukraine")
-            sys.exit(1)
+        # 2. Crawl every page of RIPE Atlas servers in Ukraine
+        all_servers = netmet.get_all_probes(params)
 
         # 3. Filter servers so they all have connected status and an IPv4 address (Define your filtering logic here)
-        all_servers = response.json()
-
         if all_servers:
             logger.info(f"Retrieved {len(all_servers)} servers from Russia")
             # Dump the data to a file (Use your dump_json function)
             dump_json(all_servers, TP2_VPS_DATASET_CORRECTION)  # Replace with the appropriate file path
+            netmet.ProbeArchive(VPS_ARCHIVE).add(all_servers)
         else:
             logger.error("VP dataset is empty")
             sys.exit(1)
@@ -195,8 +206,6 @@ def exo4_get_all_targets() -> None:
     logger.info("#  EXO4                                       #")
     logger.info("###############################################")
 
-    base_url = "https://atlas.ripe.net/api/v2/probes/"
-
     # 1. Set parameters (Define your parameters here)
     params = {
         "country_code": "RU",  # Add other required parameters as needed
@@ -207,20 +216,15 @@ def exo4_get_all_targets() -> None:
         logger.error("You must set parameters")
         sys.exit(1)
     else:
-        # 2. Perform a request to get all RIPE Atlas servers in Russia
-        response = requests.get(base_url, params=params)
-
-        if not response:
-            logger.error("Failed to fetch connected servers from Russia")
-            sys.exit(1)
+        # 2. Crawl every page of RIPE Atlas servers in Russia
+        all_servers = netmet.get_all_probes(params)
 
         # 3. Get all servers without specific filtering
-        all_servers = response.json()
-
         if all_servers:
             logger.info(f"Retrieved {len(all_servers)} servers from Russia")
             # Dump the data to a file (Use your dump_json function)
             dump_json(all_servers, TP2_TARGETS_DATASET_CORRECTION)
+            netmet.ProbeArchive(TARGETS_ARCHIVE).add(all_servers)
         else:
             logger.error("Target dataset is empty")
             sys.exit(1)
@@ -239,6 +243,8 @@ def exo5_perform_measurement(
     logger.info("#  EXO5                                       #")
     logger.info("###############################################")
 
+    from common.credentials import get_ripe_atlas_credentials
+
     ripe_credentials = get_ripe_atlas_credentials()
 
     if not ripe_credentials:
@@ -246,37 +252,29 @@ def exo5_perform_measurement(
             "set .env file at the root dir of the project with correct credentials"
         )
 
-    base_url = f"https://atlas.ripe.net/api/v2/measurements/?key={ripe_credentials['secret_key']}"
-
     logger.info(
         f"Performing traceroute measurement from {vp['address_v4']} to {target['address_v4']}"
     )
 
     json_params = {
         "definitions": [
-            {
-                "target": target["address_v4"],
-                "af": 4,
-                "packets": 3,
-                "size": 48,
-                "tags": ["netmethr"],
-                "description": "Netmet",
-                "resolve_on_probe": False,
-                "skip_dns_check": True,
-                "include_probe_id": False,
-                "port": port,
-                "type": measurement_type,
-                "protocol": protocol,
-            },
+            netmet.build_definition(target["address_v4"], port, protocol, measurement_type),
         ],
         "probes": [{"value": vp["id"], "type": "probes", "requested": 1}],
         "is_oneoff": True,
         "bill_to": ripe_credentials["username"],
     }
 
-    response = requests.post(url=base_url, json=json_params).json()
+    logger.info(f"estimated cost: {netmet.request_cost(json_params)} credits")
+
+    # the shared client sends the API key in the Authorization header
+    response = netmet.get_client().post_json("measurements/", json_params)
 
-    logger.info(response)
+    logger.debug(response)
+
+    if "measurements" not in response:
+        logger.error(f"measurement request refused: {response.get('error', response)}")
+        return None
 
     measurement = {
         "measurement_id": response["measurements"],
@@ -285,11 +283,87 @@ def exo5_perform_measurement(
 
     logger.info(f"measurement uuid (for retrieval): {response['measurements']}")
 
-    insert_json(measurement, output_file_path)
+    # one constant time append, whatever the size of the ledger
+    netmet.Ledger(output_file_path).append(measurement)
 
     return measurement_id
 
 
+def exo6_sweep(
+    target: dict,
+    vp: dict,
+    protocols: list,
+    ports: list,
+    paris: list,
+    measurement_type: str,
+    output_file_path: Path,
+) -> list:
+    """
+    measure the same vp and target with every protocol, port and paris id
+
+    all the variants are packed into as few requests as possible, instead of
+    one exo5 run per variant; variants already in the ledger are skipped.
+    """
+    logger.info("###############################################")
+    logger.info("#  EXO6                                       #")
+    logger.info("###############################################")
+
+    from common.credentials import get_ripe_atlas_credentials
+
+    ripe_credentials = get_ripe_atlas_credentials()
+
+    if not ripe_credentials:
+        raise RuntimeError(
+            "set .env file at the root dir of the project with correct credentials"
+        )
+
+    variants = netmet.sweep_variants(protocols, ports, paris)
+    logger.info(
+        f"sweeping {len(variants)} variants from {vp['address_v4']} to {target['address_v4']}"
+    )
+
+    scheduler = netmet.CampaignScheduler(ripe_credentials)
+    measurements = scheduler.submit_variants(
+        [(vp["id"], target["address_v4"])],
+        variants,
+        output_file_path=output_file_path,
+        measurement_type=measurement_type,
+    )
+
+    measurement_ids = [
+        measurement_id
+        for measurement in measurements
+        for measurement_id in measurement["measurement_id"]
+    ]
+    logger.info(f"measurement uuids (for retrieval): {measurement_ids}")
+
+    return measurement_ids
+
+
+def exo6_compare_sweep(ledger_path: Path, output_file_path: Path) -> dict:
+    """download the results of a sweep and print the hops of each variant side by side"""
+    ledger = netmet.Ledger(ledger_path)
+
+    results = [
+        result
+        for measurement_id in ledger.measurement_ids()
+        for result in netmet.iter_results(f"measurements/{measurement_id}/results/")
+    ]
+    sweep = netmet.SweepResult.from_results(results, ledger)
+
+    for vp_id, target_addr in sweep.pairs():
+        logger.info(f"vp {vp_id} -> {target_addr}\n{sweep.format(vp_id, target_addr)}")
+
+    summary = sweep.summary()
+    logger.info(
+        f"{summary['nb_divergent_hops']} hops answered by a different address "
+        f"depending on the variant (load balancing)"
+    )
+    dump_json({**summary, "divergent_hops": sweep.divergent_hops()}, output_file_path)
+
+    return summary
+
+
 if __name__ == "__main__":
     # comment methods you do not want to exec
     # (or uncomment otherwise)
@@ -318,14 +392,32 @@ if __name__ == "__main__":
         port=port,
         protocol=protocol,
         measurement_type=measurement_type,
-        output_file_path=TP2_RESULTS_PATH / "results_exo5_correction.json",
+        output_file_path=TP2_RESULTS_PATH / "results_exo5_correction.jsonl",
     ) 
 
+    # at scale, campaigns run from the command line (see netmet/cli.py):
+    #   python -m netmet fetch-probes|submit|collect|analyze campaign.json
+
     # On your own, make a measurement with the same target and same vp but:
     #   - change port number with ICMP
     #   - make one measurement with UDP
     # analyze the results
 
+    # or sweep every variant in one batch and compare their hops:
+    """exo6_sweep(
+        target=target,
+        vp=vp,
+        protocols=["ICMP", "UDP", "TCP"],
+        ports=[34543, 33434, 80],
+        paris=[None, 16],
+        measurement_type="traceroute",
+        output_file_path=TP2_RESULTS_PATH / "results_exo6_correction.jsonl",
+    )
+    exo6_compare_sweep(
+        TP2_RESULTS_PATH / "results_exo6_correction.jsonl",
+        output_file_path=TP2_RESULTS_PATH / "exo6_sweep_correction.json",
+    )"""
+
     # measurement_ids = [60359913, 60359920, 60359932]
 
     """ for id in measurement_ids:
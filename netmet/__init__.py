@@ -0,0 +1,95 @@
+"""
+reusable building blocks for the TP2 measurement scripts
+
+submodules and their main names are loaded on first access (PEP 562), so
+that `import netmet` stays cheap: the HTTP stack and the credentials are
+only imported by code that talks to the API, never by analysis workers.
+
+    import netmet
+    netmet.hop_statistics(columns)   # imports netmet.analysis (numpy) only
+    netmet.get_client()              # imports requests and the credentials
+"""
+import importlib
+
+
+SUBMODULES = {
+    "admission",
+    "analysis",
+    "archive",
+    "bulk",
+    "anomaly",
+    "cache",
+    "changes",
+    "cli",
+    "client",
+    "collector",
+    "geo",
+    "ledger",
+    "metrics",
+    "mock_server",
+    "prefixes",
+    "probes",
+    "registry",
+    "sampler",
+    "scheduler",
+    "store",
+    "stream",
+    "sweep",
+    "topology",
+}
+
+# public name -> submodule defining it
+EXPORTS = {
+    "AdmissionController": "admission",
+    "request_cost": "admission",
+    "analyze_traceroutes": "analysis",
+    "hop_statistics": "analysis",
+    "measurement_summary": "analysis",
+    "traceroute_summary": "analysis",
+    "ProbeArchive": "archive",
+    "BulkImporter": "bulk",
+    "AnomalyDetector": "anomaly",
+    "get_cache": "cache",
+    "measurement_ttl": "cache",
+    "ChangeDetector": "changes",
+    "AtlasClient": "client",
+    "get_client": "client",
+    "ResultCollector": "collector",
+    "SiteTree": "geo",
+    "Sites": "geo",
+    "haversine": "geo",
+    "Ledger": "ledger",
+    "iter_ledger": "ledger",
+    "PrefixIndex": "prefixes",
+    "get_all_probes": "probes",
+    "iter_probes": "probes",
+    "ProbeRegistry": "registry",
+    "get_registry": "registry",
+    "sample_pairs": "sampler",
+    "CampaignScheduler": "scheduler",
+    "build_definition": "scheduler",
+    "TracerouteStore": "store",
+    "flatten_traceroutes": "store",
+    "iter_results": "stream",
+    "SweepResult": "sweep",
+    "sweep_variants": "sweep",
+    "TopologyGraph": "topology",
+}
+
+__all__ = sorted(EXPORTS)
+
+
+def __getattr__(name: str):
+    if name in SUBMODULES:
+        return importlib.import_module(f"{__name__}.{name}")
+    if name in EXPORTS:
+        value = getattr(importlib.import_module(f"{__name__}.{EXPORTS[name]}"), name)
+        # later accesses skip __getattr__
+        globals()[name] = value
+        return value
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | SUBMODULES | set(EXPORTS))
@@ -0,0 +1,6 @@
+import sys
+
+from netmet.cli import main
+
+
+sys.exit(main())
@@ -0,0 +1,213 @@
+"""
+credit and quota aware admission control for measurement submissions
+
+every request is admitted only once it fits the account budget, the daily
+credit limit, the concurrent measurement cap and the request/credit rates;
+until then it waits in line rather than being refused by the API.
+"""
+import collections
+import threading
+import time
+
+from typing import Callable, Optional
+
+from common.logger_config import logger
+
+from netmet.metrics import metrics
+
+
+CREDITS_PATH = "credits/"
+
+# credits per probe and per packet of a one-off, by measurement type
+# (see https://atlas.ripe.net/docs/getting-started/credits.html)
+CREDITS_PER_PACKET = {"ping": 1, "traceroute": 10, "ntp": 1}
+CREDITS_PER_RESULT = {"dns": 10, "sslcert": 10, "http": 10}
+
+# the API accounts the daily limit over the last 24 hours
+DAY = 24 * 3600.0
+
+
+class BudgetExhausted(Exception):
+    """the credit budget cannot pay for the next request"""
+
+
+def definition_cost(definition: dict, nb_probes: int) -> int:
+    """estimated credits of one definition run once on nb_probes probes"""
+    measurement_type = definition.get("type", "traceroute")
+    if measurement_type in CREDITS_PER_RESULT:
+        return CREDITS_PER_RESULT[measurement_type] * nb_probes
+
+    # packets larger than 1500 bytes count several times
+    packets = definition.get("packets", 3) * (definition.get("size", 48) // 1500 + 1)
+
+    return CREDITS_PER_PACKET.get(measurement_type, 10) * packets * nb_probes
+
+
+def request_cost(json_params: dict) -> int:
+    """estimated credits of a measurement request, every definition on every probe"""
+    nb_probes = sum(int(probes.get("requested", 0)) for probes in json_params["probes"])
+
+    return sum(
+        definition_cost(definition, nb_probes) for definition in json_params["definitions"]
+    )
+
+
+def account_balance(client) -> Optional[int]:
+    """current credit balance of the account, None when the API does not tell"""
+    return client.get_json(CREDITS_PATH).get("current_balance")
+
+
+class TokenBucket:
+    """
+    tokens refill at rate per second up to capacity
+
+    take() blocks until the tokens are there, so bursts up to capacity go
+    through at once and the long run average never exceeds rate.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, amount: float) -> float:
+        """seconds to wait before amount tokens are available"""
+        with self._lock:
+            self._refill()
+            # a request larger than the bucket waits for a full bucket
+            missing = min(amount, self.capacity) - self._tokens
+            return max(missing, 0.0) / self.rate if self.rate > 0 else 0.0
+
+    def take(self, amount: float = 1.0) -> float:
+        """block until amount tokens are available, return the time waited"""
+        waited = 0.0
+        while True:
+            delay = self.delay(amount)
+            if delay <= 0:
+                break
+            time.sleep(delay)
+            waited += delay
+
+        with self._lock:
+            self._tokens -= amount
+
+        return waited
+
+
+class AdmissionController:
+    """
+    decide when a measurement request may be posted
+
+    - credit_budget: total credits this run may spend, requests beyond it
+      raise BudgetExhausted (the rest of the campaign stays to be submitted)
+    - daily_credits: credits spent over any 24 hours
+    - max_concurrent: measurements running at once; running_measurements,
+      when given, is asked for the real count whenever the local estimate
+      says the cap might be reached, or before every request when shared
+      (other processes submit on the same account, so the local estimate
+      cannot see their measurements)
+    - requests_per_second and credits_per_hour: token bucket rates, None
+      for no limit
+    """
+
+    def __init__(
+        self,
+        credit_budget: Optional[int] = None,
+        daily_credits: Optional[int] = None,
+        max_concurrent: int = 100,
+        requests_per_second: Optional[float] = 1.0,
+        credits_per_hour: Optional[float] = None,
+        running_measurements: Optional[Callable[[], int]] = None,
+        poll_interval: float = 30.0,
+        shared: bool = False,
+    ) -> None:
+        self.credit_budget = credit_budget
+        self.daily_credits = daily_credits
+        self.max_concurrent = max_concurrent
+        self.running_measurements = running_measurements
+        self.poll_interval = poll_interval
+        self.shared = shared
+
+        self.request_bucket = (
+            TokenBucket(requests_per_second, capacity=1.0) if requests_per_second else None
+        )
+        self.credit_bucket = (
+            TokenBucket(credits_per_hour / 3600.0, capacity=credits_per_hour)
+            if credits_per_hour
+            else None
+        )
+
+        self.spent = 0
+        self._spending = collections.deque()  # (time, credits) of the last 24 hours
+        self._running = None
+
+    def _spent_today(self) -> int:
+        while self._spending and time.time() - self._spending[0][0] > DAY:
+            self._spending.popleft()
+        return sum(credits for _, credits in self._spending)
+
+    def _wait_for_daily_credits(self, cost: int) -> None:
+        if self.daily_credits is None:
+            return
+        if cost > self.daily_credits:
+            raise BudgetExhausted(f"one request costs {cost} credits, over the daily limit")
+
+        if self._spent_today() + cost > self.daily_credits:
+            logger.info("daily credit limit reached, waiting for credits to free up")
+        while self._spent_today() + cost > self.daily_credits:
+            delay = self._spending[0][0] + DAY - time.time()
+            time.sleep(max(min(delay, self.poll_interval), 0.0))
+
+    def _wait_for_slots(self, nb_measurements: int) -> None:
+        # only ask the API when our local estimate says we might be over the cap
+        if (
+            self.shared
+            or self._running is None
+            or self._running + nb_measurements > self.max_concurrent
+        ):
+            self._running = self.running_measurements() if self.running_measurements else 0
+            while self._running + nb_measurements > self.max_concurrent:
+                logger.info(
+                    f"concurrent measurement limit reached, waiting {self.poll_interval}s"
+                )
+                time.sleep(self.poll_interval)
+                self._running = self.running_measurements()
+
+    def admit(self, json_params: dict) -> int:
+        """
+        block until json_params may be posted, return its estimated cost
+
+        raises BudgetExhausted when the request would overrun credit_budget.
+        """
+        cost = request_cost(json_params)
+        if self.credit_budget is not None and self.spent + cost > self.credit_budget:
+            raise BudgetExhausted(
+                f"{self.spent} of {self.credit_budget} credits spent, next request costs {cost}"
+            )
+
+        start = time.monotonic()
+        self._wait_for_daily_credits(cost)
+        self._wait_for_slots(len(json_params["definitions"]))
+        if self.credit_bucket:
+            self.credit_bucket.take(cost)
+        if self.request_bucket:
+            self.request_bucket.take()
+        metrics.observe("admission_wait_seconds", time.monotonic() - start)
+
+        return cost
+
+    def record(self, json_params: dict, cost: int) -> None:
+        """account for a request the API accepted"""
+        self.spent += cost
+        self._spending.append((time.time(), cost))
+        self._running = (self._running or 0) + len(json_params["definitions"])
+
+        metrics.inc("credits_spent", cost)
+        metrics.set("scheduler_running", self._running)
@@ -0,0 +1,204 @@
+"""vectorized statistics over many traceroutes at once"""
+from typing import Iterable
+
+import numpy as np
+
+from netmet.store import flatten_traceroutes
+
+
+def _boundaries(*keys: np.ndarray) -> np.ndarray:
+    """indexes where any of the (contiguous) keys changes value"""
+    nb_rows = len(keys[0])
+    change = np.zeros(nb_rows, dtype=bool)
+    if nb_rows:
+        change[0] = True
+    for key in keys:
+        change[1:] |= key[1:] != key[:-1]
+
+    return np.flatnonzero(change)
+
+
+def _group_quantile(
+    sorted_values: np.ndarray, starts: np.ndarray, nb_valid: np.ndarray, q: float
+) -> np.ndarray:
+    """linear interpolated quantile per group, values sorted with nan last"""
+    position = q * np.maximum(nb_valid - 1, 0)
+    low = np.floor(position).astype(np.int64)
+    high = np.ceil(position).astype(np.int64)
+
+    low_values = sorted_values[np.minimum(starts + low, len(sorted_values) - 1)]
+    high_values = sorted_values[np.minimum(starts + high, len(sorted_values) - 1)]
+    quantile = low_values + (high_values - low_values) * (position - low)
+
+    return np.where(nb_valid > 0, quantile, np.nan)
+
+
+def hop_statistics(columns: dict) -> dict:
+    """
+    per (traceroute, hop) statistics, computed without per-hop python loops
+
+    columns are rows as produced by flatten_traceroutes / TracerouteStore.load,
+    where the rows of one traceroute are contiguous and ordered by hop.
+    Returns one entry per hop: msm_id, prb_id, timestamp, hop, rtt_min,
+    rtt_median, rtt_p95, loss_rate and rtt_delta (min rtt increase since
+    the previous hop of the same traceroute, nan for the first hop).
+    """
+    msm_id = columns["msm_id"]
+    prb_id = columns["prb_id"]
+    timestamp = columns["timestamp"]
+    hop = columns["hop"]
+    rtt = columns["rtt"].astype(np.float64)
+    timeout = columns["timeout"]
+
+    # 1. number each hop group, then sort rtts inside each group (nan last)
+    hop_starts = _boundaries(msm_id, prb_id, timestamp, hop)
+    group = np.zeros(len(hop), dtype=np.int64)
+    group[hop_starts[1:]] = 1
+    group = np.cumsum(group)
+
+    order = np.lexsort((rtt, group))
+    sorted_rtt = rtt[order]
+
+    counts = np.diff(np.append(hop_starts, len(hop)))
+    nb_valid = np.add.reduceat(~np.isnan(sorted_rtt), hop_starts) if len(hop) else counts
+    nb_lost = np.add.reduceat(timeout, hop_starts) if len(hop) else counts
+
+    rtt_min = np.where(nb_valid > 0, sorted_rtt[hop_starts] if len(hop) else rtt, np.nan)
+
+    # 2. min rtt increase since the previous hop of the same traceroute
+    rtt_delta = np.full(len(hop_starts), np.nan)
+    if len(hop_starts) > 1:
+        same_traceroute = (
+            (msm_id[hop_starts[1:]] == msm_id[hop_starts[:-1]])
+            & (prb_id[hop_starts[1:]] == prb_id[hop_starts[:-1]])
+            & (timestamp[hop_starts[1:]] == timestamp[hop_starts[:-1]])
+        )
+        rtt_delta[1:] = np.where(same_traceroute, rtt_min[1:] - rtt_min[:-1], np.nan)
+
+    return {
+        "msm_id": msm_id[hop_starts],
+        "prb_id": prb_id[hop_starts],
+        "timestamp": timestamp[hop_starts],
+        "hop": hop[hop_starts],
+        "rtt_min": rtt_min,
+        "rtt_median": _group_quantile(sorted_rtt, hop_starts, nb_valid, 0.5),
+        "rtt_p95": _group_quantile(sorted_rtt, hop_starts, nb_valid, 0.95),
+        "loss_rate": nb_lost / np.maximum(counts, 1),
+        "rtt_delta": rtt_delta,
+    }
+
+
+def traceroute_summary(columns: dict) -> dict:
+    """
+    per traceroute path length and destination-reached flag
+
+    a traceroute reaches its destination when any reply comes from dst_addr.
+    """
+    msm_id = columns["msm_id"]
+    prb_id = columns["prb_id"]
+    timestamp = columns["timestamp"]
+
+    starts = _boundaries(msm_id, prb_id, timestamp)
+    if not len(starts):
+        return {
+            "msm_id": msm_id,
+            "prb_id": prb_id,
+            "timestamp": timestamp,
+            "path_length": columns["hop"],
+            "reached": np.zeros(0, dtype=bool),
+        }
+
+    reached_rows = (columns["from"] == columns["dst"]) & (columns["dst"] != 0)
+
+    return {
+        "msm_id": msm_id[starts],
+        "prb_id": prb_id[starts],
+        "timestamp": timestamp[starts],
+        "path_length": np.maximum.reduceat(columns["hop"], starts),
+        "reached": np.logical_or.reduceat(reached_rows, starts),
+    }
+
+
+def measurement_summary(columns: dict) -> dict:
+    """
+    aggregate per measurement, e.g. to compare ICMP / UDP / port variants
+
+    returns, per msm_id: number of traceroutes, mean path length, share of
+    traceroutes reaching the destination, overall loss rate and median of
+    the last hop min rtt.
+    """
+    traceroutes = traceroute_summary(columns)
+    hops = hop_statistics(columns)
+
+    msm_ids, traceroute_group = np.unique(traceroutes["msm_id"], return_inverse=True)
+    nb_traceroutes = np.bincount(traceroute_group, minlength=len(msm_ids))
+
+    # last hop of each traceroute
+    last_hop = np.ones(len(hops["hop"]), dtype=bool)
+    if len(last_hop) > 1:
+        last_hop[:-1] = (
+            (hops["msm_id"][1:] != hops["msm_id"][:-1])
+            | (hops["prb_id"][1:] != hops["prb_id"][:-1])
+            | (hops["timestamp"][1:] != hops["timestamp"][:-1])
+        )
+    last_rtt = hops["rtt_min"][last_hop]
+    _, last_group = np.unique(hops["msm_id"][last_hop], return_inverse=True)
+
+    # sort last hop rtts per measurement to take their median
+    order = np.lexsort((last_rtt, last_group))
+    sorted_rtt = last_rtt[order]
+    starts = np.flatnonzero(np.diff(np.append(-1, last_group[order])))
+    nb_valid = (
+        np.add.reduceat(~np.isnan(sorted_rtt), starts) if len(starts) else nb_traceroutes
+    )
+
+    row_group = np.searchsorted(msm_ids, columns["msm_id"])
+    nb_rows = np.bincount(row_group, minlength=len(msm_ids))
+    nb_lost = np.bincount(row_group, weights=columns["timeout"], minlength=len(msm_ids))
+
+    return {
+        "msm_id": msm_ids,
+        "traceroutes": nb_traceroutes,
+        "path_length": np.bincount(
+            traceroute_group, weights=traceroutes["path_length"], minlength=len(msm_ids)
+        )
+        / np.maximum(nb_traceroutes, 1),
+        "reached": np.bincount(
+            traceroute_group, weights=traceroutes["reached"], minlength=len(msm_ids)
+        )
+        / np.maximum(nb_traceroutes, 1),
+        "loss_rate": nb_lost / np.maximum(nb_rows, 1),
+        "rtt_median": _group_quantile(sorted_rtt, starts, nb_valid, 0.5),
+    }
+
+
+def responding_hops(columns: dict) -> dict:
+    """
+    one entry per hop that got at least one reply
+
+    the hop is represented by the address of its first responding reply,
+    together with the min rtt of its replies; silent hops are skipped.
+    """
+    responding = (columns["from"] != 0) & ~columns["timeout"]
+    msm_id = columns["msm_id"][responding]
+    prb_id = columns["prb_id"][responding]
+    timestamp = columns["timestamp"][responding]
+    hop = columns["hop"][responding]
+    rtt = columns["rtt"][responding].astype(np.float64)
+
+    starts = _boundaries(msm_id, prb_id, timestamp, hop)
+
+    return {
+        "msm_id": msm_id[starts],
+        "prb_id": prb_id[starts],
+        "timestamp": timestamp[starts],
+        "dst": columns["dst"][responding][starts],
+        "hop": hop[starts],
+        "address": columns["from"][responding][starts],
+        "rtt_min": np.fmin.reduceat(rtt, starts) if len(starts) else rtt,
+    }
+
+
+def analyze_traceroutes(traceroutes: Iterable[dict]) -> dict:
+    """flatten raw traceroute results and return their hop statistics"""
+    return hop_statistics(flatten_traceroutes(traceroutes))
@@ -0,0 +1,374 @@
+"""streaming rtt anomaly and congestion detection over traceroute batches"""
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+from netmet.analysis import _boundaries
+from netmet.store import flatten_traceroutes, int_to_ip
+
+
+# random multipliers per hop number, to hash a path into one integer
+_HOP_MULTIPLIERS = np.random.default_rng(0).integers(
+    1, 2**63, size=256, dtype=np.uint64
+) | np.uint64(1)
+
+
+class _StateTable:
+    """
+    fixed size state per key, in growable arrays
+
+    keys are int64; each key gets a row index on first sight, and every
+    field is a numpy array indexed by row.
+    """
+
+    def __init__(self, fields: dict) -> None:
+        self.fields = fields
+        self.rows = {}
+        self.capacity = 0
+        self.arrays = {name: np.empty(0, dtype=dtype) for name, (dtype, _) in fields.items()}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.arrays[name][: len(self.rows)]
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        """row of each key, allocating rows for new keys"""
+        unique, inverse = np.unique(keys, return_inverse=True)
+        rows = self.rows
+        unique_rows = np.fromiter(
+            (rows.setdefault(key, len(rows)) for key in unique.tolist()),
+            dtype=np.int64,
+            count=len(unique),
+        )
+        self._grow()
+
+        return unique_rows[inverse.reshape(-1)]
+
+    def _grow(self) -> None:
+        if len(self.rows) <= self.capacity:
+            return
+
+        # amortized doubling, new rows start from the initial values
+        self.capacity = max(len(self.rows), 2 * self.capacity, 1024)
+        for name, (dtype, initial) in self.fields.items():
+            array = np.full(self.capacity, initial, dtype=dtype)
+            array[: len(self.arrays[name])] = self.arrays[name]
+            self.arrays[name] = array
+
+    def state(self) -> dict:
+        return {
+            "keys": np.fromiter(self.rows, dtype=np.int64, count=len(self.rows)),
+            **{name: self[name] for name in self.fields},
+        }
+
+    def restore(self, state: dict) -> None:
+        self.rows = {key: row for row, key in enumerate(state["keys"].tolist())}
+        self.capacity = len(self.rows)
+        self.arrays = {name: state[name].astype(dtype) for name, (dtype, _) in self.fields.items()}
+        self._grow()
+
+
+def _rounds(rows: np.ndarray, timestamps: np.ndarray) -> list:
+    """
+    split observations so that each state row appears at most once per round
+
+    rounds are in time order: round r holds the r-th observation of every row.
+    """
+    order = np.lexsort((timestamps, rows))
+    sorted_rows = rows[order]
+    starts = _boundaries(sorted_rows)
+    rank = np.arange(len(rows)) - np.repeat(starts, np.diff(np.append(starts, len(rows))))
+
+    return [order[rank == r] for r in range(int(rank.max()) + 1)] if len(rows) else []
+
+
+class AnomalyDetector:
+    """
+    streaming rtt anomaly detector, fed with batches of store columns
+
+    baselines are kept per (vp, target, hop address) and per (vp, target)
+    as exponentially decayed robust estimates (Huber-clipped EWMA of the
+    location, EWMA of the absolute deviation), a few floats per key whatever
+    the length of the stream. Each batch is processed with array operations;
+    the only per-key python work is the dictionary lookup of its row.
+
+    three kinds of alerts are raised:
+    - inflation: the min rtt to a hop address exceeds its baseline by more
+      than threshold deviations (and min_shift ms), on an unchanged key
+    - loss_burst: burst_length consecutive traceroutes of a pair with a
+      loss rate loss_excess above its usual level
+    - path_jump: the path of a pair changed and its end to end rtt moved by
+      more than threshold deviations (and min_shift ms); the end to end
+      baseline then restarts from the new path
+    """
+
+    def __init__(
+        self,
+        alpha: float = 0.05,
+        threshold: float = 4.0,
+        min_shift: float = 10.0,
+        min_scale: float = 1.0,
+        warmup: int = 5,
+        loss_excess: float = 0.3,
+        burst_length: int = 2,
+    ) -> None:
+        self.alpha = alpha
+        self.threshold = threshold
+        self.min_shift = min_shift
+        self.min_scale = min_scale
+        self.warmup = warmup
+        self.loss_excess = loss_excess
+        self.burst_length = burst_length
+
+        baseline = {
+            "location": (np.float64, np.nan),
+            "scale": (np.float64, 0.0),
+            "count": (np.int64, 0),
+        }
+        self.pairs = _StateTable(
+            {
+                **baseline,
+                "path": (np.uint64, 0),
+                "traceroutes": (np.int64, 0),
+                "loss": (np.float64, 0.0),
+                "lossy_run": (np.int64, 0),
+            }
+        )
+        self.hops = _StateTable(baseline)
+
+    def _pair_rows(self, prb_id: np.ndarray, dst: np.ndarray) -> np.ndarray:
+        return self.pairs.lookup((prb_id.astype(np.int64) << 32) | dst.astype(np.int64))
+
+    def _update(self, table: _StateTable, rows: np.ndarray, values: np.ndarray) -> tuple:
+        """
+        fold one value per row into the baselines
+
+        returns the baseline and scale before the update and whether the
+        value is an upward outlier of an established baseline.
+        """
+        location = table.arrays["location"][rows]
+        scale = table.arrays["scale"][rows]
+        count = table.arrays["count"][rows]
+
+        first = count == 0
+        floor = np.maximum(scale, self.min_scale)
+        deviation = np.where(first, 0.0, values - location)
+        outlier = (
+            (count >= self.warmup)
+            & (deviation > self.threshold * floor)
+            & (deviation > self.min_shift)
+        )
+
+        clipped = np.clip(deviation, -2 * floor, 2 * floor)
+        table.arrays["location"][rows] = np.where(first, values, location + self.alpha * clipped)
+        table.arrays["scale"][rows] = np.where(
+            first, 0.0, scale + self.alpha * (np.abs(clipped) - scale)
+        )
+        table.arrays["count"][rows] = count + 1
+
+        return location, floor, outlier
+
+    def _traceroutes(self, columns: dict) -> dict:
+        """per traceroute: pair row, loss rate, path hash and end to end rtt"""
+        msm_id, prb_id, timestamp = columns["msm_id"], columns["prb_id"], columns["timestamp"]
+        starts = _boundaries(msm_id, prb_id, timestamp)
+        nb_rows = np.diff(np.append(starts, len(msm_id)))
+
+        timeout = columns["timeout"]
+        loss = np.add.reduceat(timeout.astype(np.int64), starts) / nb_rows
+
+        # first responding reply of each hop
+        traceroute = np.repeat(np.arange(len(starts)), nb_rows)
+        responding = np.flatnonzero((columns["from"] != 0) & ~timeout)
+        first = responding[_boundaries(traceroute[responding], columns["hop"][responding])]
+        multipliers = _HOP_MULTIPLIERS[columns["hop"][first].astype(np.int64) % 256]
+        with np.errstate(over="ignore"):
+            weights = (columns["from"][first].astype(np.uint64) + np.uint64(1)) * multipliers
+        path = np.zeros(len(starts), dtype=np.uint64)
+        np.add.at(path, traceroute[first], weights)
+
+        # rtt of the last responding hop
+        last_rtt = np.full(len(starts), np.nan)
+        replied = responding[~np.isnan(columns["rtt"][responding])]
+        ordering = np.lexsort(
+            (columns["rtt"][replied], -columns["hop"][replied], traceroute[replied])
+        )
+        by_traceroute = traceroute[replied][ordering]
+        last = _boundaries(by_traceroute)
+        last_rtt[by_traceroute[last]] = columns["rtt"][replied][ordering][last]
+
+        return {
+            "msm_id": msm_id[starts],
+            "prb_id": prb_id[starts],
+            "dst": columns["dst"][starts],
+            "timestamp": timestamp[starts],
+            "loss": loss,
+            "path": path,
+            "rtt": last_rtt,
+        }
+
+    def _hop_observations(self, columns: dict) -> dict:
+        """min rtt per (traceroute, hop, address) of the replying hops"""
+        replied = (columns["from"] != 0) & ~columns["timeout"] & ~np.isnan(columns["rtt"])
+        selected = {
+            name: columns[name][replied]
+            for name in ("msm_id", "prb_id", "timestamp", "dst", "hop", "from", "rtt")
+        }
+
+        order = np.lexsort(
+            (
+                selected["rtt"],
+                selected["from"],
+                selected["hop"],
+                selected["timestamp"],
+                selected["prb_id"],
+                selected["msm_id"],
+            )
+        )
+        selected = {name: values[order] for name, values in selected.items()}
+        starts = _boundaries(
+            *(selected[name] for name in ("msm_id", "prb_id", "timestamp", "hop", "from"))
+        )
+
+        return {name: values[starts] for name, values in selected.items()}
+
+    def process(self, columns: dict) -> list:
+        """fold a batch of flattened traceroutes into the baselines, return alerts"""
+        if not len(columns["msm_id"]):
+            return []
+
+        alerts = []
+
+        # 1. per pair: loss bursts and path induced jumps
+        traceroutes = self._traceroutes(columns)
+        pair_rows = self._pair_rows(traceroutes["prb_id"], traceroutes["dst"])
+        for selection in _rounds(pair_rows, traceroutes["timestamp"]):
+            alerts.extend(
+                self._pair_round(
+                    pair_rows[selection],
+                    {name: values[selection] for name, values in traceroutes.items()},
+                )
+            )
+
+        # 2. per hop address: latency inflation
+        observations = self._hop_observations(columns)
+        hop_rows = self.hops.lookup(
+            (self._pair_rows(observations["prb_id"], observations["dst"]) << 32)
+            | observations["from"].astype(np.int64)
+        )
+        for selection in _rounds(hop_rows, observations["timestamp"]):
+            rtt = observations["rtt"][selection].astype(np.float64)
+            baseline, scale, outlier = self._update(self.hops, hop_rows[selection], rtt)
+            for index in np.flatnonzero(outlier):
+                row = selection[index]
+                alerts.append(
+                    {
+                        "type": "inflation",
+                        "msm_id": int(observations["msm_id"][row]),
+                        "prb_id": int(observations["prb_id"][row]),
+                        "dst": int_to_ip(observations["dst"][row]),
+                        "timestamp": int(observations["timestamp"][row]),
+                        "hop": int(observations["hop"][row]),
+                        "address": int_to_ip(observations["from"][row]),
+                        "rtt": float(rtt[index]),
+                        "baseline": float(baseline[index]),
+                        "scale": float(scale[index]),
+                    }
+                )
+
+        return alerts
+
+    def _pair_round(self, rows: np.ndarray, traceroutes: dict) -> list:
+        alerts = []
+
+        def alert(kind: str, index: int, **fields) -> dict:
+            return {
+                "type": kind,
+                "msm_id": int(traceroutes["msm_id"][index]),
+                "prb_id": int(traceroutes["prb_id"][index]),
+                "dst": int_to_ip(traceroutes["dst"][index]),
+                "timestamp": int(traceroutes["timestamp"][index]),
+                **fields,
+            }
+
+        # 1. loss bursts, against the decayed loss rate of the pair
+        pairs = self.pairs.arrays
+        usual_loss = pairs["loss"][rows]
+        seen = pairs["traceroutes"][rows] > 0
+        pairs["traceroutes"][rows] += 1
+        lossy = seen & (traceroutes["loss"] - usual_loss > self.loss_excess)
+        lossy_run = np.where(lossy, pairs["lossy_run"][rows] + 1, 0)
+        pairs["lossy_run"][rows] = lossy_run
+        pairs["loss"][rows] = np.where(
+            seen, usual_loss + self.alpha * (traceroutes["loss"] - usual_loss), traceroutes["loss"]
+        )
+        for index in np.flatnonzero(lossy_run == self.burst_length):
+            alerts.append(
+                alert(
+                    "loss_burst",
+                    index,
+                    loss=float(traceroutes["loss"][index]),
+                    usual_loss=float(usual_loss[index]),
+                )
+            )
+
+        # 2. end to end rtt, restarting the baseline when the path changes;
+        # lossy traceroutes stop early, their path and rtt are left out
+        has_rtt = ~np.isnan(traceroutes["rtt"]) & ~lossy
+        rows, rtt, path = rows[has_rtt], traceroutes["rtt"][has_rtt], traceroutes["path"][has_rtt]
+        indices = np.flatnonzero(has_rtt)
+
+        location = pairs["location"][rows]
+        floor = np.maximum(pairs["scale"][rows], self.min_scale)
+        established = pairs["count"][rows] >= self.warmup
+        path_changed = (pairs["count"][rows] > 0) & (pairs["path"][rows] != path)
+        shift = rtt - location
+        jump = (
+            path_changed
+            & established
+            & (np.abs(shift) > self.threshold * floor)
+            & (np.abs(shift) > self.min_shift)
+        )
+        for index in np.flatnonzero(jump):
+            alerts.append(
+                alert(
+                    "path_jump",
+                    indices[index],
+                    rtt=float(rtt[index]),
+                    baseline=float(location[index]),
+                    shift=float(shift[index]),
+                )
+            )
+
+        pairs["count"][rows[path_changed]] = 0
+        pairs["path"][rows] = path
+        self._update(self.pairs, rows, rtt)
+
+        return alerts
+
+    def process_results(self, results: Iterable[dict]) -> list:
+        """process raw traceroute results, as yielded by the collector"""
+        return self.process(flatten_traceroutes(results))
+
+    def save(self, path: Path) -> None:
+        """persist the baselines, so that detection resumes where it stopped"""
+        arrays = {}
+        for name, table in (("pairs", self.pairs), ("hops", self.hops)):
+            arrays.update({f"{name}.{field}": values for field, values in table.state().items()})
+        with Path(path).open("wb") as file:
+            np.savez(file, **arrays)
+
+    def load(self, path: Path) -> None:
+        with np.load(path) as arrays:
+            for name, table in (("pairs", self.pairs), ("hops", self.hops)):
+                prefix = f"{name}."
+                table.restore(
+                    {
+                        key[len(prefix) :]: arrays[key]
+                        for key in arrays.files
+                        if key.startswith(prefix)
+                    }
+                )
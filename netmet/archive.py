@@ -0,0 +1,380 @@
+"""
+compressed archive of probe list snapshots over time
+
+every probe field value (tag lists, ASNs, prefixes, descriptions...) is
+dictionary encoded: it is stored once per chain and probes refer to it by
+index, so the identical tag arrays repeated by thousands of probes cost a
+few bytes each. A chain starts with a keyframe holding a full snapshot;
+the following snapshots only store the cells that changed since the
+previous one, as delta encoded (probe id, value id) arrays. Frames are
+compressed with zstd when zstandard is installed, lzma otherwise.
+
+    archive = ProbeArchive(Path("datasets/archive/ua_vps"))
+    archive.add(probes)                      # today's probe list
+    probes = archive.at(1696204800)          # the list as it was then
+"""
+import bisect
+import json
+import lzma
+import os
+import time
+
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:  # optional, archives are then written with lzma
+    zstandard = None
+
+from common.logger_config import logger
+
+from netmet.metrics import metrics
+
+
+# value id of a field the probe does not have
+MISSING = -1
+
+# stands for MISSING while records are assembled
+_ABSENT = object()
+
+
+def _zstd_compress(data: bytes) -> bytes:
+    return zstandard.ZstdCompressor(level=19).compress(data)
+
+
+def _zstd_decompress(data: bytes) -> bytes:
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+# file suffix -> (compress, decompress)
+CODECS = {
+    "zst": (_zstd_compress, _zstd_decompress),
+    "xz": (lambda data: lzma.compress(data, preset=6), lzma.decompress),
+}
+
+
+def _pack(header: dict, arrays: list) -> bytes:
+    """a JSON header line followed by the raw int64 arrays it describes"""
+    header = {**header, "arrays": [len(array) for array in arrays]}
+    return b"".join(
+        [json.dumps(header, separators=(",", ":")).encode(), b"\n"]
+        + [np.ascontiguousarray(array, dtype="<i8").tobytes() for array in arrays]
+    )
+
+
+def _unpack(data: bytes) -> tuple:
+    end = data.index(b"\n")
+    header = json.loads(data[:end])
+
+    arrays = []
+    offset = end + 1
+    for length in header["arrays"]:
+        arrays.append(np.frombuffer(data, dtype="<i8", count=length, offset=offset))
+        offset += 8 * length
+
+    return header, arrays
+
+
+def _key(value):
+    """hashable key of a value, telling 1, 1.0 and True apart"""
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, separators=(",", ":"))
+    return (type(value), value)
+
+
+def _records(probes: Union[list, dict]) -> list:
+    # probe lists may also come as a raw API page
+    if isinstance(probes, dict):
+        return probes.get("results", [])
+    return list(probes)
+
+
+class _Chain:
+    """
+    a snapshot decoded from its keyframe and deltas
+
+    ids is the sorted array of probe ids, rows holds one value id per probe
+    and per field (MISSING when the probe lacks the field).
+    """
+
+    def __init__(self) -> None:
+        self.fields = []
+        self.values = []
+        self.ids = np.empty(0, dtype=np.int64)
+        self.rows = np.empty((0, 0), dtype=np.int64)
+        # only needed to encode new snapshots, built on first use
+        self._value_ids = None
+
+    @property
+    def value_ids(self) -> dict:
+        if self._value_ids is None:
+            self._value_ids = {_key(value): value_id for value_id, value in enumerate(self.values)}
+        return self._value_ids
+
+    def _add_values(self, values: list) -> None:
+        if self._value_ids is not None:
+            for value in values:
+                self._value_ids[_key(value)] = len(self.values)
+                self.values.append(value)
+        else:
+            self.values.extend(values)
+
+    def _add_fields(self, fields: list) -> None:
+        self.fields.extend(fields)
+        missing = np.full((len(self.ids), len(fields)), MISSING, dtype=np.int64)
+        self.rows = np.hstack([self.rows, missing])
+
+    def encode(self, records: list) -> tuple:
+        """
+        (ids, rows) of a probe list, sorted by probe id
+
+        fields and values not seen yet are appended to the chain; returns
+        also the number of fields and values it had before.
+        """
+        nb_fields = len(self.fields)
+        nb_values = len(self.values)
+
+        field_index = {field: index for index, field in enumerate(self.fields)}
+        for record in records:
+            for field in record:
+                if field not in field_index:
+                    field_index[field] = len(field_index)
+        self._add_fields(list(field_index)[nb_fields:])
+
+        value_ids = self.value_ids
+        new_values = []
+        rows = np.full((len(records), len(self.fields)), MISSING, dtype=np.int64)
+        for position, record in enumerate(records):
+            row = rows[position]
+            for field, value in record.items():
+                key = _key(value)
+                value_id = value_ids.get(key)
+                if value_id is None:
+                    value_id = value_ids[key] = nb_values + len(new_values)
+                    new_values.append(value)
+                row[field_index[field]] = value_id
+        self.values.extend(new_values)
+
+        ids = np.fromiter((record["id"] for record in records), dtype=np.int64, count=len(records))
+        order = np.argsort(ids, kind="stable")
+
+        return ids[order], rows[order], nb_fields, nb_values
+
+    def diff(self, ids: np.ndarray, rows: np.ndarray) -> tuple:
+        """removed ids, added ids and per field (probe ids, value ids) of the changed cells"""
+        removed = np.setdiff1d(self.ids, ids, assume_unique=True)
+        added = np.setdiff1d(ids, self.ids, assume_unique=True)
+
+        # previous value of every cell of the new snapshot, MISSING for new probes
+        previous = np.full_like(rows, MISSING)
+        _, new_index, old_index = np.intersect1d(
+            ids, self.ids, assume_unique=True, return_indices=True
+        )
+        previous[new_index] = self.rows[old_index]
+
+        changed = rows != previous
+        changes = [
+            (field_index, ids[changed[:, field_index]], rows[changed[:, field_index], field_index])
+            for field_index in np.flatnonzero(changed.any(axis=0)).tolist()
+        ]
+
+        return removed, added, changes
+
+    def apply(self, header: dict, arrays: list) -> None:
+        """apply a keyframe or a delta frame"""
+        self._add_values(header["values"])
+        self._add_fields(header["fields"])
+
+        arrays = iter(arrays)
+        removed = np.cumsum(next(arrays))
+        added = np.cumsum(next(arrays))
+        if len(removed):
+            keep = ~np.isin(self.ids, removed, assume_unique=True)
+            self.ids, self.rows = self.ids[keep], self.rows[keep]
+        if len(added):
+            ids = np.concatenate([self.ids, added])
+            rows = np.vstack(
+                [self.rows, np.full((len(added), len(self.fields)), MISSING, dtype=np.int64)]
+            )
+            order = np.argsort(ids, kind="stable")
+            self.ids, self.rows = ids[order], rows[order]
+
+        for field_index in header["changes"]:
+            probe_ids = np.cumsum(next(arrays))
+            value_ids = np.cumsum(next(arrays))
+            self.rows[np.searchsorted(self.ids, probe_ids), field_index] = value_ids
+
+    def records(self) -> list:
+        """decoded probe records, by probe id; nested values are shared between records"""
+        # the extra last entry is what MISSING (-1) indexes
+        table = np.fromiter(
+            [*self.values, _ABSENT], dtype=object, count=len(self.values) + 1
+        )
+        columns = [table[self.rows[:, field_index]] for field_index in range(len(self.fields))]
+        records = [dict(zip(self.fields, row)) for row in zip(*columns)]
+
+        for position in np.flatnonzero((self.rows == MISSING).any(axis=1)).tolist():
+            record = records[position]
+            for field in [field for field, value in record.items() if value is _ABSENT]:
+                del record[field]
+
+        return records
+
+
+class ProbeArchive:
+    """
+    append-only archive of dated probe snapshots in a directory
+
+    index.json lists the snapshots in time order with their frame file;
+    reading a snapshot decodes its chain from the keyframe, which bounds the
+    work by keyframe_interval whatever the age of the archive.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        keyframe_interval: int = 30,
+        codec: Optional[str] = None,
+    ) -> None:
+        self.root = Path(root)
+        self.keyframe_interval = keyframe_interval
+        self.codec = codec or ("zst" if zstandard is not None else "xz")
+        if self.codec == "zst" and zstandard is None:
+            raise RuntimeError("the zst codec needs the zstandard package")
+
+        self._index_path = self.root / "index.json"
+        self.snapshots = (
+            json.loads(self._index_path.read_text()) if self._index_path.exists() else []
+        )
+        # last decoded snapshot, (position, chain)
+        self._cached = None
+
+    def _save_index(self) -> None:
+        tmp_path = self._index_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.snapshots))
+        os.replace(tmp_path, self._index_path)
+
+    def timestamps(self) -> list:
+        return [snapshot["timestamp"] for snapshot in self.snapshots]
+
+    def _read_frame(self, snapshot: dict) -> tuple:
+        path = self.root / snapshot["file"]
+        codec = path.suffix.lstrip(".")
+        if codec == "zst" and zstandard is None:
+            raise RuntimeError(f"{path} is zstd compressed, install zstandard to read it")
+        _, decompress = CODECS[codec]
+
+        return _unpack(decompress(path.read_bytes()))
+
+    def _write_frame(self, name: str, data: bytes) -> tuple:
+        compress, _ = CODECS[self.codec]
+        data = compress(data)
+        file_name = f"{name}.{self.codec}"
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.root / f"{file_name}.tmp"
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, self.root / file_name)
+
+        return file_name, len(data)
+
+    def _keyframe(self, position: int) -> int:
+        while not self.snapshots[position]["keyframe"]:
+            position -= 1
+        return position
+
+    def _chain(self, position: int) -> _Chain:
+        """decode the snapshot at position, going on from the cached one when possible"""
+        keyframe = self._keyframe(position)
+        chain, start = _Chain(), keyframe
+        if self._cached is not None:
+            cached_position, cached_chain = self._cached
+            if keyframe <= cached_position <= position:
+                chain, start = cached_chain, cached_position + 1
+
+        for snapshot in self.snapshots[start : position + 1]:
+            chain.apply(*self._read_frame(snapshot))
+        self._cached = (position, chain)
+
+        return chain
+
+    def add(self, probes: Union[list, dict], timestamp: Optional[int] = None) -> None:
+        """
+        archive a probe list (or a raw API page) as the snapshot of timestamp
+
+        timestamps must increase; by default the snapshot is dated now, or
+        just after the previous one when that is later.
+        """
+        if timestamp is None:
+            latest = self.snapshots[-1]["timestamp"] if self.snapshots else 0
+            timestamp = max(int(time.time()), latest + 1)
+        timestamp = int(timestamp)
+        if self.snapshots and timestamp <= self.snapshots[-1]["timestamp"]:
+            raise ValueError(
+                f"snapshot at {timestamp} is not newer than {self.snapshots[-1]['timestamp']}"
+            )
+
+        records = _records(probes)
+        keyframe = (
+            not self.snapshots
+            or len(self.snapshots) - self._keyframe(len(self.snapshots) - 1)
+            >= self.keyframe_interval
+        )
+        chain = _Chain() if keyframe else self._chain(len(self.snapshots) - 1)
+        # encoding extends the chain in place: it is cached again once written
+        self._cached = None
+
+        ids, rows, nb_fields, nb_values = chain.encode(records)
+        removed, added, changes = chain.diff(ids, rows)
+
+        # sorted ids and freshly appended value ids delta encode to small numbers
+        arrays = [np.diff(removed, prepend=0), np.diff(added, prepend=0)]
+        for _, probe_ids, value_ids in changes:
+            arrays.extend([np.diff(probe_ids, prepend=0), np.diff(value_ids, prepend=0)])
+        header = {
+            "fields": chain.fields[nb_fields:],
+            "values": chain.values[nb_values:],
+            "changes": [field_index for field_index, _, _ in changes],
+        }
+        file_name, nb_bytes = self._write_frame(f"{timestamp}", _pack(header, arrays))
+
+        self.snapshots.append({"timestamp": timestamp, "file": file_name, "keyframe": keyframe})
+        self._save_index()
+
+        chain.ids, chain.rows = ids, rows
+        self._cached = (len(self.snapshots) - 1, chain)
+
+        metrics.inc("archive_bytes_written", nb_bytes)
+        nb_changed = sum(len(probe_ids) for _, probe_ids, _ in changes)
+        logger.info(
+            f"archived {len(records)} probes at {timestamp} "
+            f"({'keyframe' if keyframe else f'{nb_changed} changed cells'}, {nb_bytes} bytes)"
+        )
+
+    def at(self, timestamp: Optional[int] = None) -> list:
+        """
+        the probe list as of timestamp: the newest snapshot taken at or
+        before it (the latest snapshot when timestamp is None)
+
+        records are sorted by probe id; their nested values (tags, geometry,
+        status) are shared between records and must not be modified.
+        """
+        if timestamp is None:
+            position = len(self.snapshots) - 1
+        else:
+            position = bisect.bisect_right(self.timestamps(), timestamp) - 1
+        if position < 0:
+            raise KeyError(f"no probe snapshot at or before {timestamp}")
+
+        return self._chain(position).records()
+
+    def __len__(self) -> int:
+        return len(self.snapshots)
+
+    def __iter__(self) -> Iterator[tuple]:
+        """(timestamp, probes) of every snapshot, oldest first"""
+        for position, snapshot in enumerate(self.snapshots):
+            yield snapshot["timestamp"], self._chain(position).records()
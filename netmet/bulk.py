@@ -0,0 +1,263 @@
+"""
+bulk import of RIPE Atlas result dumps into a traceroute store
+
+the daily archives hold one NDJSON result per line, compressed with bz2 or
+gzip. Dumps are cut into chunks (a compressed file is one chunk, a plain
+file is split along byte ranges) that a process pool decodes in parallel.
+Lines are first screened on their raw prb_id and dst_addr, so only the
+traceroutes of the requested vps and targets pay for json.loads.
+"""
+import bz2
+import gzip
+import json
+import os
+import re
+import tempfile
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+
+from common.logger_config import logger
+
+from netmet.metrics import metrics
+from netmet.registry import ProbeRegistry
+from netmet.store import TracerouteStore, flatten_traceroutes
+
+
+CHUNK_SIZE = 256 * 1024**2
+BATCH_SIZE = 20000
+
+_PRB_ID = re.compile(rb'"prb_id":\s*(\d+)')
+_DST_ADDR = re.compile(rb'"dst_addr":\s*"([^"]*)"')
+
+
+def _open(path: Path):
+    if path.suffix == ".bz2":
+        return bz2.open(path, "rb")
+    if path.suffix == ".gz":
+        return gzip.open(path, "rb")
+    return path.open("rb")
+
+
+def _is_compressed(path: Path) -> bool:
+    return path.suffix in (".bz2", ".gz")
+
+
+def dump_chunks(paths: Iterable[Path], chunk_size: int = CHUNK_SIZE) -> list:
+    """(path, start, end) byte ranges to decode, end is None for a whole file"""
+    chunks = []
+    for path in paths:
+        path = Path(path)
+        size = path.stat().st_size
+        if _is_compressed(path) or size <= chunk_size:
+            chunks.append((path, 0, None))
+            continue
+        for start in range(0, size, chunk_size):
+            chunks.append((path, start, min(start + chunk_size, size)))
+
+    return chunks
+
+
+def _iter_lines(path: Path, start: int, end: Optional[int]) -> Iterator[bytes]:
+    """lines starting within [start, end), the whole file when end is None"""
+    with _open(path) as file:
+        if end is None:
+            yield from file
+            return
+
+        # the line running over start belongs to the previous chunk
+        position = start
+        if start:
+            file.seek(start - 1)
+            position += len(file.readline()) - 1
+        while position < end:
+            line = file.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+
+def _matches(line: bytes, vp_ids: Optional[frozenset], target_addrs: Optional[frozenset]) -> bool:
+    if vp_ids is not None:
+        match = _PRB_ID.search(line)
+        if match is None or int(match.group(1)) not in vp_ids:
+            return False
+    if target_addrs is not None:
+        match = _DST_ADDR.search(line)
+        if match is None or match.group(1).decode() not in target_addrs:
+            return False
+    return True
+
+
+def _import_chunk(job: tuple) -> tuple:
+    """
+    decode one chunk in a worker, return (path, nb_lines, nb_traceroutes, batch files)
+
+    matching traceroutes are flattened in batches written to the staging
+    directory, which the parent appends to the store: a worker never holds
+    more than batch_size traceroutes whatever the size of the dump.
+    """
+    path, start, end, vp_ids, target_addrs, staging_dir, batch_size = job
+
+    batch_paths = []
+    batch = []
+
+    def flush() -> None:
+        columns = flatten_traceroutes(batch)
+        batch_path = Path(staging_dir) / f"{path.name}.{start}.{len(batch_paths)}.npz"
+        np.savez(batch_path, **columns)
+        batch_paths.append(batch_path)
+        batch.clear()
+
+    nb_lines = 0
+    nb_traceroutes = 0
+    for line in _iter_lines(path, start, end):
+        nb_lines += 1
+        if not _matches(line, vp_ids, target_addrs):
+            continue
+        try:
+            result = json.loads(line)
+        except ValueError:
+            continue
+        if result.get("type") != "traceroute":
+            continue
+
+        batch.append(result)
+        nb_traceroutes += 1
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+
+    return path, nb_lines, nb_traceroutes, batch_paths
+
+
+class BulkImporter:
+    """
+    import result dumps into a store, optionally keeping only some vps and targets
+
+    vps selects traceroutes by source probe, targets by destination address
+    (the address_v4 of each target probe). With a state file, the dumps
+    already imported are recorded and skipped on the next run, so that a
+    month of archives can be backfilled over several runs. The chunks of a
+    dump are staged until all of them are decoded, so a dump with an
+    unreadable chunk adds no rows to the store and is retried whole.
+    """
+
+    def __init__(
+        self,
+        store: TracerouteStore,
+        vps: Optional[ProbeRegistry] = None,
+        targets: Optional[ProbeRegistry] = None,
+        state_path: Optional[Path] = None,
+        workers: Optional[int] = None,
+        chunk_size: int = CHUNK_SIZE,
+        batch_size: int = BATCH_SIZE,
+    ) -> None:
+        self.store = store
+        self.vp_ids = frozenset(probe.id for probe in vps) if vps is not None else None
+        self.target_addrs = (
+            frozenset(probe.address_v4 for probe in targets if probe.address_v4)
+            if targets is not None
+            else None
+        )
+        self.state_path = Path(state_path) if state_path else None
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+
+        self.imported = (
+            json.loads(self.state_path.read_text())
+            if self.state_path and self.state_path.exists()
+            else {}
+        )
+
+    def _save(self) -> None:
+        tmp_path = self.state_path.with_name(f"{self.state_path.name}.tmp")
+        tmp_path.write_text(json.dumps(self.imported))
+        os.replace(tmp_path, self.state_path)
+
+    def _signature(self, path: Path) -> list:
+        stat = path.stat()
+        return [stat.st_size, int(stat.st_mtime)]
+
+    def run(self, paths: Iterable[Path]) -> int:
+        """import the dumps not imported yet, return the number of traceroutes added"""
+        paths = [
+            Path(path)
+            for path in paths
+            if self.imported.get(str(Path(path).resolve())) != self._signature(Path(path))
+        ]
+        chunks = dump_chunks(paths, self.chunk_size)
+        remaining = {}
+        for path, _, _ in chunks:
+            remaining[path] = remaining.get(path, 0) + 1
+        logger.info(f"importing {len(paths)} dumps in {len(chunks)} chunks")
+
+        # batch files of each dump, appended once all its chunks are decoded
+        staged = {path: [] for path in remaining}
+        failed = set()
+        nb_staged = dict.fromkeys(remaining, 0)
+
+        nb_imported = 0
+        with tempfile.TemporaryDirectory(dir=self.store.root) as staging_dir:
+            jobs = [
+                (
+                    path,
+                    start,
+                    end,
+                    self.vp_ids,
+                    self.target_addrs,
+                    staging_dir,
+                    self.batch_size,
+                )
+                for path, start, end in chunks
+            ]
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                futures = {executor.submit(_import_chunk, job): job[0] for job in jobs}
+                # the store has a single writer: batches are appended here
+                for future in as_completed(futures):
+                    path = futures[future]
+                    try:
+                        _, nb_lines, nb_traceroutes, batch_paths = future.result()
+                    except (OSError, EOFError, zlib.error) as error:
+                        # a truncated or corrupt dump: the others still get imported
+                        logger.error(f"dump chunk of {path} could not be read: {error}")
+                        failed.add(path)
+                    else:
+                        staged[path].extend(batch_paths)
+                        nb_staged[path] += nb_traceroutes
+                        metrics.inc("bulk_lines_read", nb_lines)
+
+                    remaining[path] -= 1
+                    if remaining[path]:
+                        continue
+
+                    if path in failed:
+                        for batch_path in staged.pop(path):
+                            batch_path.unlink()
+                        logger.error(f"{path} not imported")
+                        continue
+
+                    for batch_path in staged.pop(path):
+                        with np.load(batch_path) as batch:
+                            self.store.append_columns({name: batch[name] for name in batch.files})
+                        batch_path.unlink()
+
+                    nb_imported += nb_staged[path]
+                    metrics.inc("bulk_traceroutes_imported", nb_staged[path])
+
+                    logger.info(f"{path} imported")
+                    if self.state_path:
+                        self.imported[str(path.resolve())] = self._signature(path)
+                        self._save()
+
+        logger.info(f"{nb_imported} traceroutes imported")
+
+        return nb_imported
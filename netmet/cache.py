@@ -0,0 +1,178 @@
+"""persistent on-disk cache for RIPE Atlas GET requests"""
+import hashlib
+import json
+import os
+import time
+
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+from common.logger_config import logger
+
+from netmet.client import AtlasClient, get_client
+
+
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "netmet"
+DEFAULT_MAX_BYTES = 2 * 1024**3
+
+# time to live in seconds, per kind of endpoint
+IMMUTABLE = float("inf")
+TTL_PROBES = 3600.0
+TTL_RUNNING_MEASUREMENT = 60.0
+
+# stopped, forced to stop, no suitable probes, failed
+FINAL_STATUSES = {4, 5, 6, 7}
+
+
+def measurement_ttl(description: dict) -> float:
+    """stopped one-off measurements never change, running ones do"""
+    if description.get("status", {}).get("id") in FINAL_STATUSES:
+        return IMMUTABLE
+    return TTL_RUNNING_MEASUREMENT
+
+
+class HttpCache:
+    """
+    content-addressed cache of JSON responses, keyed by url and params
+
+    each entry is a body file plus a small metadata file holding the
+    ETag / Last-Modified validators and the expiry date. Stale entries are
+    revalidated with a conditional request, and the least recently used
+    entries are evicted once the cache grows over max_bytes.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path = DEFAULT_CACHE_DIR,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        client: Optional[AtlasClient] = None,
+    ) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.client = client or get_client()
+
+        # running estimate of the cache size, computed on first write
+        self._size = None
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(url: str, params: Optional[dict] = None) -> str:
+        canonical = json.dumps([url, sorted((params or {}).items())], default=str)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def _paths(self, key: str) -> tuple:
+        return self.cache_dir / f"{key}.json", self.cache_dir / f"{key}.meta"
+
+    @staticmethod
+    def _write(path: Path, data: bytes) -> None:
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+    def _store(self, key: str, body: bytes, meta: dict) -> None:
+        body_path, meta_path = self._paths(key)
+        self._write(body_path, body)
+        self._write(meta_path, json.dumps(meta).encode())
+
+        if self._size is None:
+            self.evict()
+        else:
+            self._size += len(body)
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def get_json(
+        self,
+        url: str,
+        params: Optional[dict] = None,
+        ttl: Union[float, Callable[[object], float]] = TTL_PROBES,
+    ):
+        """
+        return the JSON body of a GET request, from disk whenever possible
+
+        ttl is either a number of seconds or a function of the decoded body,
+        e.g. measurement_ttl to keep stopped measurements forever.
+        """
+        key = self.key(url, params)
+        body_path, meta_path = self._paths(key)
+
+        meta = None
+        if body_path.exists() and meta_path.exists():
+            meta = json.loads(meta_path.read_bytes())
+            if time.time() < meta["expires"]:
+                # touch the entry so eviction stays least recently used
+                os.utime(body_path)
+                return json.loads(body_path.read_bytes())
+
+        # 1. (re)validate the entry against the server
+        headers = {}
+        if meta:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        response = self.client.get(url, params=params, headers=headers)
+
+        if response.status_code == 304 and meta:
+            data = json.loads(body_path.read_bytes())
+            body = None
+        else:
+            response.raise_for_status()
+            body = response.content
+            data = json.loads(body)
+
+        # 2. compute expiry date, possibly from the body itself
+        entry_ttl = ttl(data) if callable(ttl) else ttl
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag", meta.get("etag") if meta else None),
+            "last_modified": response.headers.get(
+                "Last-Modified", meta.get("last_modified") if meta else None
+            ),
+            "expires": time.time() + entry_ttl,
+        }
+
+        if body is None:
+            self._write(meta_path, json.dumps(meta).encode())
+            os.utime(body_path)
+        else:
+            self._store(key, body, meta)
+
+        return data
+
+    def evict(self) -> None:
+        """drop least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        total_size = 0
+        for body_path in self.cache_dir.glob("*.json"):
+            stat = body_path.stat()
+            entries.append((stat.st_mtime, stat.st_size, body_path))
+            total_size += stat.st_size
+
+        self._size = total_size
+        if total_size <= self.max_bytes:
+            return
+
+        entries.sort()
+        for _, size, body_path in entries:
+            if total_size <= self.max_bytes:
+                break
+            body_path.unlink(missing_ok=True)
+            body_path.with_suffix(".meta").unlink(missing_ok=True)
+            total_size -= size
+
+        self._size = total_size
+        logger.info(f"cache evicted down to {total_size} bytes")
+
+
+_default_cache = None
+
+
+def get_cache() -> HttpCache:
+    """return the cache shared by the exo* functions"""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = HttpCache()
+    return _default_cache
@@ -0,0 +1,142 @@
+"""detect path and rtt changes between repeated measurements of the same pair"""
+import json
+import os
+
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from common.logger_config import logger
+
+from netmet.analysis import responding_hops
+from netmet.ledger import Ledger
+from netmet.store import TracerouteStore, int_to_ip
+
+
+def compare_paths(previous: dict, latest: dict, rtt_threshold: float = 10.0) -> Optional[dict]:
+    """
+    compare two traceroutes of the same key, None when nothing changed
+
+    a traceroute is {"msm_id", "timestamp", "hops": [[hop, address, rtt_min], ...]}.
+    A change is a different sequence of responding addresses, or an end to end
+    rtt (last responding hop) moving by more than rtt_threshold ms.
+    """
+    previous_path = [address for _, address, _ in previous["hops"]]
+    latest_path = [address for _, address, _ in latest["hops"]]
+
+    previous_rtt = previous["hops"][-1][2] if previous["hops"] else None
+    latest_rtt = latest["hops"][-1][2] if latest["hops"] else None
+    rtt_shift = (
+        latest_rtt - previous_rtt
+        if previous_rtt is not None and latest_rtt is not None
+        else None
+    )
+
+    path_changed = previous_path != latest_path
+    rtt_changed = rtt_shift is not None and abs(rtt_shift) > rtt_threshold
+    if not path_changed and not rtt_changed:
+        return None
+
+    return {
+        "previous_msm_id": previous["msm_id"],
+        "msm_id": latest["msm_id"],
+        "previous_timestamp": previous["timestamp"],
+        "timestamp": latest["timestamp"],
+        "path_changed": path_changed,
+        "new_hops": sorted(set(latest_path) - set(previous_path)),
+        "lost_hops": sorted(set(previous_path) - set(latest_path)),
+        "rtt_shift": rtt_shift,
+    }
+
+
+class ChangeDetector:
+    """
+    incremental diff of the newest traceroute per (vp, target, protocol, port, paris)
+
+    the state file keeps a watermark (last store segment processed) and the
+    latest traceroute seen for each key, so each run only reads the segments
+    appended since the previous one. Compacting the store renumbers its data
+    into a new segment, which is then processed once more.
+    """
+
+    def __init__(self, store: TracerouteStore, ledger: Ledger, state_path: Path) -> None:
+        self.store = store
+        self.ledger = ledger
+        self.state_path = Path(state_path)
+
+        if self.state_path.exists():
+            state = json.loads(self.state_path.read_text())
+        else:
+            state = {"watermark": -1, "latest": {}}
+        self.watermark = state["watermark"]
+        self.latest = state["latest"]
+
+    def _save(self) -> None:
+        tmp_path = self.state_path.with_name(f"{self.state_path.name}.tmp")
+        tmp_path.write_text(json.dumps({"watermark": self.watermark, "latest": self.latest}))
+        os.replace(tmp_path, self.state_path)
+
+    def run(self, rtt_threshold: float = 10.0) -> list:
+        """process the data added since the last run, return the detected changes"""
+        watermark = self.store.last_segment
+        columns = self.store.load(
+            ["msm_id", "prb_id", "timestamp", "dst", "hop", "from", "rtt", "timeout"],
+            after_segment=self.watermark,
+        )
+        hops = responding_hops(columns)
+        variants = self.ledger.variants()
+
+        # 1. group the new hops per traceroute
+        starts = np.flatnonzero(
+            np.diff(
+                np.stack([hops["msm_id"], hops["prb_id"], hops["timestamp"]]),
+                prepend=-1,
+            ).any(axis=0)
+        )
+        ends = np.append(starts[1:], len(hops["hop"]))
+
+        traceroutes = []
+        for start, end in zip(starts, ends):
+            msm_id = int(hops["msm_id"][start])
+            protocol, port, paris = variants.get(msm_id, (None, None, None))
+            parts = [hops["prb_id"][start], int_to_ip(hops["dst"][start]), protocol, port]
+            # paris variants may take different paths, they are compared separately
+            if paris is not None:
+                parts.append(paris)
+            key = "|".join(str(part) for part in parts)
+            traceroutes.append(
+                (
+                    int(hops["timestamp"][start]),
+                    key,
+                    {
+                        "msm_id": msm_id,
+                        "timestamp": int(hops["timestamp"][start]),
+                        "hops": [
+                            [int(hop), int_to_ip(address), float(rtt)]
+                            for hop, address, rtt in zip(
+                                hops["hop"][start:end],
+                                hops["address"][start:end],
+                                hops["rtt_min"][start:end],
+                            )
+                        ],
+                    },
+                )
+            )
+
+        # 2. compare each traceroute to the previous one of its key, oldest first
+        changes = []
+        for _, key, traceroute in sorted(traceroutes, key=lambda item: item[0]):
+            previous = self.latest.get(key)
+            if previous is not None and previous["timestamp"] < traceroute["timestamp"]:
+                change = compare_paths(previous, traceroute, rtt_threshold)
+                if change is not None:
+                    changes.append({"key": key, **change})
+            if previous is None or previous["timestamp"] < traceroute["timestamp"]:
+                self.latest[key] = traceroute
+
+        self.watermark = watermark
+        self._save()
+        logger.info(f"{len(traceroutes)} new traceroutes, {len(changes)} changes")
+
+        return changes
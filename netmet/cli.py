@@ -0,0 +1,448 @@
+"""
+campaign runner: fetch-probes, submit, collect and analyze
+
+usage:
+    python -m netmet fetch-probes campaign.json
+    python -m netmet submit campaign.json --workers 4
+    python -m netmet collect campaign.json
+    python -m netmet analyze campaign.json
+    python -m netmet changes campaign.json
+    python -m netmet geolocate campaign.json
+    python -m netmet sweep campaign.json
+    python -m netmet import-dumps campaign.json --workers 8
+
+add --metrics-port 9100 to serve Prometheus metrics while a stage runs,
+--metrics-snapshot metrics.json to write them as periodic JSON snapshots and
+--profile profile.txt to sample where the time goes (collapsed stacks).
+
+a campaign spec is a JSON file, e.g.:
+    {
+        "name": "ua_ru",
+        "output_dir": "results/ua_ru",
+        "vps": {"country_code": "UA", "status": 1, "is_public": true},
+        "targets": {"country_code": "RU", "status": 1, "is_public": true},
+        "protocols": ["ICMP", "UDP"],
+        "ports": [34543, 80],
+        "paris": [null, 16],
+        "packets": 3,
+        "size": 48,
+        "pairs": 100,
+        "credit_budget": 50000,
+        "max_concurrent": 100,
+        "dumps": ["archives/traceroute-2023-10-*.bz2"]
+    }
+every (protocol, port, paris) variant of a pair is submitted in the same
+packed requests; sweep then lines up the hops of the variants of each pair
+and writes the hops whose address depends on the variant (per-flow load
+balancing) to sweep.json. "paris" defaults to [null], the API default.
+"geo_table" optionally points to a CSV (prefix, latitude, longitude,
+country_code) whose locations geolocate checks against hop rtts.
+"pairs" is optional: when set, that many diverse pairs are sampled,
+otherwise every target is measured from every vp. Submission is paced
+by the admission limits (credit_budget, daily_credits, credits_per_hour,
+max_concurrent, requests_per_second): requests wait for them and, once the
+budget is spent, the remaining pairs are left for a later run.
+
+import-dumps backfills the store from local RIPE Atlas result dumps (bz2, gz
+or plain NDJSON, as in the daily archives) matching the "dumps" glob
+patterns of the spec, keeping only the traceroutes from the campaign vps to
+its targets. Dumps already imported are recorded in imported_dumps.json.
+
+fetch-probes also adds each probe list to a dated archive (archive/vps and
+archive/targets, see netmet/archive.py) so that earlier lists stay available.
+
+every stage can be interrupted and run again: the selected pairs are
+checkpointed in pairs.json, submit skips the pairs already in the campaign
+ledger and collect the measurements already in the store. While collecting,
+rtt inflation, loss bursts and path induced rtt jumps are appended to
+anomalies.jsonl as results arrive.
+"""
+import argparse
+import json
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from pathlib import Path
+
+from common.file_utils import dump_json, load_json
+from common.logger_config import logger
+
+from netmet.metrics import SamplingProfiler, serve_metrics, write_snapshots
+
+# each command imports what it needs when it runs: analyze and changes never
+# load the HTTP stack or the credentials, submit never numpy
+
+
+DEFAULT_SPEC = {
+    "protocols": ["ICMP"],
+    "ports": [34543],
+    "paris": [None],
+    "measurement_type": "traceroute",
+    "packets": 3,
+    "size": 48,
+    "pairs": None,
+    # admission control, see netmet/admission.py; "credit_budget" may be
+    # "account" to spend at most the current balance of the account
+    "credit_budget": None,
+    "daily_credits": None,
+    "credits_per_hour": None,
+    "max_concurrent": 100,
+    "requests_per_second": 1.0,
+}
+
+
+class Campaign:
+    """paths and parameters of one campaign, read from its spec file"""
+
+    def __init__(self, spec_path: Path) -> None:
+        with Path(spec_path).open() as file:
+            self.spec = {**DEFAULT_SPEC, **json.load(file)}
+
+        self.name = self.spec.get("name", Path(spec_path).stem)
+        self.output_dir = Path(self.spec.get("output_dir", f"results/{self.name}"))
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+        self.vps_path = self.output_dir / "vps.json"
+        self.targets_path = self.output_dir / "targets.json"
+        self.vps_archive_path = self.output_dir / "archive" / "vps"
+        self.targets_archive_path = self.output_dir / "archive" / "targets"
+        self.pairs_path = self.output_dir / "pairs.json"
+        self.ledger_path = self.output_dir / "ledger.jsonl"
+        self.store_path = self.output_dir / "store"
+        self.summary_path = self.output_dir / "summary.json"
+        self.changes_path = self.output_dir / "changes.jsonl"
+        self.changes_state_path = self.output_dir / "changes_state.json"
+        self.anomalies_path = self.output_dir / "anomalies.jsonl"
+        self.anomaly_state_path = self.output_dir / "anomaly_state.npz"
+        self.infeasible_path = self.output_dir / "infeasible_hops.jsonl"
+        self.hop_sites_path = self.output_dir / "hop_sites.json"
+        self.sweep_path = self.output_dir / "sweep.json"
+        self.imported_dumps_path = self.output_dir / "imported_dumps.json"
+
+    def variants(self) -> list:
+        return list(product(self.spec["protocols"], self.spec["ports"], self.spec["paris"]))
+
+
+def fetch_probes(campaign: Campaign, args: argparse.Namespace) -> None:
+    from netmet.archive import ProbeArchive
+    from netmet.probes import get_all_probes
+
+    for params, path, archive_path in (
+        (campaign.spec["vps"], campaign.vps_path, campaign.vps_archive_path),
+        (campaign.spec["targets"], campaign.targets_path, campaign.targets_archive_path),
+    ):
+        probes = get_all_probes(params)
+        logger.info(f"{len(probes)} probes for {params} -> {path}")
+        dump_json(probes, path)
+        ProbeArchive(archive_path).add(probes)
+
+
+def _submit_shard(job: tuple) -> int:
+    """submit one shard of pairs with every (protocol, port, paris) variant, in a worker"""
+    from common.credentials import get_ripe_atlas_credentials
+
+    from netmet.admission import AdmissionController
+    from netmet.scheduler import CampaignScheduler
+
+    spec, ledger_path, pairs, variants, limits = job
+
+    scheduler = CampaignScheduler(
+        get_ripe_atlas_credentials(), admission=AdmissionController(**limits)
+    )
+    measurements = scheduler.submit_variants(
+        pairs,
+        variants,
+        output_file_path=ledger_path,
+        measurement_type=spec["measurement_type"],
+        packets=spec["packets"],
+        size=spec["size"],
+    )
+
+    return sum(len(measurement["measurement_id"]) for measurement in measurements)
+
+
+def shard_limits(spec: dict, nb_jobs: int, nb_workers: int) -> dict:
+    """
+    admission limits of one shard
+
+    budgets are split between every job and rates between the workers
+    running at the same time. The concurrency cap is checked against every
+    measurement running on the account, so each worker gets all of it.
+    """
+    from netmet.admission import account_balance
+    from netmet.client import get_client
+
+    credit_budget = spec["credit_budget"]
+    if credit_budget == "account":
+        credit_budget = account_balance(get_client())
+        logger.info(f"credit budget: {credit_budget} credits left on the account")
+
+    def share(value, nb_shares: int):
+        return None if value is None else value / nb_shares
+
+    return {
+        "credit_budget": share(credit_budget, nb_jobs),
+        "daily_credits": share(spec["daily_credits"], nb_jobs),
+        "credits_per_hour": share(spec["credits_per_hour"], nb_workers),
+        "max_concurrent": spec["max_concurrent"],
+        "requests_per_second": spec["requests_per_second"] / nb_workers,
+        "shared": nb_workers > 1,
+    }
+
+
+def select_pairs(campaign: Campaign) -> list:
+    """pairs to measure, chosen once and checkpointed so that reruns resume them"""
+    from netmet.registry import ProbeRegistry
+    from netmet.sampler import measured_pairs, sample_pairs
+
+    if campaign.pairs_path.exists():
+        return [tuple(pair) for pair in load_json(campaign.pairs_path)]
+
+    vps = ProbeRegistry.from_file(campaign.vps_path)
+    targets = ProbeRegistry.from_file(campaign.targets_path)
+
+    if campaign.spec["pairs"]:
+        selected = sample_pairs(
+            vps, targets, campaign.spec["pairs"], measured_pairs(campaign.ledger_path)
+        )
+        pairs = [(vp.id, target.address_v4) for vp, target in selected]
+    else:
+        pairs = [
+            (vp.id, target.address_v4)
+            for vp in vps
+            if vp.status == "Connected"
+            for target in targets
+            if target.address_v4
+        ]
+
+    dump_json(pairs, campaign.pairs_path)
+
+    return pairs
+
+
+def submit(campaign: Campaign, args: argparse.Namespace) -> None:
+    pairs = select_pairs(campaign)
+
+    # shard by target, so each target keeps all its vps in one packed request
+    target_addrs = sorted({target_addr for _, target_addr in pairs})
+    shard_of = {target_addr: i % args.workers for i, target_addr in enumerate(target_addrs)}
+    shards = [[] for _ in range(args.workers)]
+    for vp_id, target_addr in pairs:
+        shards[shard_of[target_addr]].append((vp_id, target_addr))
+
+    # the variants of a pair share its vps: they are packed in the same requests
+    variants = campaign.variants()
+    jobs = [(campaign.spec, campaign.ledger_path, shard, variants) for shard in shards if shard]
+    limits = shard_limits(campaign.spec, max(len(jobs), 1), max(min(args.workers, len(jobs)), 1))
+    jobs = [(*job, limits) for job in jobs]
+    logger.info(
+        f"submitting {len(pairs)} pairs x {len(variants)} variants "
+        f"in {len(jobs)} shards"
+    )
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        nb_measurements = sum(executor.map(_submit_shard, jobs))
+
+    logger.info(f"{nb_measurements} measurements submitted")
+
+
+def collect(campaign: Campaign, args: argparse.Namespace) -> None:
+    import asyncio
+
+    from netmet.anomaly import AnomalyDetector
+    from netmet.collector import collect_ledger_to_store
+    from netmet.store import TracerouteStore
+
+    # rtt baselines carry over from one collection to the next
+    detector = AnomalyDetector()
+    if campaign.anomaly_state_path.exists():
+        detector.load(campaign.anomaly_state_path)
+
+    def on_alerts(alerts: list) -> None:
+        with campaign.anomalies_path.open("a") as file:
+            for alert in alerts:
+                file.write(json.dumps(alert) + "\n")
+        logger.info(f"{len(alerts)} rtt anomalies -> {campaign.anomalies_path}")
+
+    asyncio.run(
+        collect_ledger_to_store(
+            campaign.ledger_path,
+            TracerouteStore(campaign.store_path),
+            detector=detector,
+            on_alerts=on_alerts,
+        )
+    )
+    detector.save(campaign.anomaly_state_path)
+
+
+def analyze(campaign: Campaign, args: argparse.Namespace) -> None:
+    from netmet.analysis import measurement_summary
+    from netmet.store import TracerouteStore
+
+    summary = measurement_summary(TracerouteStore(campaign.store_path).load())
+
+    dump_json({key: values.tolist() for key, values in summary.items()}, campaign.summary_path)
+    logger.info(f"summary of {len(summary['msm_id'])} measurements -> {campaign.summary_path}")
+
+
+def changes(campaign: Campaign, args: argparse.Namespace) -> None:
+    from netmet.changes import ChangeDetector
+    from netmet.ledger import Ledger
+    from netmet.store import TracerouteStore
+
+    detector = ChangeDetector(
+        TracerouteStore(campaign.store_path),
+        Ledger(campaign.ledger_path),
+        campaign.changes_state_path,
+    )
+    detected = detector.run()
+
+    with campaign.changes_path.open("a") as file:
+        for change in detected:
+            file.write(json.dumps(change) + "\n")
+    logger.info(f"{len(detected)} changes appended to {campaign.changes_path}")
+
+
+def geolocate(campaign: Campaign, args: argparse.Namespace) -> None:
+    from netmet.geo import Sites, SiteTree, feasible_sites, hop_observations, infeasible_claims
+    from netmet.registry import ProbeRegistry
+    from netmet.store import TracerouteStore
+
+    vps = ProbeRegistry.from_file(campaign.vps_path)
+    sites = Sites.from_probes(vps, ProbeRegistry.from_file(campaign.targets_path))
+    if campaign.spec.get("geo_table"):
+        sites = sites.concatenate(Sites.from_csv(campaign.spec["geo_table"]))
+
+    columns = TracerouteStore(campaign.store_path).load(
+        ["msm_id", "prb_id", "timestamp", "dst", "hop", "from", "rtt", "timeout"]
+    )
+    observations = hop_observations(columns, vps)
+
+    # 1. hops located where their rtt cannot reach
+    infeasible = infeasible_claims(observations, sites)
+    with campaign.infeasible_path.open("w") as file:
+        for claim in infeasible:
+            file.write(json.dumps(claim) + "\n")
+
+    # 2. where each hop address can be, given every vp that saw it
+    located = feasible_sites(observations, SiteTree(sites))
+    dump_json(located, campaign.hop_sites_path)
+    logger.info(
+        f"{len(infeasible)} infeasible hop locations -> "
+        f"{campaign.infeasible_path}, feasible sites of {len(located['address'])} "
+        f"addresses -> {campaign.hop_sites_path}"
+    )
+
+
+def sweep(campaign: Campaign, args: argparse.Namespace) -> None:
+    from netmet.ledger import Ledger
+    from netmet.store import TracerouteStore
+    from netmet.sweep import SweepResult
+
+    result = SweepResult.from_columns(
+        TracerouteStore(campaign.store_path).load(
+            ["msm_id", "prb_id", "timestamp", "dst", "hop", "from", "rtt", "timeout"]
+        ),
+        Ledger(campaign.ledger_path),
+    )
+    summary = result.summary()
+
+    dump_json({**summary, "divergent_hops": result.divergent_hops()}, campaign.sweep_path)
+    logger.info(
+        f"{summary['nb_divergent_hops']} hops depend on the variant in "
+        f"{summary['nb_divergent_pairs']} of {summary['nb_pairs']} pairs -> {campaign.sweep_path}"
+    )
+
+
+def import_dumps(campaign: Campaign, args: argparse.Namespace) -> None:
+    from glob import glob
+
+    from netmet.bulk import BulkImporter
+    from netmet.registry import ProbeRegistry
+    from netmet.store import TracerouteStore
+
+    paths = sorted(
+        Path(path) for pattern in campaign.spec.get("dumps", []) for path in glob(pattern)
+    )
+    # without probe lists, every traceroute of the dumps is imported
+    vps = ProbeRegistry.from_file(campaign.vps_path) if campaign.vps_path.exists() else None
+    targets = (
+        ProbeRegistry.from_file(campaign.targets_path)
+        if campaign.targets_path.exists()
+        else None
+    )
+
+    importer = BulkImporter(
+        TracerouteStore(campaign.store_path),
+        vps=vps,
+        targets=targets,
+        state_path=campaign.imported_dumps_path,
+        workers=args.workers,
+    )
+    importer.run(paths)
+
+
+COMMANDS = {
+    "fetch-probes": fetch_probes,
+    "submit": submit,
+    "collect": collect,
+    "analyze": analyze,
+    "changes": changes,
+    "geolocate": geolocate,
+    "sweep": sweep,
+    "import-dumps": import_dumps,
+}
+
+
+def parse_args(argv: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="netmet", description="run RIPE Atlas traceroute campaigns"
+    )
+    parser.add_argument("command", choices=COMMANDS)
+    parser.add_argument("spec", type=Path, help="campaign spec (JSON)")
+    parser.add_argument(
+        "--workers", type=int, default=4, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, help="serve Prometheus metrics on this port"
+    )
+    parser.add_argument(
+        "--metrics-snapshot", type=Path, help="write JSON metric snapshots to this file"
+    )
+    parser.add_argument(
+        "--snapshot-interval", type=float, default=10.0, help="seconds between snapshots"
+    )
+    parser.add_argument(
+        "--profile", type=Path, help="sample stacks of this process into this file"
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv: list = None) -> int:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    # metrics are per process: submit workers do not report to the parent
+    server = serve_metrics(args.metrics_port) if args.metrics_port else None
+    stop_snapshots = (
+        write_snapshots(args.metrics_snapshot, args.snapshot_interval)
+        if args.metrics_snapshot
+        else None
+    )
+    profiler = SamplingProfiler() if args.profile else None
+    if profiler:
+        profiler.start()
+
+    try:
+        COMMANDS[args.command](Campaign(args.spec), args)
+    finally:
+        if profiler:
+            profiler.stop(args.profile)
+            logger.info(f"profile samples -> {args.profile}")
+        if stop_snapshots:
+            stop_snapshots.set()
+        if server:
+            server.shutdown()
+
+    return 0
@@ -0,0 +1,133 @@
+"""pooled HTTP client shared by every call to the RIPE Atlas API"""
+from typing import Optional
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from common.credentials import get_ripe_atlas_credentials
+
+from netmet.metrics import endpoint_of, metrics, record_response
+
+
+BASE_URL = "https://atlas.ripe.net/api/v2/"
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class _AtlasRetry(Retry):
+    """
+    retry GETs on 429/5xx and network errors, POSTs only when refused unprocessed
+
+    a POST that timed out, lost its connection or got a 5xx may have created
+    the measurement already: sending it again would pay twice. Only a 429, or
+    a 503 carrying Retry-After, says the request was not processed.
+    """
+
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method == "POST":
+            return status_code == 429 or (status_code == 503 and has_retry_after)
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def increment(
+        self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None
+    ):
+        if method == "POST" and error is not None:
+            raise error.with_traceback(_stacktrace)
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+class AtlasClient:
+    """
+    keep-alive session to the RIPE Atlas API
+
+    connections are pooled and reused between calls, every request gets a
+    timeout, 429/5xx answers and network errors are retried with exponential
+    backoff (honouring Retry-After), POSTs only when refused unprocessed, and
+    the API key travels in the Authorization header rather than in the url.
+    base_url can point to a local stub server.
+    """
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        base_url: str = BASE_URL,
+        pool_size: int = 16,
+        timeout: tuple = (5.0, 60.0),
+        max_retries: int = 5,
+        backoff_factor: float = 0.5,
+    ) -> None:
+        self.base_url = base_url if base_url.endswith("/") else f"{base_url}/"
+        self.timeout = timeout
+
+        retry = _AtlasRetry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(
+            {"Accept": "application/json", "Accept-Encoding": "gzip, deflate"}
+        )
+        if api_key:
+            self.session.headers["Authorization"] = f"Key {api_key}"
+
+        # latency, bytes, retries and 429s of every response, per endpoint
+        self.session.hooks["response"].append(record_response)
+
+    def url(self, path: str) -> str:
+        """absolute url for an API path, absolute urls are kept as is"""
+        if path.startswith(("http://", "https://")):
+            return path
+        return f"{self.base_url}{path.lstrip('/')}"
+
+    def get(
+        self,
+        path: str,
+        params: Optional[dict] = None,
+        stream: bool = False,
+        **kwargs,
+    ) -> requests.Response:
+        """GET a path; with stream=True the body is read lazily by the caller"""
+        return self.session.get(
+            self.url(path), params=params, stream=stream, timeout=self.timeout, **kwargs
+        )
+
+    def get_json(self, path: str, params: Optional[dict] = None):
+        response = self.get(path, params=params)
+        response.raise_for_status()
+
+        with metrics.timer("parse_seconds", endpoint=endpoint_of(response.url)):
+            return response.json()
+
+    def post_json(self, path: str, json_params: dict):
+        response = self.session.post(self.url(path), json=json_params, timeout=self.timeout)
+        response.raise_for_status()
+
+        with metrics.timer("parse_seconds", endpoint=endpoint_of(response.url)):
+            return response.json()
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_default_client = None
+
+
+def get_client() -> AtlasClient:
+    """return the client shared by the exo* functions"""
+    global _default_client
+    if _default_client is None:
+        credentials = get_ripe_atlas_credentials() or {}
+        _default_client = AtlasClient(api_key=credentials.get("secret_key"))
+    return _default_client
@@ -0,0 +1,219 @@
+"""collect the results of submitted measurements concurrently with asyncio"""
+import asyncio
+
+from pathlib import Path
+from typing import AsyncIterator, Callable, Iterable, Optional
+
+import numpy as np
+import requests
+
+from common.file_utils import dump_json
+from common.logger_config import logger
+
+from netmet.anomaly import AnomalyDetector
+from netmet.client import AtlasClient, get_client
+from netmet.ledger import iter_ledger
+from netmet.metrics import metrics
+from netmet.store import TracerouteStore, flatten_traceroutes
+from netmet.stream import iter_results
+
+
+MEASUREMENTS_PATH = "measurements/"
+
+# stopped, forced to stop, no suitable probes, failed
+FINAL_STATUSES = {4, 5, 6, 7}
+
+
+def read_measurement_ids(ledger_path: Path) -> list:
+    """return every measurement id recorded by exo5 / the campaign scheduler"""
+    measurement_ids = []
+    for measurement in iter_ledger(ledger_path):
+        ids = measurement["measurement_id"]
+        measurement_ids.extend(ids if isinstance(ids, list) else [ids])
+
+    # keep submission order, drop duplicates
+    return list(dict.fromkeys(measurement_ids))
+
+
+class ResultCollector:
+    """poll many one-off measurements and fetch all their probe results"""
+
+    def __init__(
+        self,
+        client: Optional[AtlasClient] = None,
+        max_concurrent: int = 16,
+        poll_interval: float = 30.0,
+        timeout: float = 3600.0,
+        results_limit: Optional[int] = None,
+    ) -> None:
+        self.client = client or get_client()
+        self.max_concurrent = max_concurrent
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.results_limit = results_limit
+
+        # measurements still running at the deadline during the last collect
+        self.pending = []
+
+    async def _get_json(self, path: str, semaphore: asyncio.Semaphore):
+        # requests is blocking: each call runs in a worker thread,
+        # the semaphore bounds how many are in flight at once
+        metrics.add("collector_waiting", 1)
+        async with semaphore:
+            metrics.add("collector_waiting", -1)
+            return await asyncio.to_thread(self.client.get_json, path)
+
+    async def _collect_one(
+        self, measurement_id: int, semaphore: asyncio.Semaphore
+    ) -> tuple:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+
+        # 1. wait for the measurement to stop
+        while True:
+            description = await self._get_json(
+                f"{MEASUREMENTS_PATH}{measurement_id}/", semaphore
+            )
+            if description.get("status", {}).get("id") in FINAL_STATUSES:
+                break
+            if loop.time() > deadline:
+                # its results are not final yet: leave them to the next collection
+                logger.info(f"measurement {measurement_id} still running, giving up")
+                return measurement_id, None
+            await asyncio.sleep(self.poll_interval)
+
+        # 2. fetch every probe result (or the first results_limit ones),
+        # decoded one at a time rather than as one large document
+        result_url = description.get("result") or f"{MEASUREMENTS_PATH}{measurement_id}/results/"
+        async with semaphore:
+            results = await asyncio.to_thread(
+                lambda: list(iter_results(result_url, self.results_limit, self.client))
+            )
+
+        return measurement_id, results
+
+    async def collect(self, measurement_ids: Iterable[int]) -> AsyncIterator[tuple]:
+        """
+        yield (measurement_id, results) as soon as each measurement is done
+
+        measurements still running after timeout are not yielded, their ids
+        are left in self.pending.
+        """
+        self.pending = []
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        tasks = [
+            asyncio.create_task(self._collect_one(measurement_id, semaphore))
+            for measurement_id in measurement_ids
+        ]
+
+        metrics.set("collector_pending", len(tasks))
+
+        try:
+            for nb_done, task in enumerate(asyncio.as_completed(tasks), 1):
+                try:
+                    measurement_id, results = await task
+                    if results is None:
+                        self.pending.append(measurement_id)
+                    else:
+                        yield measurement_id, results
+                except (requests.RequestException, ValueError) as error:
+                    # a failed request or an invalid body only loses this measurement
+                    metrics.inc("collect_errors")
+                    logger.error(f"failed to collect a measurement: {error}")
+                metrics.set("collector_pending", len(tasks) - nb_done)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if self.pending:
+            logger.info(
+                f"{len(self.pending)} measurements still running, collect again to fetch them"
+            )
+
+
+async def collect_ledger(
+    ledger_path: Path,
+    output_dir: Path,
+    collector: Optional[ResultCollector] = None,
+) -> int:
+    """
+    collect every measurement of a ledger into output_dir
+
+    results are written one file per measurement as they complete;
+    measurements already present in output_dir are skipped, so an
+    interrupted collection can be resumed; those still running at the
+    collector timeout are not written and get collected on the next run.
+    """
+    collector = collector or ResultCollector()
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    measurement_ids = [
+        measurement_id
+        for measurement_id in read_measurement_ids(ledger_path)
+        if not (output_dir / f"{measurement_id}.json").exists()
+    ]
+    logger.info(f"collecting {len(measurement_ids)} measurements")
+
+    nb_collected = 0
+    async for measurement_id, results in collector.collect(measurement_ids):
+        dump_json(results, output_dir / f"{measurement_id}.json")
+        nb_collected += 1
+
+    logger.info(f"collected {nb_collected} measurements")
+
+    return nb_collected
+
+
+async def collect_ledger_to_store(
+    ledger_path: Path,
+    store: TracerouteStore,
+    collector: Optional[ResultCollector] = None,
+    batch_size: int = 10000,
+    detector: Optional[AnomalyDetector] = None,
+    on_alerts: Optional[Callable[[list], None]] = None,
+) -> int:
+    """
+    collect every measurement of a ledger into a columnar traceroute store
+
+    traceroutes are appended in batches of about batch_size results;
+    measurements already in the store are skipped, including those that
+    were collected without any traceroute row. With a detector, each
+    batch also goes through it as it arrives and on_alerts receives the
+    alerts it raises.
+    """
+    collector = collector or ResultCollector()
+
+    stored_ids = store.measurement_ids()
+    measurement_ids = [
+        measurement_id
+        for measurement_id in read_measurement_ids(ledger_path)
+        if measurement_id not in stored_ids
+    ]
+    logger.info(f"collecting {len(measurement_ids)} measurements")
+
+    def flush(batch: list, batch_ids: list) -> None:
+        columns = flatten_traceroutes(batch)
+        store.append_columns(columns)
+        store.add_empty(set(batch_ids) - set(np.unique(columns["msm_id"]).tolist()))
+        if detector is not None:
+            alerts = detector.process(columns)
+            metrics.inc("alerts", len(alerts))
+            if alerts and on_alerts is not None:
+                on_alerts(alerts)
+
+    nb_collected = 0
+    batch = []
+    batch_ids = []
+    async for measurement_id, results in collector.collect(measurement_ids):
+        batch.extend(results)
+        batch_ids.append(measurement_id)
+        nb_collected += 1
+        if len(batch) >= batch_size:
+            flush(batch, batch_ids)
+            batch = []
+            batch_ids = []
+
+    flush(batch, batch_ids)
+    logger.info(f"collected {nb_collected} measurements")
+
+    return nb_collected
@@ -0,0 +1,338 @@
+"""
+speed of light feasibility of hop locations
+
+a reply cannot travel further than the speed of light in fibre allows
+within half of its rtt: a hop answering a vp in rtt ms lies within
+rtt / 2 * SPEED_IN_FIBRE km of it. Over a whole campaign this checks the
+location a geo table claims for each hop, and narrows down the candidate
+sites (probes, anchors, geo table entries) where the hop can be.
+"""
+import csv
+
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from netmet.analysis import _boundaries, responding_hops
+from netmet.prefixes import UNKNOWN_ASN, PrefixIndex
+from netmet.registry import ProbeRegistry
+from netmet.store import int_to_ip
+
+
+EARTH_RADIUS = 6371.0  # km
+
+# about 2/3 of the speed of light in vacuum, in km per ms
+SPEED_IN_FIBRE = 299792.458 * 2 / 3 / 1000
+
+
+def haversine(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """great circle distance in km, element wise over arrays of degrees"""
+    lat1, lon1, lat2, lon2 = (
+        np.radians(np.asarray(value, dtype=np.float64)) for value in (lat1, lon1, lat2, lon2)
+    )
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def max_distance(rtt) -> np.ndarray:
+    """furthest a hop answering within rtt ms can be, in km"""
+    return np.asarray(rtt, dtype=np.float64) / 2 * SPEED_IN_FIBRE
+
+
+def _unit_vectors(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=1)
+
+
+def _chord(distance: np.ndarray) -> np.ndarray:
+    """straight line distance on the unit sphere for a great circle distance in km"""
+    return 2 * np.sin(np.minimum(distance / EARTH_RADIUS, np.pi) / 2)
+
+
+class Sites:
+    """
+    candidate hop locations: latitude, longitude, country and address arrays
+
+    sites come from probe records (an anchor or a probe is located where it
+    says) or from a local geo table; a geo table may locate whole prefixes.
+    """
+
+    def __init__(
+        self,
+        latitude: np.ndarray,
+        longitude: np.ndarray,
+        country_code: np.ndarray,
+        prefixes: Optional[list] = None,
+    ) -> None:
+        self.latitude = np.asarray(latitude, dtype=np.float64)
+        self.longitude = np.asarray(longitude, dtype=np.float64)
+        self.country_code = np.asarray(country_code, dtype=object)
+        self.prefixes = prefixes or [None] * len(self.latitude)
+
+    def __len__(self) -> int:
+        return len(self.latitude)
+
+    @classmethod
+    def from_probes(cls, *registries: ProbeRegistry) -> "Sites":
+        """every located probe, with its address as a /32"""
+        probes = [
+            probe
+            for registry in registries
+            for probe in registry
+            if probe.latitude is not None and probe.longitude is not None
+        ]
+        return cls(
+            [probe.latitude for probe in probes],
+            [probe.longitude for probe in probes],
+            [probe.country_code for probe in probes],
+            [f"{probe.address_v4}/32" if probe.address_v4 else None for probe in probes],
+        )
+
+    @classmethod
+    def from_csv(cls, path: Path) -> "Sites":
+        """
+        load a geo table with prefix (or address), latitude, longitude and
+        country_code columns
+        """
+        latitude, longitude, country_code, prefixes = [], [], [], []
+        with Path(path).open(newline="") as file:
+            for row in csv.DictReader(file):
+                latitude.append(float(row["latitude"]))
+                longitude.append(float(row["longitude"]))
+                country_code.append(row.get("country_code"))
+                prefixes.append(row.get("prefix") or row.get("address"))
+
+        return cls(latitude, longitude, country_code, prefixes)
+
+    def concatenate(self, other: "Sites") -> "Sites":
+        return Sites(
+            np.concatenate([self.latitude, other.latitude]),
+            np.concatenate([self.longitude, other.longitude]),
+            np.concatenate([self.country_code, other.country_code]),
+            self.prefixes + other.prefixes,
+        )
+
+    def prefix_index(self) -> PrefixIndex:
+        """longest prefix match of addresses to the index of the site locating them"""
+        return PrefixIndex.from_pairs(
+            (prefix, index) for index, prefix in enumerate(self.prefixes) if prefix
+        )
+
+
+class SiteTree:
+    """
+    k-d tree over sites, as points on the unit sphere
+
+    the tree is stored in flat arrays (bounding box, point range and children
+    of each node) and queried for whole batches at once: the traversal
+    advances all (query, node) pairs level by level with array operations.
+    """
+
+    def __init__(self, sites: Sites, leaf_size: int = 16) -> None:
+        self.sites = sites
+        self.points = _unit_vectors(sites.latitude, sites.longitude)
+        self.order = np.arange(len(sites))
+
+        # nodes are processed in creation order, children are created on split
+        starts, ends, lefts, rights, lows, highs = [0], [len(sites)], [-1], [-1], [], []
+        node = 0
+        while node < len(starts):
+            start, end = starts[node], ends[node]
+            points = self.points[self.order[start:end]]
+            lows.append(points.min(axis=0) if len(points) else np.zeros(3))
+            highs.append(points.max(axis=0) if len(points) else np.zeros(3))
+
+            if end - start > leaf_size:
+                # split at the median of the widest dimension
+                axis = int(np.argmax(highs[node] - lows[node]))
+                middle = start + (end - start) // 2
+                split = np.argpartition(points[:, axis], middle - start)
+                self.order[start:end] = self.order[start:end][split]
+
+                lefts[node], rights[node] = len(starts), len(starts) + 1
+                starts.extend([start, middle])
+                ends.extend([middle, end])
+                lefts.extend([-1, -1])
+                rights.extend([-1, -1])
+            node += 1
+
+        self.start = np.array(starts, dtype=np.int64)
+        self.end = np.array(ends, dtype=np.int64)
+        self.left = np.array(lefts, dtype=np.int64)
+        self.right = np.array(rights, dtype=np.int64)
+        self.low = np.array(lows)
+        self.high = np.array(highs)
+
+    def query_radius(self, latitude, longitude, radius) -> tuple:
+        """
+        (query_index, site_index) of every site within radius km of each query
+        """
+        queries = _unit_vectors(
+            np.asarray(latitude, dtype=np.float64), np.asarray(longitude, dtype=np.float64)
+        )
+        chord = _chord(np.broadcast_to(np.asarray(radius, dtype=np.float64), len(queries)))
+
+        query = np.arange(len(queries))
+        node = np.zeros(len(queries), dtype=np.int64)
+
+        found_queries, found_sites = [], []
+        while len(query):
+            # 1. prune nodes whose box is out of reach
+            gap = np.maximum(self.low[node] - queries[query], 0) + np.maximum(
+                queries[query] - self.high[node], 0
+            )
+            reachable = np.einsum("ij,ij->i", gap, gap) <= chord[query] ** 2
+            query, node = query[reachable], node[reachable]
+
+            # 2. leaves: exact distance to each of their sites
+            leaf = self.left[node] < 0
+            leaf_query, leaf_node = query[leaf], node[leaf]
+            sizes = self.end[leaf_node] - self.start[leaf_node]
+            pair_query = np.repeat(leaf_query, sizes)
+            offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+            pair_site = self.order[np.repeat(self.start[leaf_node], sizes) + offsets]
+            difference = self.points[pair_site] - queries[pair_query]
+            within = np.einsum("ij,ij->i", difference, difference) <= chord[pair_query] ** 2
+            found_queries.append(pair_query[within])
+            found_sites.append(pair_site[within])
+
+            # 3. descend into both children of the other nodes
+            inner_query, inner_node = query[~leaf], node[~leaf]
+            query = np.concatenate([inner_query, inner_query])
+            node = np.concatenate([self.left[inner_node], self.right[inner_node]])
+
+        if not found_queries:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(found_queries), np.concatenate(found_sites)
+
+
+def hop_observations(columns: dict, vps: ProbeRegistry) -> dict:
+    """
+    one observation per responding hop: vp location, hop address, min rtt
+    and the max distance it allows; hops of unlocated vps are dropped
+    """
+    hops = responding_hops(columns)
+
+    located = [probe for probe in vps if probe.latitude is not None]
+    vp_ids = np.array([probe.id for probe in located], dtype=np.int64)
+    order = np.argsort(vp_ids)
+    vp_ids = vp_ids[order]
+    vp_latitude = np.array([probe.latitude for probe in located], dtype=np.float64)[order]
+    vp_longitude = np.array([probe.longitude for probe in located], dtype=np.float64)[order]
+
+    position = np.minimum(np.searchsorted(vp_ids, hops["prb_id"]), max(len(vp_ids) - 1, 0))
+    known = (
+        (vp_ids[position] == hops["prb_id"]) if len(vp_ids) else np.zeros(len(position), bool)
+    )
+    known &= ~np.isnan(hops["rtt_min"])
+
+    observations = {name: values[known] for name, values in hops.items()}
+    observations["vp_latitude"] = vp_latitude[position[known]]
+    observations["vp_longitude"] = vp_longitude[position[known]]
+    observations["max_distance"] = max_distance(observations["rtt_min"])
+
+    return observations
+
+
+def check_claims(observations: dict, geo_table: Sites) -> dict:
+    """
+    distance between each vp and the location the geo table claims for the
+    hop, and whether the rtt allows it (claimed_site is -1, distance nan and
+    feasible True for addresses the table does not locate)
+    """
+    # the prefix index maps addresses to site indexes instead of ASNs
+    claimed_site, _ = geo_table.prefix_index().lookup(observations["address"])
+    located = claimed_site != UNKNOWN_ASN
+
+    distance = np.full(len(claimed_site), np.nan)
+    distance[located] = haversine(
+        observations["vp_latitude"][located],
+        observations["vp_longitude"][located],
+        geo_table.latitude[claimed_site[located]],
+        geo_table.longitude[claimed_site[located]],
+    )
+
+    return {
+        "claimed_site": claimed_site,
+        "distance": distance,
+        "feasible": ~located | (distance <= observations["max_distance"]),
+    }
+
+
+def feasible_sites(observations: dict, tree: SiteTree, max_constraints: int = 8) -> dict:
+    """
+    sites where each hop address can be, given every vp that saw it
+
+    candidates are the sites within reach of the tightest observation of the
+    address (a tree query), filtered by its next tightest ones, up to
+    max_constraints observations per address. Returns lists aligned by
+    address: number of observations, tightest max distance, number of
+    feasible sites and the countries they are in.
+    """
+    address = observations["address"]
+    order = np.lexsort((observations["max_distance"], address))
+    sorted_address = address[order]
+    starts = _boundaries(sorted_address)
+    sizes = np.diff(np.append(starts, len(order)))
+
+    # 1. candidates from the tightest observation of each address
+    tightest = order[starts]
+    group, site = tree.query_radius(
+        observations["vp_latitude"][tightest],
+        observations["vp_longitude"][tightest],
+        observations["max_distance"][tightest],
+    )
+
+    # 2. every other constraint must hold as well
+    keep = np.ones(len(group), dtype=bool)
+    sites = tree.sites
+    for rank in range(1, max_constraints):
+        constrained = sizes[group] > rank
+        observation = order[starts[group[constrained]] + rank]
+        keep[constrained] &= haversine(
+            observations["vp_latitude"][observation],
+            observations["vp_longitude"][observation],
+            sites.latitude[site[constrained]],
+            sites.longitude[site[constrained]],
+        ) <= observations["max_distance"][observation]
+    group, site = group[keep], site[keep]
+
+    # 3. distinct countries per address
+    codes, country = np.unique(sites.country_code.astype(str), return_inverse=True)
+    pairs = np.unique(group * len(codes) + country.reshape(-1)[site])
+    countries = [[] for _ in starts]
+    for index, code in zip((pairs // len(codes)).tolist(), codes[pairs % len(codes)].tolist()):
+        if code != "None":
+            countries[index].append(code)
+
+    return {
+        "address": [int_to_ip(value) for value in sorted_address[starts]],
+        "observations": sizes.tolist(),
+        "max_distance": observations["max_distance"][tightest].tolist(),
+        "sites": np.bincount(group, minlength=len(starts)).tolist(),
+        "countries": countries,
+    }
+
+
+def infeasible_claims(observations: dict, geo_table: Sites) -> list:
+    """the hop observations whose claimed location their rtt rules out"""
+    claims = check_claims(observations, geo_table)
+
+    return [
+        {
+            "msm_id": int(observations["msm_id"][index]),
+            "prb_id": int(observations["prb_id"][index]),
+            "hop": int(observations["hop"][index]),
+            "address": int_to_ip(observations["address"][index]),
+            "rtt_min": float(observations["rtt_min"][index]),
+            "max_distance": float(observations["max_distance"][index]),
+            "claimed_country": geo_table.country_code[claims["claimed_site"][index]],
+            "distance": float(claims["distance"][index]),
+        }
+        for index in np.flatnonzero(~claims["feasible"])
+    ]
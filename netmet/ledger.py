@@ -0,0 +1,242 @@
+"""append-only ledger of submitted measurements (JSON Lines)"""
+import json
+import os
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, appends are then unlocked
+    fcntl = None
+
+from common.file_utils import load_json
+
+
+def measurement_keys(measurement: dict) -> Iterator[tuple]:
+    """
+    yield (measurement_id, (vp_id, target, protocol, port, paris)) for a
+    ledger record, paris being None for definitions that leave it unset
+
+    the API returns one measurement id per definition, in definition order;
+    every probe of the request runs every definition.
+    """
+    description = measurement["measurement_description"]
+    measurement_ids = measurement["measurement_id"]
+    if not isinstance(measurement_ids, list):
+        measurement_ids = [measurement_ids]
+
+    vp_ids = []
+    for probes in description["probes"]:
+        vp_ids.extend(int(vp_id) for vp_id in str(probes["value"]).split(","))
+
+    for measurement_id, definition in zip(measurement_ids, description["definitions"]):
+        for vp_id in vp_ids:
+            yield measurement_id, (
+                vp_id,
+                definition["target"],
+                definition.get("protocol"),
+                definition.get("port"),
+                definition.get("paris"),
+            )
+
+
+def _decode_line(line: bytes):
+    """decode one ledger line, None for blank, unfinished or torn lines"""
+    if not line.endswith(b"\n") or not line.strip():
+        return None
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError:
+        return None
+
+
+def iter_ledger(path: Path) -> Iterator[dict]:
+    """
+    yield the records of a ledger, JSON Lines or legacy JSON array
+
+    lines torn by a crash during an append are ignored.
+    """
+    path = Path(path)
+    with path.open("rb") as file:
+        first_byte = file.read(1).lstrip()
+        if first_byte == b"[":
+            yield from load_json(path)
+            return
+
+        file.seek(0)
+        for line in file:
+            measurement = _decode_line(line)
+            if measurement is not None:
+                yield measurement
+
+
+class Ledger:
+    """
+    append-only, multi-process safe record of submitted measurements
+
+    each record is one JSON line written in a single append under an
+    exclusive lock, so a submission costs the same whatever the ledger size
+    and concurrent writers never interleave. The in-memory indexes (by
+    measurement id and by (vp_id, target, protocol, port, paris)) are built once
+    and then only read the lines appended since.
+    """
+
+    def __init__(self, path: Path, durable: bool = False) -> None:
+        self.path = Path(path)
+        self.durable = durable
+        self._lock_path = self.path.with_name(f"{self.path.name}.lock")
+        # a JSONL ledger never turns into a legacy one: checked on the first append only
+        self._legacy_checked = False
+
+        self._reset()
+
+    def _reset(self) -> None:
+        self.by_measurement_id = {}
+        self.by_key = {}
+        self._offset = 0
+        # inode of the file read up to _offset, to notice when compact() replaced it
+        self._inode = None
+
+    @classmethod
+    def from_json(cls, json_path: Path, path: Path) -> "Ledger":
+        """migrate a legacy JSON array ledger (as written by insert_json)"""
+        ledger = cls(path)
+        for measurement in load_json(json_path):
+            ledger.append(measurement)
+
+        return ledger
+
+    def _is_legacy(self) -> bool:
+        if not self.path.exists():
+            return False
+        with self.path.open("rb") as file:
+            return file.read(64).lstrip().startswith(b"[")
+
+    @contextmanager
+    def _locked(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock_path.open("a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _index(self, measurement: dict) -> None:
+        for measurement_id, key in measurement_keys(measurement):
+            self.by_measurement_id[measurement_id] = measurement
+            self.by_key.setdefault(key, []).append(measurement_id)
+
+    def append(self, measurement: dict) -> None:
+        line = json.dumps(measurement, separators=(",", ":")).encode() + b"\n"
+
+        if not self._legacy_checked:
+            if not self._offset and self._is_legacy():
+                raise ValueError(
+                    f"{self.path} is a JSON array, migrate it first with Ledger.from_json"
+                )
+            self._legacy_checked = True
+
+        with self._locked():
+            with self.path.open("a+b") as file:
+                # a crash may have left a torn last line: close it first
+                if file.seek(0, os.SEEK_END):
+                    file.seek(-1, os.SEEK_END)
+                    if file.read(1) != b"\n":
+                        line = b"\n" + line
+                file.write(line)
+                file.flush()
+                if self.durable:
+                    os.fsync(file.fileno())
+
+        self._index(measurement)
+
+    def refresh(self) -> int:
+        """
+        index the records appended since the last refresh (by any process)
+
+        a ledger compacted by another instance since is read again from the start.
+        """
+        if not self.path.exists():
+            return 0
+
+        if not self._offset and self._is_legacy():
+            # legacy files are read once, they never grow
+            measurements = load_json(self.path)
+            for measurement in measurements:
+                self._index(measurement)
+            self._offset = self.path.stat().st_size
+            return len(measurements)
+
+        nb_records = 0
+        with self.path.open("rb") as file:
+            stat = os.fstat(file.fileno())
+            if self._inode is not None and (
+                stat.st_ino != self._inode or stat.st_size < self._offset
+            ):
+                self._reset()
+            self._inode = stat.st_ino
+
+            file.seek(self._offset)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                self._offset += len(line)
+                measurement = _decode_line(line)
+                if measurement is not None:
+                    nb_records += 1
+                    # our own appends are already indexed
+                    if not all(
+                        measurement_id in self.by_measurement_id
+                        for measurement_id, _ in measurement_keys(measurement)
+                    ):
+                        self._index(measurement)
+
+        return nb_records
+
+    def __iter__(self) -> Iterator[dict]:
+        if not self.path.exists():
+            return iter(())
+        return iter_ledger(self.path)
+
+    def measurement_ids(self) -> list:
+        self.refresh()
+        return list(self.by_measurement_id)
+
+    def variants(self) -> dict:
+        """measurement id -> (protocol, port, paris) of its definition"""
+        self.refresh()
+        return {
+            measurement_id: key[2:]
+            for key, measurement_ids in self.by_key.items()
+            for measurement_id in measurement_ids
+        }
+
+    def compact(self) -> int:
+        """rewrite the ledger without duplicate records, return the record count"""
+        with self._locked():
+            seen = set()
+            records = []
+            for measurement in self:
+                ids = measurement["measurement_id"]
+                key = tuple(ids) if isinstance(ids, list) else (ids,)
+                if key not in seen:
+                    seen.add(key)
+                    records.append(measurement)
+
+            tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+            with tmp_path.open("wb") as file:
+                for measurement in records:
+                    file.write(json.dumps(measurement, separators=(",", ":")).encode() + b"\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+
+        self._reset()
+        self.refresh()
+
+        return len(records)
@@ -0,0 +1,251 @@
+"""
+instrumentation of API interactions and hot paths
+
+counters, gauges and latency histograms are kept in a process-wide
+registry, exported as Prometheus text (served over HTTP or written as
+periodic JSON snapshots). A small sampling profiler can be switched on
+around a whole run.
+"""
+import bisect
+import collections
+import json
+import os
+import re
+import signal
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+
+# seconds, from a fast cached call to a slow result download
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+class MetricsRegistry:
+    """thread-safe counters, gauges and histograms, keyed by name and labels"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        with self._lock:
+            self.counters[(name, _label_key(labels))] += value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self.gauges[(name, _label_key(labels))] = value
+
+    def add(self, name: str, value: float, **labels) -> None:
+        """move a gauge up or down, e.g. a queue depth"""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def snapshot(self) -> dict:
+        """plain dict of every metric, for JSON export"""
+
+        def name_of(key: tuple) -> str:
+            name, labels = key
+            if not labels:
+                return name
+            return f"{name}{{{','.join(f'{k}={v}' for k, v in labels)}}}"
+
+        with self._lock:
+            return {
+                "time": time.time(),
+                "counters": {name_of(key): value for key, value in self.counters.items()},
+                "gauges": {name_of(key): value for key, value in self.gauges.items()},
+                "histograms": {
+                    name_of(key): {
+                        "count": histogram.count,
+                        "sum": histogram.total,
+                        "buckets": dict(zip(map(str, histogram.buckets + ("+Inf",)), histogram.counts)),
+                    }
+                    for key, histogram in self.histograms.items()
+                },
+            }
+
+    def render_prometheus(self) -> str:
+        """metrics in the Prometheus text exposition format"""
+
+        def labels_of(labels: tuple, **extra) -> str:
+            items = list(labels) + list(extra.items())
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"netmet_{name}_total{labels_of(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"netmet_{name}{labels_of(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f"netmet_{name}_bucket{labels_of(labels, le=bound)} {cumulative}")
+                lines.append(f"netmet_{name}_sum{labels_of(labels)} {histogram.total}")
+                lines.append(f"netmet_{name}_count{labels_of(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+_ID_PATTERN = re.compile(r"/\d+(?=/|$)")
+
+
+def endpoint_of(url: str) -> str:
+    """url path with numeric ids folded, e.g. /api/v2/measurements/{id}/results/"""
+    path = url.split("://", 1)[-1].split("/", 1)[-1].split("?", 1)[0]
+    return _ID_PATTERN.sub("/{id}", f"/{path}")
+
+
+def record_response(response, *args, **kwargs) -> None:
+    """requests response hook: latency, bytes, retries and 429s per endpoint"""
+    endpoint = endpoint_of(response.url)
+    method = response.request.method
+
+    metrics.observe(
+        "request_seconds", response.elapsed.total_seconds(), endpoint=endpoint, method=method
+    )
+    metrics.inc("requests", endpoint=endpoint, method=method, status=response.status_code)
+    metrics.inc(
+        "response_bytes",
+        int(response.headers.get("Content-Length") or 0),
+        endpoint=endpoint,
+    )
+
+    retries = getattr(getattr(response, "raw", None), "retries", None)
+    history = getattr(retries, "history", ()) or ()
+    if history:
+        metrics.inc("retries", len(history), endpoint=endpoint)
+    nb_throttled = sum(1 for attempt in history if attempt.status == 429)
+    nb_throttled += response.status_code == 429
+    if nb_throttled:
+        metrics.inc("throttled", nb_throttled, endpoint=endpoint)
+
+
+def serve_metrics(port: int, host: str = "127.0.0.1"):
+    """expose /metrics in Prometheus format from a background thread"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            body = metrics.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def write_snapshots(path: Path, interval: float = 10.0) -> threading.Event:
+    """write a JSON snapshot every interval seconds; set the event to stop"""
+    stop = threading.Event()
+
+    def loop() -> None:
+        while True:
+            stopped = stop.wait(interval)
+            tmp_path = Path(f"{path}.tmp")
+            tmp_path.write_text(json.dumps(metrics.snapshot(), indent=4))
+            os.replace(tmp_path, path)
+            if stopped:
+                return
+
+    threading.Thread(target=loop, daemon=True).start()
+
+    return stop
+
+
+class SamplingProfiler:
+    """
+    statistical profiler: samples every thread's stack on a CPU timer
+
+    the output is in collapsed stack format ("a;b;c count" lines), ready for
+    flamegraph tools. Only available where SIGPROF exists (not on Windows).
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.samples = collections.Counter()
+
+    def _sample(self, signum, frame) -> None:
+        for thread_frame in sys._current_frames().values():
+            stack = []
+            while thread_frame is not None:
+                code = thread_frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                thread_frame = thread_frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self, output_path: Optional[Path] = None) -> None:
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        if output_path:
+            with Path(output_path).open("w") as file:
+                for stack, count in self.samples.most_common():
+                    file.write(f"{stack} {count}\n")
@@ -0,0 +1,378 @@
+"""
+local stand-in for the RIPE Atlas API, served from recorded fixtures
+
+serves /api/v2/probes/, /api/v2/measurements/{id}/, their results,
+measurement submissions and the account credits, with configurable
+latency, pagination, 429 injection and synthetic scale-up, so that the
+fetch / submit / collect paths can be benchmarked without network:
+
+    python -m netmet.mock_server --port 8080 --latency 0.02 --results 10000
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Iterator, Optional
+from urllib.parse import parse_qs, urlparse
+
+from netmet.admission import request_cost
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+# stopped status, as returned for finished one-off measurements
+STOPPED = {"id": 4, "name": "Stopped"}
+ONGOING = {"id": 2, "name": "Ongoing"}
+
+
+def _load_records(path: Path) -> list:
+    with path.open() as file:
+        records = json.load(file)
+    if isinstance(records, dict):
+        records = records.get("results", [records])
+    return records
+
+
+class MockAtlas:
+    """
+    state of the mock API: probes, measurements and injected behaviours
+
+    probe_scale duplicates every fixture probe that many times (with new ids),
+    results_per_measurement replicates the fixture result of a measurement
+    over as many probes, generated lazily so that millions of results cost
+    no memory. Every rate_limit_every-th request is answered with a 429.
+    With credits, the account holds that many credits and submissions it
+    cannot pay for are refused with a 400, as the real API does.
+    """
+
+    def __init__(
+        self,
+        fixtures_dir: Path = ROOT_DIR,
+        latency: float = 0.0,
+        probe_scale: int = 1,
+        results_per_measurement: Optional[int] = None,
+        rate_limit_every: int = 0,
+        retry_after: int = 1,
+        oneoff_duration: float = 0.0,
+        credits: Optional[int] = None,
+    ) -> None:
+        self.latency = latency
+        self.credits = credits
+        self.results_per_measurement = results_per_measurement
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.oneoff_duration = oneoff_duration
+
+        self._lock = threading.Lock()
+        self._nb_requests = 0
+        self._next_id = itertools.count(90000000)
+
+        # 1. probes, scaled up with fresh ids
+        probes = {}
+        for path in sorted((fixtures_dir / "datasets").glob("*.json")):
+            for probe in _load_records(path):
+                probes[probe["id"]] = probe
+        self.probes = [
+            {**probe, "id": probe["id"] + copy_index * 1000000}
+            for copy_index in range(probe_scale)
+            for probe in probes.values()
+        ]
+
+        # 2. measurements: recorded descriptions and single results
+        self.descriptions = {}
+        self.templates = {}
+        for path in sorted((fixtures_dir / "results").glob("*.json")):
+            for record in _load_records(path):
+                if "msm_id" in record:
+                    self.templates[record["msm_id"]] = record
+                elif "id" in record and "type" in record:
+                    self.descriptions[record["id"]] = record
+        for msm_id, result in self.templates.items():
+            self.descriptions.setdefault(msm_id, self._description(msm_id, result))
+
+        self.submitted = []
+        self._created = {}
+
+    def _description(self, msm_id: int, result: dict) -> dict:
+        return {
+            "id": msm_id,
+            "type": result.get("type", "traceroute"),
+            "af": result.get("af", 4),
+            "protocol": result.get("proto"),
+            "target": result.get("dst_addr"),
+            "target_ip": result.get("dst_addr"),
+            "is_oneoff": True,
+            "status": STOPPED,
+        }
+
+    def throttled(self) -> bool:
+        """count a request, True when it must be refused with a 429"""
+        with self._lock:
+            self._nb_requests += 1
+            return bool(self.rate_limit_every) and self._nb_requests % self.rate_limit_every == 0
+
+    def create(self, json_params: dict) -> Optional[list]:
+        """register a submission, one new measurement per definition (None if unpaid)"""
+        probe_ids = []
+        for probes in json_params.get("probes", []):
+            probe_ids.extend(int(probe_id) for probe_id in str(probes["value"]).split(","))
+
+        template = next(iter(self.templates.values()), {"result": []})
+        measurement_ids = []
+        with self._lock:
+            if self.credits is not None:
+                cost = request_cost(json_params)
+                if cost > self.credits:
+                    return None
+                self.credits -= cost
+            self.submitted.append(json_params)
+            for definition in json_params.get("definitions", []):
+                msm_id = next(self._next_id)
+                result = {
+                    **template,
+                    "msm_id": msm_id,
+                    "dst_addr": definition["target"],
+                    "dst_name": definition["target"],
+                    "proto": definition.get("protocol"),
+                }
+                self.templates[msm_id] = result
+                self.descriptions[msm_id] = {**self._description(msm_id, result), "probes": probe_ids}
+                self._created[msm_id] = time.monotonic()
+                measurement_ids.append(msm_id)
+
+        return measurement_ids
+
+    def description(self, msm_id: int, base_url: str) -> Optional[dict]:
+        description = self.descriptions.get(msm_id)
+        if description is None:
+            return None
+
+        created = self._created.get(msm_id)
+        running = created is not None and time.monotonic() - created < self.oneoff_duration
+        return {
+            **description,
+            "status": ONGOING if running else STOPPED,
+            "result": f"{base_url}/api/v2/measurements/{msm_id}/results/",
+        }
+
+    def iter_results(self, msm_id: int) -> Iterator[dict]:
+        template = self.templates.get(msm_id)
+        if template is None:
+            return
+
+        probe_ids = self.descriptions[msm_id].get("probes") or [template.get("prb_id", 0)]
+        nb_results = self.results_per_measurement or len(probe_ids)
+        for index in range(nb_results):
+            yield {
+                **template,
+                "prb_id": probe_ids[index % len(probe_ids)] + index // len(probe_ids) * 1000000,
+                "timestamp": template.get("timestamp", 0) + index,
+            }
+
+    def running_count(self) -> int:
+        now = time.monotonic()
+        return sum(1 for created in self._created.values() if now - created < self.oneoff_duration)
+
+
+class MockAtlasHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    atlas: MockAtlas = None
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _send_json(self, status: int, body, headers: dict = None) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, lines: Iterator[bytes], content_type: str) -> None:
+        """chunked response, so that huge result sets are never built in memory"""
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        buffer = []
+        size = 0
+        try:
+            for line in itertools.chain(lines, [None]):
+                if line is not None:
+                    buffer.append(line)
+                    size += len(line)
+                if buffer and (line is None or size >= 64 * 1024):
+                    chunk = b"".join(buffer)
+                    self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                    buffer, size = [], 0
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped reading, e.g. after the first K results
+            self.close_connection = True
+
+    def _before(self) -> bool:
+        """apply latency and rate limiting, False when the request was refused"""
+        if self.atlas.latency:
+            time.sleep(self.atlas.latency * random.uniform(0.5, 1.5))
+        if self.atlas.throttled():
+            self._send_json(
+                429,
+                {"error": {"status": 429, "title": "Too Many Requests"}},
+                {"Retry-After": str(self.atlas.retry_after)},
+            )
+            return False
+        return True
+
+    def do_GET(self) -> None:
+        if not self._before():
+            return
+
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split("/") if part]
+
+        if parts[:3] == ["api", "v2", "probes"]:
+            return self._probes(url.path, query)
+
+        if parts[:3] == ["api", "v2", "credits"]:
+            return self._send_json(200, {"current_balance": self.atlas.credits})
+
+        if parts[:3] == ["api", "v2", "measurements"] and len(parts) >= 4:
+            if parts[3] == "my":
+                return self._send_json(200, {"count": self.atlas.running_count(), "results": []})
+            msm_id = int(parts[3])
+            if len(parts) == 5 and parts[4] == "results":
+                return self._results(msm_id, query)
+            description = self.atlas.description(msm_id, self.base_url)
+            if description is not None:
+                return self._send_json(200, description)
+
+        self._send_json(404, {"error": {"status": 404, "title": "Not Found"}})
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if not self._before():
+            return
+
+        if urlparse(self.path).path.rstrip("/") != "/api/v2/measurements":
+            return self._send_json(404, {"error": {"status": 404, "title": "Not Found"}})
+
+        measurement_ids = self.atlas.create(body)
+        if measurement_ids is None:
+            return self._send_json(
+                400,
+                {"error": {"status": 400, "title": "Bad Request", "detail": "not enough credits"}},
+            )
+        self._send_json(201, {"measurements": measurement_ids})
+
+    def _probes(self, path: str, query: dict) -> None:
+        probes = self.atlas.probes
+        if "country_code" in query:
+            probes = [p for p in probes if p.get("country_code") == query["country_code"]]
+        if "status" in query:
+            probes = [p for p in probes if str((p.get("status") or {}).get("id")) == query["status"]]
+        if "is_public" in query:
+            is_public = query["is_public"].lower() == "true"
+            probes = [p for p in probes if p.get("is_public") == is_public]
+
+        page_size = min(int(query.get("page_size", 100)), 500)
+        page = int(query.get("page", 1))
+        nb_pages = max(1, -(-len(probes) // page_size))
+
+        def page_url(number: int) -> Optional[str]:
+            if not 1 <= number <= nb_pages:
+                return None
+            params = "&".join(f"{k}={v}" for k, v in {**query, "page": number}.items())
+            return f"{self.base_url}{path}?{params}"
+
+        self._send_json(
+            200,
+            {
+                "count": len(probes),
+                "next": page_url(page + 1),
+                "previous": page_url(page - 1),
+                "results": probes[(page - 1) * page_size : page * page_size],
+            },
+        )
+
+    def _results(self, msm_id: int, query: dict) -> None:
+        if msm_id not in self.atlas.templates:
+            return self._send_json(404, {"error": {"status": 404, "title": "Not Found"}})
+
+        results = (json.dumps(result).encode() for result in self.atlas.iter_results(msm_id))
+        if query.get("format") == "txt":
+            self._send_stream((line + b"\n" for line in results), "text/plain")
+        else:
+            # a JSON array, still generated element by element
+            def elements():
+                yield b"["
+                for index, result in enumerate(results):
+                    yield result if index == 0 else b"," + result
+                yield b"]"
+
+            self._send_stream(elements(), "application/json")
+
+
+@contextmanager
+def serve(atlas: Optional[MockAtlas] = None, host: str = "127.0.0.1", port: int = 0):
+    """run a mock server in a background thread, yield its API base url"""
+    handler = type("Handler", (MockAtlasHandler,), {"atlas": atlas or MockAtlas()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://{host}:{server.server_address[1]}/api/v2/"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="mock RIPE Atlas API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--fixtures", type=Path, default=ROOT_DIR)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--probe-scale", type=int, default=1)
+    parser.add_argument("--results", type=int, default=None, help="results per measurement")
+    parser.add_argument("--rate-limit-every", type=int, default=0)
+    parser.add_argument("--oneoff-duration", type=float, default=0.0)
+    parser.add_argument("--credits", type=int, default=None, help="account balance")
+    args = parser.parse_args()
+
+    atlas = MockAtlas(
+        fixtures_dir=args.fixtures,
+        latency=args.latency,
+        probe_scale=args.probe_scale,
+        results_per_measurement=args.results,
+        rate_limit_every=args.rate_limit_every,
+        oneoff_duration=args.oneoff_duration,
+        credits=args.credits,
+    )
+    with serve(atlas, args.host, args.port) as base_url:
+        print(f"mock RIPE Atlas API on {base_url}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""longest-prefix match of IPv4 addresses to their prefix and ASN"""
+import ipaddress
+
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+from netmet.registry import ProbeRegistry
+from netmet.store import ip_to_int
+
+
+UNKNOWN_ASN = -1
+
+
+class PrefixIndex:
+    """
+    prefix -> ASN table, looked up in vectorized batches
+
+    prefixes are kept as sorted network integers grouped by prefix length
+    (length_starts[l]:length_starts[l + 1] holds the /l networks). A batch
+    of addresses is matched with one searchsorted per prefix length, from
+    the most to the least specific, so millions of addresses cost at most
+    33 vectorized passes. The arrays can be saved and memory mapped back,
+    so loading a large table is instant.
+    """
+
+    def __init__(self, networks: np.ndarray, asns: np.ndarray, length_starts: np.ndarray) -> None:
+        self.networks = networks
+        self.asns = asns
+        self.length_starts = length_starts
+
+    @classmethod
+    def from_pairs(cls, pairs: Iterable[tuple]) -> "PrefixIndex":
+        """build from (prefix, asn) pairs such as ("193.29.220.0/24", 29067)"""
+        table = {}
+        for prefix, asn in pairs:
+            if not prefix or asn is None:
+                continue
+            try:
+                network = ipaddress.IPv4Network(prefix, strict=False)
+            except ValueError:
+                continue
+            table[(network.prefixlen, int(network.network_address))] = asn
+
+        keys = sorted(table)
+        lengths = np.fromiter((length for length, _ in keys), dtype=np.int64, count=len(keys))
+
+        return cls(
+            networks=np.fromiter((network for _, network in keys), dtype=np.uint32, count=len(keys)),
+            asns=np.fromiter((table[key] for key in keys), dtype=np.int64, count=len(keys)),
+            length_starts=np.searchsorted(lengths, np.arange(34)),
+        )
+
+    @classmethod
+    def from_probes(cls, *registries: ProbeRegistry) -> "PrefixIndex":
+        """build from the prefix_v4 / asn_v4 of probe records"""
+        return cls.from_pairs(
+            (probe.prefix_v4, probe.asn_v4) for registry in registries for probe in registry
+        )
+
+    @classmethod
+    def from_rib(cls, path: Path) -> "PrefixIndex":
+        """
+        build from a prefix to AS table: "network<tab>length<tab>asn" lines
+        (CAIDA pfx2as format) or "prefix asn" lines; MOAS entries ("1_2")
+        keep their first origin.
+        """
+
+        def pairs():
+            with Path(path).open() as file:
+                for line in file:
+                    fields = line.split()
+                    if len(fields) == 3:
+                        prefix, asn = f"{fields[0]}/{fields[1]}", fields[2]
+                    elif len(fields) == 2:
+                        prefix, asn = fields
+                    else:
+                        continue
+                    asn = asn.split("_")[0].split(",")[0]
+                    if asn.isdigit():
+                        yield prefix, int(asn)
+
+        return cls.from_pairs(pairs())
+
+    def save(self, directory: Path) -> None:
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        np.save(directory / "networks.npy", self.networks)
+        np.save(directory / "asns.npy", self.asns)
+        np.save(directory / "length_starts.npy", self.length_starts)
+
+    @classmethod
+    def load(cls, directory: Path) -> "PrefixIndex":
+        directory = Path(directory)
+        return cls(
+            networks=np.load(directory / "networks.npy", mmap_mode="r"),
+            asns=np.load(directory / "asns.npy", mmap_mode="r"),
+            length_starts=np.load(directory / "length_starts.npy"),
+        )
+
+    def lookup(self, addresses: np.ndarray) -> tuple:
+        """
+        return (asn, prefix_length) arrays for IPv4 addresses as uint32
+
+        unmatched addresses (and 0, our missing address) get UNKNOWN_ASN and
+        a prefix length of -1.
+        """
+        addresses = np.asarray(addresses, dtype=np.uint32)
+
+        # hop addresses repeat a lot: only look up distinct ones, which also
+        # sorts the needles (cache friendly searchsorted, kept sorted by masking)
+        addresses, inverse = np.unique(addresses, return_inverse=True)
+
+        asn = np.full(len(addresses), UNKNOWN_ASN, dtype=np.int64)
+        prefix_length = np.full(len(addresses), -1, dtype=np.int8)
+        pending = np.flatnonzero(addresses != 0)
+
+        for length in range(32, -1, -1):
+            start, end = self.length_starts[length], self.length_starts[length + 1]
+            if start == end or not len(pending):
+                continue
+
+            mask = np.uint32((0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF)
+            networks = self.networks[start:end]
+            keys = addresses[pending] & mask
+
+            position = np.searchsorted(networks, keys)
+            position = np.minimum(position, len(networks) - 1)
+            found = networks[position] == keys
+
+            matched = pending[found]
+            asn[matched] = self.asns[start:end][position[found]]
+            prefix_length[matched] = length
+            pending = pending[~found]
+
+        return asn[inverse], prefix_length[inverse]
+
+    def lookup_addresses(self, addresses: Iterable[str]) -> tuple:
+        """same as lookup, for dotted-quad strings"""
+        return self.lookup(np.fromiter((ip_to_int(a) for a in addresses), dtype=np.uint32))
+
+    def annotate(self, columns: dict) -> dict:
+        """add the ASN and matched prefix length of each reply to store columns"""
+        asn, prefix_length = self.lookup(columns["from"])
+        return {**columns, "asn": asn, "prefix_length": prefix_length}
+
+    def __len__(self) -> int:
+        return len(self.networks)
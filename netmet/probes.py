@@ -0,0 +1,63 @@
+"""crawl RIPE Atlas probe listings, following every page of results"""
+import math
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+from common.logger_config import logger
+
+from netmet.client import AtlasClient, get_client
+
+
+PROBES_PATH = "probes/"
+
+# the API refuses page sizes above 500
+MAX_PAGE_SIZE = 500
+
+
+def iter_probes(
+    params: dict,
+    client: Optional[AtlasClient] = None,
+    max_workers: int = 8,
+    page_size: int = MAX_PAGE_SIZE,
+) -> Iterator[dict]:
+    """
+    yield every probe matching params, not only the first page
+
+    the first page gives the total count, from which all remaining page
+    numbers are computed and fetched concurrently over the client's
+    keep-alive connection pool. Pages are yielded in order as soon as they
+    are available. If the API does not return a count, we fall back on
+    following next links.
+    """
+    client = client or get_client()
+    params = {**params, "page_size": min(page_size, MAX_PAGE_SIZE)}
+
+    # 1. first page tells us how many probes (hence pages) to expect
+    first_page = client.get_json(PROBES_PATH, params)
+    yield from first_page.get("results", [])
+
+    count = first_page.get("count")
+    if count is None:
+        # 2a. no count: walk the next links one by one
+        next_url = first_page.get("next")
+        while next_url:
+            page = client.get_json(next_url)
+            yield from page.get("results", [])
+            next_url = page.get("next")
+        return
+
+    nb_pages = math.ceil(count / params["page_size"])
+    logger.info(f"crawling {count} probes over {nb_pages} pages")
+
+    # 2b. fetch every other page concurrently, keeping page order
+    page_params = [{**params, "page": page} for page in range(2, nb_pages + 1)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pages = executor.map(lambda p: client.get_json(PROBES_PATH, p), page_params)
+        for page in pages:
+            yield from page.get("results", [])
+
+
+def get_all_probes(params: dict, **kwargs) -> list:
+    """return the complete list of probes matching params"""
+    return list(iter_probes(params, **kwargs))
@@ -0,0 +1,221 @@
+"""in-memory probe registry, indexed for constant time selection"""
+import random
+
+from collections.abc import Mapping
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, Optional
+
+from common.file_utils import load_json
+from common.logger_config import logger
+
+
+class Probe(Mapping):
+    """
+    compact probe record: everything we use from the API, without the tags
+
+    probes are read-only mappings of their fields, so code written for the
+    API probe dicts keeps working (probe["id"], get, in, dict(probe));
+    json.dumps takes dict(probe). Unlike the API records, status holds the
+    status name and geometry is split into longitude and latitude.
+    """
+
+    __slots__ = (
+        "id",
+        "address_v4",
+        "asn_v4",
+        "prefix_v4",
+        "country_code",
+        "longitude",
+        "latitude",
+        "status",
+        "status_since",
+        "last_connected",
+    )
+
+    def __init__(self, record: dict) -> None:
+        coordinates = (record.get("geometry") or {}).get("coordinates") or (None, None)
+        status = record.get("status")
+
+        self.id = record["id"]
+        self.address_v4 = record.get("address_v4")
+        self.asn_v4 = record.get("asn_v4")
+        self.prefix_v4 = record.get("prefix_v4")
+        self.country_code = record.get("country_code")
+        self.longitude, self.latitude = coordinates
+        self.status = status.get("name") if isinstance(status, dict) else status
+        self.status_since = record.get("status_since") or 0
+        self.last_connected = record.get("last_connected") or 0
+
+    def __getitem__(self, key: str):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self) -> int:
+        return len(self.__slots__)
+
+    def __repr__(self) -> str:
+        return (
+            f"Probe(id={self.id}, address_v4={self.address_v4}, "
+            f"asn_v4={self.asn_v4}, country_code={self.country_code})"
+        )
+
+
+class _IndexedSet:
+    """set supporting O(1) add, remove and uniform random choice"""
+
+    __slots__ = ("items", "positions")
+
+    def __init__(self) -> None:
+        self.items = []
+        self.positions = {}
+
+    def add(self, item) -> None:
+        if item not in self.positions:
+            self.positions[item] = len(self.items)
+            self.items.append(item)
+
+    def remove(self, item) -> None:
+        position = self.positions.pop(item, None)
+        if position is None:
+            return
+        last = self.items.pop()
+        if position < len(self.items):
+            self.items[position] = last
+            self.positions[last] = position
+
+    def choice(self):
+        return random.choice(self.items)
+
+    def __contains__(self, item) -> bool:
+        return item in self.positions
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+INDEXED_FIELDS = ("asn_v4", "prefix_v4", "country_code", "status")
+
+
+class ProbeRegistry:
+    """
+    probes indexed by id, ASN, prefix, country and status
+
+    random picks are O(1); refresh() only downloads probes whose status
+    changed since the last load instead of the whole country set.
+    """
+
+    def __init__(self, records: Iterable[dict] = (), params: Optional[dict] = None) -> None:
+        # API parameters the registry was built from, reused on refresh
+        self.params = params or {}
+
+        self.probes = {}
+        self.ids = _IndexedSet()
+        self.indexes = {field: {} for field in INDEXED_FIELDS}
+        self.watermark = 0
+
+        self.update(records)
+
+    @classmethod
+    def from_file(cls, path: Path, params: Optional[dict] = None) -> "ProbeRegistry":
+        """load a probe dataset, either a probe list or a raw API page"""
+        records = load_json(path)
+        if isinstance(records, dict):
+            records = records.get("results", [])
+
+        return cls(records, params)
+
+    def add(self, record: dict) -> Probe:
+        probe = Probe(record)
+        self.remove(probe.id)
+
+        self.probes[probe.id] = probe
+        self.ids.add(probe.id)
+        for field, index in self.indexes.items():
+            index.setdefault(getattr(probe, field), _IndexedSet()).add(probe.id)
+
+        self.watermark = max(self.watermark, probe.status_since, probe.last_connected)
+
+        return probe
+
+    def remove(self, probe_id: int) -> None:
+        probe = self.probes.pop(probe_id, None)
+        if probe is None:
+            return
+
+        self.ids.remove(probe_id)
+        for field, index in self.indexes.items():
+            index[getattr(probe, field)].remove(probe_id)
+
+    def update(self, records: Iterable[dict]) -> int:
+        nb_updated = 0
+        for record in records:
+            self.add(record)
+            nb_updated += 1
+
+        return nb_updated
+
+    def refresh(self, **kwargs) -> int:
+        """fetch probes connected or changing status since the last load"""
+        # the HTTP stack is only imported by registries that refresh
+        from netmet.probes import iter_probes
+
+        params = {**self.params, "status_since__gte": self.watermark}
+        nb_updated = self.update(iter_probes(params, **kwargs))
+        logger.info(f"probe registry refreshed, {nb_updated} probes updated")
+
+        return nb_updated
+
+    def select(self, **filters) -> list:
+        """ids of probes matching every field=value filter"""
+        if not filters:
+            return list(self.ids.items)
+
+        candidates = [self.indexes[field].get(value, ()) for field, value in filters.items()]
+        smallest = min(candidates, key=len)
+
+        return [
+            probe_id
+            for probe_id in getattr(smallest, "items", ())
+            if all(probe_id in candidate for candidate in candidates)
+        ]
+
+    def random(self, **filters) -> Optional[Probe]:
+        """
+        one uniformly random probe matching filters (e.g. status="Connected")
+
+        draws from the smallest matching index and rejects the few mismatches,
+        so a pick does not depend on the registry size.
+        """
+        if not filters:
+            return self.probes[self.ids.choice()] if len(self.ids) else None
+
+        candidates = [self.indexes[field].get(value) for field, value in filters.items()]
+        if not all(candidates):
+            return None
+        smallest = min(candidates, key=len)
+
+        for _ in range(32):
+            probe_id = smallest.choice()
+            if all(probe_id in candidate for candidate in candidates):
+                return self.probes[probe_id]
+
+        # very selective filter combination: fall back on a full scan
+        matching = self.select(**filters)
+        return self.probes[random.choice(matching)] if matching else None
+
+    def __len__(self) -> int:
+        return len(self.probes)
+
+    def __iter__(self):
+        return iter(self.probes.values())
+
+
+@lru_cache(maxsize=None)
+def get_registry(path: Path) -> ProbeRegistry:
+    """load a probe dataset once per process"""
+    return ProbeRegistry.from_file(path)
@@ -0,0 +1,135 @@
+"""diversity-aware sampling of (vp, target) pairs"""
+import heapq
+import math
+import random
+
+from collections import Counter
+from pathlib import Path
+from typing import Iterable, Optional
+
+from netmet.ledger import Ledger
+from netmet.registry import Probe, ProbeRegistry
+
+
+def measured_pairs(ledger_path: Path) -> set:
+    """(vp_id, target_addr) pairs already submitted according to a results ledger"""
+    ledger = Ledger(ledger_path)
+    ledger.refresh()
+
+    return {(vp_id, target_addr) for vp_id, target_addr, *_ in ledger.by_key}
+
+
+class _Strata:
+    """
+    probes of a registry stratified by ASN, drawn least covered first
+
+    ASNs are picked from a heap ordered by how many times they were used;
+    inside an ASN, a few distinct usable probes are drawn and the one whose
+    prefix and geographic cell are the least covered wins. The usable probes
+    of an ASN are listed the first time it comes up, later picks cost
+    O(log #ASN) whatever the number of probes.
+    """
+
+    def __init__(
+        self,
+        registry: ProbeRegistry,
+        nb_candidates: int = 8,
+        cell_degrees: float = 1.0,
+        status: Optional[str] = "Connected",
+    ) -> None:
+        self.registry = registry
+        self.nb_candidates = nb_candidates
+        self.cell_degrees = cell_degrees
+        self.status = status
+
+        self.prefix_uses = Counter()
+        self.cell_uses = Counter()
+        self.usable_ids = {}
+        self.heap = [
+            (0, random.random(), asn)
+            for asn, probe_ids in registry.indexes["asn_v4"].items()
+            if asn is not None and len(probe_ids)
+        ]
+        heapq.heapify(self.heap)
+
+    def _cell(self, probe: Probe) -> tuple:
+        if probe.latitude is None or probe.longitude is None:
+            return None
+        return (
+            math.floor(probe.latitude / self.cell_degrees),
+            math.floor(probe.longitude / self.cell_degrees),
+        )
+
+    def _usable(self, probe: Probe) -> bool:
+        return bool(probe.address_v4) and (self.status is None or probe.status == self.status)
+
+    def pick(self) -> Optional[Probe]:
+        while self.heap:
+            uses, _, asn = heapq.heappop(self.heap)
+            if asn not in self.usable_ids:
+                self.usable_ids[asn] = [
+                    probe_id
+                    for probe_id in self.registry.indexes["asn_v4"][asn].items
+                    if self._usable(self.registry.probes[probe_id])
+                ]
+            usable_ids = self.usable_ids[asn]
+            if not usable_ids:
+                # no usable probe in this ASN: give up on it
+                continue
+
+            candidates = [
+                self.registry.probes[probe_id]
+                for probe_id in random.sample(usable_ids, min(self.nb_candidates, len(usable_ids)))
+            ]
+
+            probe = min(
+                candidates,
+                key=lambda p: (self.prefix_uses[p.prefix_v4], self.cell_uses[self._cell(p)]),
+            )
+            self.prefix_uses[probe.prefix_v4] += 1
+            self.cell_uses[self._cell(probe)] += 1
+            heapq.heappush(self.heap, (uses + 1, random.random(), asn))
+
+            return probe
+
+        return None
+
+
+def sample_pairs(
+    vps: ProbeRegistry,
+    targets: ProbeRegistry,
+    k: int,
+    measured: Iterable[tuple] = (),
+    max_attempts: Optional[int] = None,
+    **strata_kwargs,
+) -> list:
+    """
+    draw k (vp, target) pairs covering as many ASNs, prefixes and places as possible
+
+    pairs in measured, as (vp_id, target_addr), are never drawn again,
+    e.g. measured_pairs(ledger_path) to avoid paying twice for the same path.
+    Fewer than k pairs are returned when the registries run out of new pairs.
+    """
+    vp_strata = _Strata(vps, **strata_kwargs)
+    target_strata = _Strata(targets, **strata_kwargs)
+
+    seen = set(measured)
+    pairs = []
+    max_attempts = max_attempts or 10 * k
+    for _ in range(max_attempts):
+        if len(pairs) >= k:
+            break
+
+        vp = vp_strata.pick()
+        target = target_strata.pick()
+        if vp is None or target is None:
+            break
+
+        key = (vp.id, target.address_v4)
+        if key in seen:
+            continue
+
+        seen.add(key)
+        pairs.append((vp, target))
+
+    return pairs
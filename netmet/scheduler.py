@@ -0,0 +1,282 @@
+"""schedule traceroute campaigns as packed RIPE Atlas measurement requests"""
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+import requests
+
+from common.logger_config import logger
+
+from netmet.admission import AdmissionController, BudgetExhausted
+from netmet.client import AtlasClient
+from netmet.ledger import Ledger
+from netmet.metrics import metrics
+
+
+MEASUREMENTS_PATH = "measurements/"
+
+# API limits, see https://atlas.ripe.net/docs/apis/rest-api-manual/
+MAX_DEFINITIONS_PER_REQUEST = 100
+MAX_PROBES_PER_MEASUREMENT = 1000
+MAX_CONCURRENT_MEASUREMENTS = 100
+
+# measurement status ids that still count against the concurrency limit
+RUNNING_STATUSES = "0,1,2"  # specified, scheduled, ongoing
+
+
+def build_definition(
+    target_addr: str,
+    port: int,
+    protocol: str,
+    measurement_type: str = "traceroute",
+    packets: int = 3,
+    size: int = 48,
+    paris: Optional[int] = None,
+) -> dict:
+    """
+    return one measurement definition, as sent by exo5_perform_measurement
+
+    paris sets the number of paris traceroute variations (0 disables them),
+    the API default is used when it is None.
+    """
+    definition = {
+        "target": target_addr,
+        "af": 4,
+        "packets": packets,
+        "size": size,
+        "tags": ["netmethr"],
+        "description": "Netmet",
+        "resolve_on_probe": False,
+        "skip_dns_check": True,
+        "include_probe_id": False,
+        "port": port,
+        "type": measurement_type,
+        "protocol": protocol,
+    }
+    if paris is not None:
+        definition["paris"] = paris
+
+    return definition
+
+
+def build_probes(vp_ids: list) -> list:
+    """return the probe specification selecting exactly the given vps"""
+    return [
+        {
+            "type": "probes",
+            "value": ",".join(str(vp_id) for vp_id in vp_ids),
+            "requested": len(vp_ids),
+        }
+    ]
+
+
+def _chunks(items: list, size: int) -> Iterator[list]:
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def pack_pairs(
+    pairs: Iterable[tuple],
+    max_definitions: int = MAX_DEFINITIONS_PER_REQUEST,
+    max_probes: int = MAX_PROBES_PER_MEASUREMENT,
+) -> list:
+    """
+    pack (vp_id, target_addr) pairs into as few requests as possible
+
+    a request carries several definitions (one per target) that all run on
+    the same probe set. Targets are therefore grouped by the set of vps that
+    must reach them, and each group is split along the API limits.
+    Duplicate pairs are dropped. Returns a list of (target_addrs, vp_ids).
+    A target may be any hashable describing one definition, e.g. a
+    (target_addr, protocol, port, paris) variant.
+    """
+    vps_per_target = {}
+    for vp_id, target_addr in pairs:
+        vps_per_target.setdefault(target_addr, set()).add(vp_id)
+
+    targets_per_vp_set = {}
+    for target_addr, vp_ids in vps_per_target.items():
+        key = tuple(sorted(vp_ids))
+        targets_per_vp_set.setdefault(key, []).append(target_addr)
+
+    packed = []
+    for vp_ids, target_addrs in targets_per_vp_set.items():
+        for vp_chunk in _chunks(list(vp_ids), max_probes):
+            for target_chunk in _chunks(target_addrs, max_definitions):
+                packed.append((target_chunk, vp_chunk))
+
+    return packed
+
+
+class CampaignScheduler:
+    """submit packed measurement requests under the API rate, credit and concurrency limits"""
+
+    def __init__(
+        self,
+        credentials: dict,
+        client: Optional[AtlasClient] = None,
+        min_interval: float = 1.0,
+        max_concurrent: int = MAX_CONCURRENT_MEASUREMENTS,
+        poll_interval: float = 30.0,
+        admission: Optional[AdmissionController] = None,
+    ) -> None:
+        self.credentials = credentials
+        self.client = client or AtlasClient(api_key=credentials["secret_key"])
+        self.admission = admission or AdmissionController(
+            max_concurrent=max_concurrent,
+            requests_per_second=1.0 / min_interval if min_interval else None,
+            poll_interval=poll_interval,
+        )
+        if self.admission.running_measurements is None:
+            self.admission.running_measurements = self._running_measurements
+
+    def _running_measurements(self) -> int:
+        """number of our measurements still counting against the concurrency cap"""
+        response = self.client.get_json(
+            f"{MEASUREMENTS_PATH}my/",
+            params={"status__in": RUNNING_STATUSES, "page_size": 1},
+        )
+
+        return response.get("count", 0)
+
+    def post(self, json_params: dict) -> list:
+        """
+        post one request once admitted and return the measurement ids
+
+        429 answers are retried by the client, honouring Retry-After; an
+        answer without measurement ids raises a RuntimeError with the API error.
+        """
+        cost = self.admission.admit(json_params)
+        response = self.client.post_json(MEASUREMENTS_PATH, json_params)
+
+        if "measurements" not in response:
+            raise RuntimeError(f"measurement request refused: {response.get('error', response)}")
+        self.admission.record(json_params, cost)
+
+        return response["measurements"]
+
+    def submit(
+        self,
+        pairs: Iterable[tuple],
+        port: int,
+        protocol: str,
+        output_file_path: Path,
+        measurement_type: str = "traceroute",
+        paris: Optional[int] = None,
+        **definition_kwargs,
+    ) -> Iterator[dict]:
+        """submit one measurement per (vp_id, target_addr) pair, for one variant"""
+        return self.submit_variants(
+            pairs,
+            [(protocol, port, paris)],
+            output_file_path,
+            measurement_type,
+            **definition_kwargs,
+        )
+
+    def submit_variants(
+        self,
+        pairs: Iterable[tuple],
+        variants: Iterable[tuple],
+        output_file_path: Path,
+        measurement_type: str = "traceroute",
+        **definition_kwargs,
+    ) -> Iterator[dict]:
+        """
+        submit one measurement per (vp_id, target_addr) pair and per
+        (protocol, port, paris) variant, in packed requests
+
+        the definitions of every variant of a target share its vps, so they
+        travel in the same requests. Each request is appended to the ledger
+        at output_file_path; measurements the ledger already holds are
+        skipped, so an interrupted campaign can be resumed without paying twice.
+
+        submission stops early, leaving the remaining pairs for a later run,
+        when the credit budget is exhausted or the API refuses a request
+        (e.g. not enough credits left on the account).
+        """
+        ledger = Ledger(output_file_path)
+        ledger.refresh()
+        variants = list(dict.fromkeys(variants))
+        pending = [
+            (vp_id, (target_addr, *variant))
+            for vp_id, target_addr in dict.fromkeys(pairs)
+            for variant in variants
+            if (vp_id, target_addr, *variant) not in ledger.by_key
+        ]
+
+        # a request never holds more measurements than may run at once
+        packed = pack_pairs(
+            pending,
+            max_definitions=min(MAX_DEFINITIONS_PER_REQUEST, self.admission.max_concurrent),
+        )
+        for nb_sent, (measured, vp_ids) in enumerate(packed):
+            metrics.set("scheduler_queued_requests", len(packed) - nb_sent)
+            json_params = {
+                "definitions": [
+                    build_definition(
+                        target_addr,
+                        port,
+                        protocol,
+                        measurement_type,
+                        paris=paris,
+                        **definition_kwargs,
+                    )
+                    for target_addr, protocol, port, paris in measured
+                ],
+                "probes": build_probes(vp_ids),
+                "is_oneoff": True,
+                "bill_to": self.credentials["username"],
+            }
+
+            try:
+                measurement_ids = self.post(json_params)
+            except BudgetExhausted as error:
+                logger.info(f"credit budget exhausted, stopping submission: {error}")
+                return
+            except requests.HTTPError as error:
+                if error.response is None or error.response.status_code >= 500:
+                    raise
+                logger.error(
+                    f"measurement request refused ({error.response.status_code}), "
+                    f"stopping submission: {error.response.text[:500]}"
+                )
+                return
+
+            measurement = {
+                "measurement_id": measurement_ids,
+                "measurement_description": json_params,
+            }
+            logger.info(
+                f"submitted {len(measured)} definitions x {len(vp_ids)} vps: "
+                f"{measurement_ids}"
+            )
+            ledger.append(measurement)
+            metrics.inc("measurements_submitted", len(measurement_ids))
+            metrics.set("scheduler_queued_requests", len(packed) - nb_sent - 1)
+
+            yield measurement
+
+
+def submit_campaign(
+    targets: list,
+    vps: list,
+    port: int,
+    protocol: str,
+    output_file_path: Path,
+    credentials: dict,
+    measurement_type: str = "traceroute",
+) -> list:
+    """measure every target from every vp (probe records as in the datasets)"""
+    pairs = [(vp["id"], target["address_v4"]) for vp in vps for target in targets]
+
+    scheduler = CampaignScheduler(credentials)
+
+    return list(
+        scheduler.submit(
+            pairs,
+            port=port,
+            protocol=protocol,
+            output_file_path=output_file_path,
+            measurement_type=measurement_type,
+        )
+    )
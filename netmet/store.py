@@ -0,0 +1,223 @@
+"""columnar on-disk store of flattened traceroute replies"""
+import ipaddress
+import json
+import os
+
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, Optional
+
+import numpy as np
+
+
+# one row per reply (or per hop when the hop has no reply at all)
+COLUMNS = {
+    "msm_id": np.int64,
+    "prb_id": np.int32,
+    "timestamp": np.int64,
+    "dst": np.uint32,
+    "hop": np.int16,
+    "reply": np.int16,
+    "from": np.uint32,
+    "rtt": np.float32,
+    "ttl": np.int16,
+    "size": np.int32,
+    "timeout": np.bool_,
+}
+
+
+# the same router addresses come back in every reply of every traceroute
+@lru_cache(maxsize=1 << 16)
+def ip_to_int(address: Optional[str]) -> int:
+    """IPv4 address as an integer, 0 when missing or not IPv4"""
+    try:
+        return int(ipaddress.IPv4Address(address))
+    except (ipaddress.AddressValueError, ValueError):
+        return 0
+
+
+def int_to_ip(value: int) -> str:
+    return str(ipaddress.IPv4Address(int(value)))
+
+
+def flatten_traceroutes(traceroutes: Iterable[dict]) -> dict:
+    """
+    flatten RIPE Atlas traceroute results into columns
+
+    each reply of result[].result[] becomes one row; "*" replies and hops
+    reporting an error are kept as rows with the timeout flag set.
+    """
+    rows = []
+    for traceroute in traceroutes:
+        msm_id = traceroute.get("msm_id", 0)
+        prb_id = traceroute.get("prb_id", 0)
+        timestamp = traceroute.get("timestamp", 0)
+        dst = ip_to_int(traceroute.get("dst_addr"))
+
+        for hop in traceroute.get("result") or []:
+            replies = hop.get("result") or [{"x": "*"}]
+            for reply_index, reply in enumerate(replies):
+                rtt = reply.get("rtt")
+                rows.append(
+                    (
+                        msm_id,
+                        prb_id,
+                        timestamp,
+                        dst,
+                        hop.get("hop", 0),
+                        reply_index,
+                        ip_to_int(reply.get("from")),
+                        np.nan if rtt is None else rtt,
+                        reply.get("ttl", 0),
+                        reply.get("size", 0),
+                        rtt is None,
+                    )
+                )
+
+    columns = {}
+    for index, (name, dtype) in enumerate(COLUMNS.items()):
+        columns[name] = np.fromiter((row[index] for row in rows), dtype=dtype, count=len(rows))
+
+    return columns
+
+
+class TracerouteStore:
+    """
+    append-only columnar store, one .npy file per column and per segment
+
+    every append writes a new segment; index.json records, for each segment,
+    its row count and the measurement ids it holds so that loads can skip
+    segments outside the requested measurement range. Columns are memory
+    mapped, so only the columns a query asks for are read from disk.
+    empty.json lists the measurements collected without a single traceroute
+    row, so that they are not fetched again.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        self._index_path = self.root / "index.json"
+        self.segments = (
+            json.loads(self._index_path.read_text()) if self._index_path.exists() else []
+        )
+        self._next_segment = 1 + max((int(segment["name"]) for segment in self.segments), default=-1)
+
+        self._empty_path = self.root / "empty.json"
+        self.empty_msm_ids = (
+            set(json.loads(self._empty_path.read_text())) if self._empty_path.exists() else set()
+        )
+
+    def _save_index(self) -> None:
+        tmp_path = self._index_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.segments))
+        os.replace(tmp_path, self._index_path)
+
+    @property
+    def last_segment(self) -> int:
+        """number of the newest segment, -1 for an empty store"""
+        return self._next_segment - 1
+
+    def measurement_ids(self) -> set:
+        """measurements in the store, those recorded empty included"""
+        return {
+            msm_id for segment in self.segments for msm_id in segment["msm_ids"]
+        } | self.empty_msm_ids
+
+    def add_empty(self, msm_ids: Iterable[int]) -> None:
+        """record measurements that have no traceroute row to store"""
+        msm_ids = set(msm_ids) - self.empty_msm_ids
+        if not msm_ids:
+            return
+
+        self.empty_msm_ids |= msm_ids
+        tmp_path = self._empty_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(sorted(self.empty_msm_ids)))
+        os.replace(tmp_path, self._empty_path)
+
+    def append_columns(self, columns: dict) -> None:
+        """write already flattened columns as a new segment"""
+        nb_rows = len(columns["msm_id"])
+        if not nb_rows:
+            return
+
+        name = f"{self._next_segment:06d}"
+        self._next_segment += 1
+        segment_dir = self.root / name
+        segment_dir.mkdir(exist_ok=True)
+        for column, dtype in COLUMNS.items():
+            np.save(segment_dir / f"{column}.npy", np.asarray(columns[column], dtype=dtype))
+
+        msm_ids = np.unique(columns["msm_id"])
+        self.segments.append(
+            {
+                "name": name,
+                "rows": nb_rows,
+                "msm_min": int(msm_ids[0]),
+                "msm_max": int(msm_ids[-1]),
+                "msm_ids": msm_ids.tolist(),
+            }
+        )
+        self._save_index()
+
+    def append(self, traceroutes: Iterable[dict]) -> None:
+        """flatten a batch of traceroute results and append it"""
+        self.append_columns(flatten_traceroutes(traceroutes))
+
+    def load(
+        self,
+        columns: Optional[Iterable[str]] = None,
+        msm_min: Optional[int] = None,
+        msm_max: Optional[int] = None,
+        after_segment: Optional[int] = None,
+    ) -> dict:
+        """
+        return the requested columns for measurements in [msm_min, msm_max]
+
+        with after_segment, only segments appended after that one are read,
+        which lets incremental consumers process new data only.
+        """
+        columns = list(columns or COLUMNS)
+        filtered = msm_min is not None or msm_max is not None
+        low = msm_min if msm_min is not None else np.iinfo(np.int64).min
+        high = msm_max if msm_max is not None else np.iinfo(np.int64).max
+
+        parts = {column: [] for column in columns}
+        for segment in self.segments:
+            if segment["msm_max"] < low or segment["msm_min"] > high:
+                continue
+            if after_segment is not None and int(segment["name"]) <= after_segment:
+                continue
+
+            segment_dir = self.root / segment["name"]
+            mask = None
+            if filtered and not (low <= segment["msm_min"] and segment["msm_max"] <= high):
+                msm_id = np.load(segment_dir / "msm_id.npy", mmap_mode="r")
+                mask = (msm_id >= low) & (msm_id <= high)
+
+            for column in columns:
+                values = np.load(segment_dir / f"{column}.npy", mmap_mode="r")
+                parts[column].append(values if mask is None else values[mask])
+
+        return {
+            column: np.concatenate(parts[column])
+            if parts[column]
+            else np.empty(0, dtype=COLUMNS[column])
+            for column in columns
+        }
+
+    def compact(self) -> None:
+        """merge every segment into a single one"""
+        if len(self.segments) <= 1:
+            return
+
+        old_segments = self.segments
+        columns = self.load()
+        self.segments = []
+        self.append_columns({column: np.array(values) for column, values in columns.items()})
+
+        for segment in old_segments:
+            segment_dir = self.root / segment["name"]
+            for column in COLUMNS:
+                (segment_dir / f"{column}.npy").unlink(missing_ok=True)
+            segment_dir.rmdir()
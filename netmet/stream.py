@@ -0,0 +1,133 @@
+"""decode large measurement result downloads one result at a time"""
+import codecs
+import json
+
+from itertools import chain, islice
+from typing import Callable, Iterable, Iterator, Optional, Union
+
+from netmet.cache import IMMUTABLE, HttpCache
+from netmet.client import AtlasClient, get_client
+from netmet.metrics import metrics
+
+
+CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator:
+    """
+    yield the elements of a JSON array read from byte chunks
+
+    only the element being decoded is kept in memory, never the whole array.
+    """
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    started = False
+    chunks = iter(chunks)
+    exhausted = False
+
+    while True:
+        # 1. skip whitespace, the opening bracket and separators
+        while position < len(buffer) and buffer[position] in _WHITESPACE + ",":
+            position += 1
+        if not started and position < len(buffer):
+            if buffer[position] != "[":
+                raise ValueError("expected a JSON array")
+            started = True
+            position += 1
+            continue
+        if started and position < len(buffer) and buffer[position] == "]":
+            return
+
+        # 2. decode the next element once it is complete
+        if position < len(buffer):
+            try:
+                element, end = _decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                element, end = None, None
+
+            # a value ending on the buffer boundary may be truncated (e.g. a number)
+            if end is not None and (end < len(buffer) or exhausted):
+                yield element
+                position = end
+                continue
+
+        if exhausted:
+            if buffer[position:].strip():
+                raise ValueError("truncated JSON array")
+            return
+
+        # 3. need more data
+        try:
+            buffer = buffer[position:] + utf8.decode(next(chunks))
+        except StopIteration:
+            buffer = buffer[position:] + utf8.decode(b"", final=True)
+            exhausted = True
+        position = 0
+
+
+def iter_ndjson(chunks: Iterable[bytes]) -> Iterator:
+    """yield the JSON documents of newline delimited byte chunks"""
+    pending = b""
+    for chunk in chunks:
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+    if pending.strip():
+        yield json.loads(pending)
+
+
+def iter_results(
+    result_url: str,
+    limit: Optional[int] = None,
+    client: Optional[AtlasClient] = None,
+    chunk_size: int = CHUNK_SIZE,
+    cache: Optional[HttpCache] = None,
+    ttl: Union[float, Callable[[object], float]] = IMMUTABLE,
+) -> Iterator[dict]:
+    """
+    yield the probe results of a measurement one by one, with bounded memory
+
+    results are requested as NDJSON (format=txt, one result per line); when
+    the server answers a plain JSON array instead, it is decoded incrementally.
+    With limit, the download stops after the first limit results.
+
+    With cache, the whole result list is read through it instead and kept
+    for ttl seconds (see measurement_ttl): the results of a stopped
+    measurement are then downloaded once, at the cost of bounded memory.
+    """
+    if cache is not None:
+        results = cache.get_json(result_url, ttl=ttl)
+        metrics.inc("results_decoded", len(results) if limit is None else min(limit, len(results)))
+        yield from islice(results, limit)
+        return
+
+    client = client or get_client()
+
+    with client.get(result_url, params={"format": "txt"}, stream=True) as response:
+        response.raise_for_status()
+
+        # servers ignoring format=txt answer a plain JSON array
+        chunks = (chunk for chunk in response.iter_content(chunk_size) if chunk)
+        first_chunk = next(chunks, b"")
+        chunks = chain([first_chunk], chunks)
+
+        if first_chunk.lstrip().startswith(b"["):
+            results = iter_json_array(chunks)
+        else:
+            results = iter_ndjson(chunks)
+
+        # streamed bodies have no Content-Length: count what is decoded
+        nb_results = 0
+        try:
+            for result in islice(results, limit):
+                nb_results += 1
+                yield result
+        finally:
+            metrics.inc("results_decoded", nb_results)
@@ -0,0 +1,168 @@
+"""
+measure the same pairs with a grid of protocols, ports and paris ids
+
+each (protocol, port, paris) variant of a pair may follow a different path
+through load balancers: the sweep submits every variant in the same packed
+requests, and SweepResult lines up their hops for side by side comparison.
+"""
+from itertools import product
+from typing import Iterable, Optional
+
+import numpy as np
+
+from netmet.analysis import _boundaries, responding_hops
+from netmet.ledger import Ledger
+from netmet.store import flatten_traceroutes, int_to_ip
+
+
+def sweep_variants(
+    protocols: Iterable[str],
+    ports: Iterable[int],
+    paris: Iterable[Optional[int]] = (None,),
+) -> list:
+    """every (protocol, port, paris) combination, in grid order"""
+    return list(product(protocols, ports, paris))
+
+
+def variant_label(variant: tuple) -> str:
+    """short name of a variant, e.g. UDP:33434 or UDP:33434/paris=16"""
+    protocol, port, paris = variant
+    label = f"{protocol}:{port}"
+
+    return label if paris is None else f"{label}/paris={paris}"
+
+
+class SweepResult:
+    """
+    the latest traceroute of each variant of each (vp_id, target_addr) pair
+
+    hops[(vp_id, target_addr)][(protocol, port, paris)] = {hop: (address, rtt_min)}
+    only responding hops are kept, a hop missing from a variant did not answer.
+    """
+
+    def __init__(self, hops: dict) -> None:
+        self.hops = hops
+
+    @classmethod
+    def from_columns(cls, columns: dict, ledger: Ledger) -> "SweepResult":
+        """build from traceroute columns (see flatten_traceroutes) and the campaign ledger"""
+        hops = responding_hops(columns)
+        variants = ledger.variants()
+
+        starts = _boundaries(hops["msm_id"], hops["prb_id"], hops["timestamp"])
+        ends = np.append(starts[1:], len(hops["hop"]))
+
+        grouped = {}
+        timestamps = {}
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            variant = variants.get(int(hops["msm_id"][start]))
+            if variant is None:
+                continue
+            pair = (int(hops["prb_id"][start]), int_to_ip(hops["dst"][start]))
+            timestamp = int(hops["timestamp"][start])
+            if timestamps.get((pair, variant), -1) >= timestamp:
+                continue
+
+            timestamps[(pair, variant)] = timestamp
+            grouped.setdefault(pair, {})[variant] = {
+                hop: (int_to_ip(address), rtt)
+                for hop, address, rtt in zip(
+                    hops["hop"][start:end].tolist(),
+                    hops["address"][start:end].tolist(),
+                    hops["rtt_min"][start:end].tolist(),
+                )
+            }
+
+        return cls(grouped)
+
+    @classmethod
+    def from_results(cls, results: Iterable[dict], ledger: Ledger) -> "SweepResult":
+        """build from raw RIPE Atlas traceroute results"""
+        return cls.from_columns(flatten_traceroutes(results), ledger)
+
+    def pairs(self) -> list:
+        return sorted(self.hops)
+
+    def variants(self) -> list:
+        """every variant measured for at least one pair"""
+        return sorted(
+            {variant for per_variant in self.hops.values() for variant in per_variant},
+            # the API default (None) first
+            key=lambda variant: tuple(-1 if part is None else part for part in variant),
+        )
+
+    def aligned(self, vp_id: int, target_addr: str) -> tuple:
+        """
+        return (variants, rows) for one pair
+
+        each row is (hop, addresses) with one address per variant, None
+        where that variant got no reply at this hop.
+        """
+        per_variant = self.hops.get((vp_id, target_addr), {})
+        variants = [variant for variant in self.variants() if variant in per_variant]
+        hop_numbers = sorted({hop for hops in per_variant.values() for hop in hops})
+
+        rows = [
+            (
+                hop,
+                [
+                    per_variant[variant][hop][0] if hop in per_variant[variant] else None
+                    for variant in variants
+                ],
+            )
+            for hop in hop_numbers
+        ]
+
+        return variants, rows
+
+    def divergent_hops(self) -> list:
+        """
+        hops answered by different addresses depending on the variant
+
+        this is the footprint of per-flow load balancing (ECMP) between the
+        vp and the target: one entry per (pair, hop), with the address seen
+        by each variant.
+        """
+        divergent = []
+        for vp_id, target_addr in self.pairs():
+            variants, rows = self.aligned(vp_id, target_addr)
+            for hop, addresses in rows:
+                if len({address for address in addresses if address is not None}) > 1:
+                    divergent.append(
+                        {
+                            "prb_id": vp_id,
+                            "dst": target_addr,
+                            "hop": hop,
+                            "addresses": {
+                                variant_label(variant): address
+                                for variant, address in zip(variants, addresses)
+                                if address is not None
+                            },
+                        }
+                    )
+
+        return divergent
+
+    def summary(self) -> dict:
+        divergent = self.divergent_hops()
+
+        return {
+            "nb_pairs": len(self.hops),
+            "variants": [variant_label(variant) for variant in self.variants()],
+            "nb_divergent_hops": len(divergent),
+            "nb_divergent_pairs": len({(hop["prb_id"], hop["dst"]) for hop in divergent}),
+        }
+
+    def format(self, vp_id: int, target_addr: str) -> str:
+        """the hops of every variant of one pair side by side, one line per hop"""
+        variants, rows = self.aligned(vp_id, target_addr)
+        header = ["hop", *(variant_label(variant) for variant in variants)]
+        lines = [header] + [
+            [str(hop), *(address or "*" for address in addresses)] for hop, addresses in rows
+        ]
+        widths = [max(len(line[column]) for line in lines) for column in range(len(header))]
+
+        return "\n".join(
+            "  ".join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip()
+            for line in lines
+        )
@@ -0,0 +1,161 @@
+"""IP and AS level topology built from many traceroutes"""
+import numpy as np
+
+from netmet.analysis import responding_hops
+from netmet.prefixes import UNKNOWN_ASN, PrefixIndex
+from netmet.store import int_to_ip
+
+
+def _hop_links(columns: dict) -> tuple:
+    """
+    (src, dst, rtt_delta) address links between consecutive responding hops
+
+    each hop is represented by its first responding reply; hops without any
+    reply are skipped, so the link joins the hops around them.
+    """
+    hops = responding_hops(columns)
+    msm_id, prb_id, timestamp = hops["msm_id"], hops["prb_id"], hops["timestamp"]
+
+    # consecutive hops of the same traceroute
+    linked = (
+        (msm_id[1:] == msm_id[:-1])
+        & (prb_id[1:] == prb_id[:-1])
+        & (timestamp[1:] == timestamp[:-1])
+    )
+    src = hops["address"][:-1][linked]
+    dst = hops["address"][1:][linked]
+    rtt_delta = (hops["rtt_min"][1:] - hops["rtt_min"][:-1])[linked]
+
+    keep = src != dst
+    return src[keep], dst[keep], rtt_delta[keep]
+
+
+class TopologyGraph:
+    """
+    deduplicated directed graph of links seen in traceroutes
+
+    nodes are IPv4 addresses numbered in order of discovery; edges are kept
+    as a sorted array of (src << 32 | dst) keys with aligned traversal
+    counts and rtt delta sums, merged batch by batch as results stream in.
+    The AS level graph is derived by mapping nodes through a PrefixIndex.
+    """
+
+    def __init__(self) -> None:
+        self.nodes = np.empty(0, dtype=np.uint32)
+        self._sorted_nodes = np.empty(0, dtype=np.uint32)
+        self._sorted_ids = np.empty(0, dtype=np.int64)
+
+        self.edge_keys = np.empty(0, dtype=np.int64)
+        self.edge_counts = np.empty(0, dtype=np.int64)
+        self.edge_rtt_sum = np.empty(0, dtype=np.float64)
+        self.edge_rtt_min = np.empty(0, dtype=np.float64)
+
+    def _node_ids(self, addresses: np.ndarray) -> np.ndarray:
+        """ids of addresses, numbering the new ones"""
+        unique, inverse = np.unique(addresses, return_inverse=True)
+
+        position = np.searchsorted(self._sorted_nodes, unique)
+        position = np.minimum(position, max(len(self._sorted_nodes) - 1, 0))
+        known = (
+            self._sorted_nodes[position] == unique
+            if len(self._sorted_nodes)
+            else np.zeros(len(unique), dtype=bool)
+        )
+
+        ids = np.empty(len(unique), dtype=np.int64)
+        ids[known] = self._sorted_ids[position[known]]
+        nb_new = int((~known).sum())
+        ids[~known] = np.arange(len(self.nodes), len(self.nodes) + nb_new)
+
+        if nb_new:
+            self.nodes = np.concatenate([self.nodes, unique[~known]])
+            order = np.argsort(self.nodes, kind="stable")
+            self._sorted_nodes = self.nodes[order]
+            self._sorted_ids = order
+
+        return ids[inverse]
+
+    def add(self, columns: dict) -> None:
+        """fold a batch of flattened traceroutes (store columns) into the graph"""
+        src, dst, rtt_delta = _hop_links(columns)
+        if not len(src):
+            return
+
+        ids = self._node_ids(np.concatenate([src, dst]))
+        keys = (ids[: len(src)] << 32) | ids[len(src) :]
+
+        # merge the batch into the existing edges
+        all_keys = np.concatenate([self.edge_keys, keys])
+        all_counts = np.concatenate([self.edge_counts, np.ones(len(keys), dtype=np.int64)])
+        all_rtt = np.concatenate([self.edge_rtt_sum, np.nan_to_num(rtt_delta)])
+        all_min = np.concatenate(
+            [self.edge_rtt_min, np.where(np.isnan(rtt_delta), np.inf, rtt_delta)]
+        )
+
+        self.edge_keys, inverse = np.unique(all_keys, return_inverse=True)
+        self.edge_counts = np.bincount(inverse, weights=all_counts).astype(np.int64)
+        self.edge_rtt_sum = np.bincount(inverse, weights=all_rtt)
+        self.edge_rtt_min = np.full(len(self.edge_keys), np.inf)
+        np.minimum.at(self.edge_rtt_min, inverse, all_min)
+
+    def edges(self) -> tuple:
+        """(src_id, dst_id) arrays of every edge"""
+        return self.edge_keys >> 32, self.edge_keys & 0xFFFFFFFF
+
+    def adjacency(self) -> tuple:
+        """CSR adjacency: successors of node i are indices[indptr[i]:indptr[i + 1]]"""
+        src, dst = self.edges()
+        indptr = np.searchsorted(src, np.arange(len(self.nodes) + 1))
+        return indptr, dst
+
+    def top_edges(self, k: int = 10) -> list:
+        """the k most traversed IP links, with their count and mean rtt delta"""
+        src, dst = self.edges()
+        top = np.argsort(-self.edge_counts, kind="stable")[:k]
+        return [
+            (
+                int_to_ip(self.nodes[src[i]]),
+                int_to_ip(self.nodes[dst[i]]),
+                int(self.edge_counts[i]),
+                float(self.edge_rtt_sum[i] / self.edge_counts[i]),
+            )
+            for i in top
+        ]
+
+    def as_edges(self, prefix_index: PrefixIndex, include_internal: bool = False) -> dict:
+        """
+        aggregate IP links into AS links
+
+        returns src_asn, dst_asn, count (traversals) and ip_links (number of
+        distinct IP links) arrays; links to or from unknown ASNs are dropped
+        and, unless include_internal, so are links inside one AS.
+        """
+        node_asn, _ = prefix_index.lookup(self.nodes)
+        src, dst = self.edges()
+        src_asn, dst_asn = node_asn[src], node_asn[dst]
+
+        keep = (src_asn != UNKNOWN_ASN) & (dst_asn != UNKNOWN_ASN)
+        if not include_internal:
+            keep &= src_asn != dst_asn
+
+        pairs = np.stack([src_asn[keep], dst_asn[keep]], axis=1)
+        unique, inverse = np.unique(pairs, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        return {
+            "src_asn": unique[:, 0] if len(unique) else np.empty(0, dtype=np.int64),
+            "dst_asn": unique[:, 1] if len(unique) else np.empty(0, dtype=np.int64),
+            "count": np.bincount(
+                inverse, weights=self.edge_counts[keep], minlength=len(unique)
+            ).astype(np.int64),
+            "ip_links": np.bincount(inverse, minlength=len(unique)),
+        }
+
+    def top_interconnects(self, prefix_index: PrefixIndex, k: int = 10) -> list:
+        """the k AS interconnects carrying the most traversals"""
+        as_edges = self.as_edges(prefix_index)
+        top = np.argsort(-as_edges["count"], kind="stable")[:k]
+        return [
+            (int(as_edges["src_asn"][i]), int(as_edges["dst_asn"][i]), int(as_edges["count"][i]))
+            for i in top
+        ]
@@ -0,0 +1,105 @@
+"""retry policy of the API client: POSTs must never be sent twice once they may have been processed"""
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from netmet.client import AtlasClient
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # per server: list of (status, headers, delay) answers, the last one repeats
+    answers = []
+    hits = None
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _answer(self) -> None:
+        with self.server.lock:
+            self.server.hits.append(self.command)
+            status, headers, delay = self.server.answers[
+                min(len(self.server.hits) - 1, len(self.server.answers) - 1)
+            ]
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+
+        time.sleep(delay)
+        body = json.dumps({"measurements": [1]}).encode()
+        try:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    do_GET = _answer
+    do_POST = _answer
+
+
+@pytest.fixture
+def server():
+    servers = []
+
+    def start(answers: list) -> tuple:
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        httpd.daemon_threads = True
+        httpd.lock = threading.Lock()
+        httpd.hits = []
+        httpd.answers = answers
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        servers.append(httpd)
+        return httpd, f"http://127.0.0.1:{httpd.server_address[1]}/api/v2/"
+
+    yield start
+
+    for httpd in servers:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_post_read_timeout_is_sent_once(server):
+    httpd, base_url = server([(201, {}, 1.0)])
+    client = AtlasClient(base_url=base_url, timeout=(1, 0.3), backoff_factor=0)
+
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.post_json("measurements/", {"definitions": []})
+    # leave time for a retry to show up, if one was sent
+    time.sleep(1.0)
+
+    assert httpd.hits == ["POST"]
+
+
+def test_post_5xx_is_not_retried(server):
+    httpd, base_url = server([(502, {}, 0.0)])
+    client = AtlasClient(base_url=base_url, backoff_factor=0)
+
+    with pytest.raises(requests.HTTPError):
+        client.post_json("measurements/", {"definitions": []})
+
+    assert httpd.hits == ["POST"]
+
+
+def test_post_throttled_is_retried(server):
+    httpd, base_url = server([(429, {"Retry-After": "0"}, 0.0), (201, {}, 0.0)])
+    client = AtlasClient(base_url=base_url, backoff_factor=0)
+
+    assert client.post_json("measurements/", {"definitions": []}) == {"measurements": [1]}
+    assert httpd.hits == ["POST", "POST"]
+
+
+def test_get_read_timeout_is_retried(server):
+    httpd, base_url = server([(200, {}, 1.0), (200, {}, 0.0)])
+    client = AtlasClient(base_url=base_url, timeout=(1, 0.3), backoff_factor=0)
+
+    assert client.get_json("measurements/1/") == {"measurements": [1]}
+    assert httpd.hits == ["GET", "GET"]
@@ -0,0 +1,51 @@
+"""ledger instances sharing one file"""
+from netmet.ledger import Ledger
+
+
+def _record(measurement_id: int, vp_id: int, target: str = "192.0.2.1") -> dict:
+    return {
+        "measurement_id": [measurement_id],
+        "measurement_description": {
+            "definitions": [{"target": target, "protocol": "ICMP"}],
+            "probes": [{"type": "probes", "value": str(vp_id), "requested": 1}],
+        },
+    }
+
+
+def test_refresh_after_compact_by_another_instance(tmp_path):
+    path = tmp_path / "ledger.jsonl"
+    writer = Ledger(path)
+    reader = Ledger(path)
+
+    for measurement_id in range(1, 6):
+        writer.append(_record(measurement_id, vp_id=measurement_id))
+        writer.append(_record(measurement_id, vp_id=measurement_id))
+    assert reader.refresh() == 10
+
+    # the rewrite shrinks the file below the reader offset, then grows it again
+    assert writer.compact() == 5
+    writer.append(_record(6, vp_id=6, target="198.51.100.1"))
+    reader.refresh()
+
+    assert reader.measurement_ids() == [1, 2, 3, 4, 5, 6]
+    assert reader.by_key[(6, "198.51.100.1", "ICMP", None, None)] == [6]
+    assert all(len(ids) == 1 for ids in reader.by_key.values())
+
+
+def test_refresh_after_compact_regrown_past_offset(tmp_path):
+    path = tmp_path / "ledger.jsonl"
+    writer = Ledger(path)
+    reader = Ledger(path)
+
+    writer.append(_record(1, vp_id=1))
+    writer.append(_record(1, vp_id=1))
+    reader.refresh()
+
+    # the compacted file grows past the reader offset: only its inode changed
+    writer.compact()
+    writer.append(_record(2, vp_id=2))
+    writer.append(_record(3, vp_id=3))
+    assert path.stat().st_size > reader._offset
+    reader.refresh()
+
+    assert reader.measurement_ids() == [1, 2, 3]
@@ -0,0 +1,45 @@
+"""smoke tests of the exercise scripts against the local stub server"""
+import importlib
+
+import pytest
+
+from netmet import cache, client
+from netmet.cache import HttpCache
+from netmet.client import BASE_URL, AtlasClient
+from netmet.mock_server import MockAtlas, serve
+
+
+class _LocalClient(AtlasClient):
+    """send the absolute RIPE Atlas urls of the scripts to the stub server"""
+
+    def url(self, path: str) -> str:
+        if path.startswith(BASE_URL):
+            path = path[len(BASE_URL) :]
+        return super().url(path)
+
+
+@pytest.fixture
+def atlas(tmp_path, monkeypatch):
+    atlas = MockAtlas()
+    with serve(atlas) as base_url:
+        local_client = _LocalClient(base_url=base_url)
+        monkeypatch.setattr(client, "_default_client", local_client)
+        monkeypatch.setattr(
+            cache, "_default_cache", HttpCache(tmp_path / "cache", client=local_client)
+        )
+        yield atlas
+
+
+@pytest.mark.parametrize("script", ["main", "main_correction"])
+def test_exo2_get_a_measurement_result(script, atlas, tmp_path):
+    module = importlib.import_module(script)
+    # the measurement of the exercise statement, recorded in the stub fixtures
+    measurement_id = 38333397
+    output_file_path = tmp_path / "results_exo2.json"
+
+    for _ in range(2):
+        # the second run reads the stopped measurement from the cache
+        traceroute = module.exo2_get_a_measurement_result(measurement_id, output_file_path)
+
+    assert traceroute == atlas.templates[measurement_id]["result"]
+    assert output_file_path.exists()